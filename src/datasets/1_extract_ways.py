@@ -2,31 +2,40 @@ import os
 import pandas as pd
 
 from way_graph import WayGraph
+from instrument import Run
 
-map_dir = "~/data/HERE-24Q2"
-state = 'NV'
+data_dir = os.environ.get('PIPELINE_DATA_DIR', "~/data")
+map_dir = os.path.join(data_dir, os.environ.get('PIPELINE_MAP', "HERE-24Q2"))
+state = os.environ.get('PIPELINE_STATE', 'NV')
 
 graph = WayGraph()
-
-raw_ways = pd.read_csv(os.path.join(map_dir, f"{state}/WAYS"), delimiter='`', header=None)
-for index, raw_way in raw_ways.iterrows():
-    graph.append_way(raw_way)
-    if index % 100000 == 0:
-        print(f"parsed {index} raw ways")
-
-raw_relations = pd.read_csv(os.path.join(map_dir, f"{state}/RELATIONS"), delimiter='`', header=None)
-for index, raw_relation in raw_relations.iterrows():
-    graph.append_relation(raw_relation)
-    if index % 200000 == 0:
-        print(f"parsed {index} raw relations")
-
-raw_members = pd.read_csv(os.path.join(map_dir, f"{state}/RELATION_MEMBERS"), delimiter='`', header=None)
-for index, raw_member in raw_members.iterrows():
-    graph.add_relation_member(raw_member)
-    if index % 500000 == 0:
-        print(f"parsed {index} raw relation members")
-
-graph.complete()
+run = Run(f'1_extract_ways_{state}')
+
+with run.stage('ways') as stage:
+    raw_ways = pd.read_csv(os.path.join(map_dir, f"{state}/WAYS"), delimiter='`', header=None)
+    for index, raw_way in raw_ways.iterrows():
+        graph.append_way(raw_way)
+        if index % 100000 == 0:
+            print(f"parsed {index} raw ways")
+    stage.rows = len(raw_ways)
+
+with run.stage('relations') as stage:
+    raw_relations = pd.read_csv(os.path.join(map_dir, f"{state}/RELATIONS"), delimiter='`', header=None)
+    for index, raw_relation in raw_relations.iterrows():
+        graph.append_relation(raw_relation)
+        if index % 200000 == 0:
+            print(f"parsed {index} raw relations")
+    stage.rows = len(raw_relations)
+
+with run.stage('members') as stage:
+    raw_members = pd.read_csv(os.path.join(map_dir, f"{state}/RELATION_MEMBERS"), delimiter='`', header=None)
+    graph.add_relation_members(raw_members)
+    print(f"parsed {len(raw_members)} raw relation members")
+    stage.rows = len(raw_members)
+
+with run.stage('complete', rows=len(graph.__leaf_ways__)):
+    graph.complete()
+    graph.close()
 
 ways = pd.DataFrame(graph.ways, columns=['way_id', 'length', 'oneway', 'road_class', 'road_type', 'divider', 'urban', 'bipesz',
                              'lane_count', 'forward_lane_count', 'backward_lane_count', 'forward_speed', 'backward_speed',
@@ -40,10 +49,13 @@ relations = pd.DataFrame(graph.relations, columns=['type', 'value', 'from_way',
 print(f"non road way {graph.non_road_way}; ignored leaf way {graph.ignored_road_way};") 
 print(f"built {ways.shape[0]} ways, {nodes.shape[0]} nodes, {relations.shape[0]} relations")
 
-output_dir = "~/data/GNN"
+output_dir = os.path.join(data_dir, "GNN")
+
+with run.stage('export', rows=ways.shape[0] + nodes.shape[0] + relations.shape[0]):
+    ways.to_csv(os.path.join(output_dir, f"{state}/WAYS.csv"), index=False, )
+    polylines.to_csv(os.path.join(output_dir, f"{state}/POLYLINES.csv"), index=False)
+    nodes.to_csv(os.path.join(output_dir, f"{state}/NODES.csv"), index=False)
+    stations.to_csv(os.path.join(output_dir, f"{state}/STATIONS.csv"), index=False)
+    relations.to_csv(os.path.join(output_dir, f"{state}/RELATIONS.csv"), index=False)
 
-ways.to_csv(os.path.join(output_dir, f"{state}/WAYS.csv"), index=False, )
-polylines.to_csv(os.path.join(output_dir, f"{state}/POLYLINES.csv"), index=False)
-nodes.to_csv(os.path.join(output_dir, f"{state}/NODES.csv"), index=False)
-stations.to_csv(os.path.join(output_dir, f"{state}/STATIONS.csv"), index=False)
-relations.to_csv(os.path.join(output_dir, f"{state}/RELATIONS.csv"), index=False)
+run.save()
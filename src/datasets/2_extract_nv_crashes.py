@@ -1,6 +1,18 @@
+import os
+import sys
 import pandas as pd
 import pyproj
-from matching import match_maneuver
+from matching import match_maneuver, telemetry, probe_order
+from instrument import Run
+from crash_counts import CrashCounts
+
+data_dir = os.environ.get('PIPELINE_DATA_DIR', "~/data")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+year = int(os.environ.get('PIPELINE_YEAR', 2019))
+
+# append mode: only crashes not in CRASHES.csv yet are classified, matched, appended and counted
+append = '--append' in sys.argv or os.environ.get('CRASH_APPEND') == '1'
+crashes_path = os.path.expanduser(os.path.join(data_dir, f"GNN/{state}/CRASHES.csv"))
 
 severities = {'FATAL CRASH':3, 'INJURY CRASH':2, 'PROPERTY DAMAGE ONLY':1}
 
@@ -231,35 +243,56 @@ def print_crash(raw_crash, crash):
         print(str(raw_crash['V2 Action']) + ' | ' + str(raw_crash['V2 Driver Factors']) + ' | ' + str(raw_crash['V2 Vehicle Factors']) + ' | ' + str(raw_crash['V2 All Events']))
         print(f"=> {crash['v2_maneuver']} | {crash['v2_dir']} | {crash['v2_fault']} " + ('$' if at_fault(raw_crash, 'V2') else ''))
 
-raw_crashes = pd.read_csv('~/data/CRASH/NV/Crash_2016-2020.csv')
+run = Run(f'2_extract_{state.lower()}_crashes_{year}')
+raw_crashes = pd.read_csv(os.path.join(data_dir, f"CRASH/{state}/Crash_2016-2020.csv"))
 
 maneuvers = {}
 crashes = []
 num = 0
 
-raw_crashes = raw_crashes[raw_crashes['Crash Year'] == 2019]
+raw_crashes = raw_crashes[raw_crashes['Crash Year'] == year]
+ways = pd.read_csv(os.path.join(data_dir, f"GNN/{state}/WAYS.csv"), usecols=['way_id', 'start_bearing'])
+probe_order.set_bearings(ways['way_id'], ways['start_bearing'])
+counts = CrashCounts(os.path.join(data_dir, f"GNN/{state}/CRASH_COUNTS"))
+if append and os.path.exists(crashes_path):
+    if counts.n_ways is None:
+        # the first append after full runs counts the crashes extracted so far
+        counts.rebuild(pd.read_csv(crashes_path), ways)
+    raw_crashes = raw_crashes[~counts.seen(raw_crashes['OBJECTID'].to_numpy())]
 print(raw_crashes.shape)
 
-for index, raw_crash in raw_crashes.iterrows():
-    crash = convert(raw_crash)
+with run.stage('crashes', rows=len(raw_crashes)):
+    for index, raw_crash in raw_crashes.iterrows():
+        with run.lap('classify'):
+            crash = convert(raw_crash)
 
-    match_maneuver(crash)
-    crashes.append(crash)
-    num += 1
+        with run.lap('match'), telemetry.item():
+            match_maneuver(crash)
+        crashes.append(crash)
+        num += 1
 
-    if num % 200 == 0:
-        print(f"parsed {index} raw crashes, matched {num} crashes")
-        # break
+        if num % 200 == 0:
+            print(f"parsed {index} raw crashes, matched {num} crashes")
+            # break
 
-    # if is_special(raw_crash, 'V1'):
-    #     print_crash(raw_crash, crash)
-    #     print('***')
+        # if is_special(raw_crash, 'V1'):
+        #     print_crash(raw_crash, crash)
+        #     print('***')
 
 crashes = pd.DataFrame(crashes, columns=['crash_id', 'crash_date', 'crash_time', 'crash_severity', 'intersection', 
                              'v1_maneuver', 'v1_dir', 'v1_fault', 'v1_way', 'v2_maneuver', 'v2_dir', 'v2_fault', 'v2_way',
                              'mbpa', 'primary_road', 'lat', 'lon']) 
  
-crashes.to_csv("~/data/GNN/NV/CRASHES.csv", index=False)
+with run.stage('counts', rows=len(crashes)):
+    if append and os.path.exists(crashes_path):
+        crashes.to_csv(crashes_path, mode='a', header=False, index=False)
+        counts.append(crashes, ways)
+    else:
+        crashes.to_csv(crashes_path, index=False)
+        counts.rebuild(crashes, ways)
+run.attach('matching', telemetry)
+run.attach('probe_order', probe_order)
+run.save()
 
 '''  
 dfactors = {}
@@ -1,8 +1,14 @@
+import os
 import numpy as np
 import pandas as pd 
-import requests
 
-raw_aadts = pd.read_csv('~/data/AADT/NV/NV_AADT.csv')
+from instrument import Run
+from match_telemetry import MatchTelemetry
+
+data_dir = os.environ.get('PIPELINE_DATA_DIR', "~/data")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+raw_aadts = pd.read_csv(os.path.join(data_dir, f"AADT/{state}/{state}_AADT.csv"))
 
 '''
 http://denali.telenav.com/entity/v4/search/json?api_key=b616a547-6611-4fc4-9b2e-41b0c8f5b903
@@ -17,6 +23,10 @@ OFFSET = 0.0002
 DEVIS = [ [0, OFFSET], [-OFFSET, 0], [0, -OFFSET], [OFFSET, 0], 
          [OFFSET, OFFSET], [-OFFSET, OFFSET], [-OFFSET, -OFFSET], [OFFSET, -OFFSET]]
 
+# matching requests and probes, search requests kept apart to not count as probes
+telemetry = MatchTelemetry()
+search_telemetry = MatchTelemetry()
+
 def match_line(points, is_ramp = False):
     coordinates = ''
     for point in points:
@@ -30,7 +40,7 @@ def match_line(points, is_ramp = False):
         'multiplePath':'true'    
     }
     
-    response = requests.get(url = MATCHING_URL, params = matching_params)
+    response = telemetry.get(MATCHING_URL, matching_params)
     if not response.ok:
         return (0, 0)
     
@@ -62,10 +72,13 @@ def match_line(points, is_ramp = False):
 def match_point(from_point, is_ramp = False):
     score = 0
     way_id = 0
+    probes = 0
+    early_exit = False
 
     for devi in DEVIS:
         to_point = (from_point[0] + devi[0], from_point[1] + devi[1])
         score_, way_id_ = match_line([from_point, to_point], is_ramp)
+        probes += 1
         
         if score_ < 70:
             continue
@@ -74,8 +87,10 @@ def match_point(from_point, is_ramp = False):
             way_id = way_id_
 
         if score > 99:
+            early_exit = probes < len(DEVIS)
             break
-        
+
+    telemetry.point(probes, score, early_exit)
     return (score, way_id)
 
 def road_is_ramp(name):
@@ -121,7 +136,7 @@ def towards(pt, on_road, to_road):
         'limit': 1  
     }
 
-    response = requests.get(url = SEARCHING_URL, params = searching_params)
+    response = search_telemetry.get(SEARCHING_URL, searching_params)
     if not response.ok:
         return None
     
@@ -164,74 +179,85 @@ aadts = []
 # 12110,312310,35400,30832; 170035,190129,
 # raw_aadts = raw_aadts[raw_aadts['Name'].isin([190002,30111])]
 
-for index, raw_aadt in raw_aadts.iterrows():
-    pt = (float(raw_aadt['LAT_DECIMAL']), float(raw_aadt['LON_DECIMAL']))
-    is_ramp = road_is_ramp(raw_aadt['LOCATION_D'])
-    on_road = road_name(raw_aadt['ROUTE_NAME'])
-    pts = None
-
-    aadt = {}
-
-    aadt['aadt_code'] = raw_aadt['Name']
-    aadt['on_road'] = on_road
-    aadt['to_road'] = ''
-    aadt['lat'] = round(pt[0], 5)
-    aadt['lon'] = round(pt[1], 5)
-
-    if not pd.isna(raw_aadt['STREET_TO']):
-        to_road = road_name(raw_aadt['STREET_TO'])
-        aadt['to_road'] = to_road
-        pt2 = towards(pt, on_road, to_road)
-        if pt2 is not None:
-            pts = start_segment_of_line(pt, pt2, 0.00030)
-
-    if pts:
-        score, way_id = match_line(pts, is_ramp)
-        aadt['score'] = int(score)
-        if score >= 95:
-            aadt['matched'] = 2
-
-    if 'matched' not in aadt:
-        score, way_id = match_point(pt, is_ramp)
-        aadt['score'] = int(score)
-        if score >= 95:
-            aadt['matched'] = 1
-        elif score >= 85:
-            aadt['matched'] = 0
-        elif score >= 70:
-            aadt['matched'] = -1
-        else:
-            aadt['matched'] = -2
-
-    aadt['way_id'] = way_id
-    aadt['aadt_2007'] = raw_aadt['AADT_2007']
-    aadt['aadt_2008'] = raw_aadt['AADT_2008']
-    aadt['aadt_2009'] = raw_aadt['AADT_2009']
-    aadt['aadt_2010'] = raw_aadt['AADT_2010']
-    aadt['aadt_2011'] = raw_aadt['AADT_2011']
-    aadt['aadt_2012'] = raw_aadt['AADT_2012']
-    aadt['aadt_2013'] = raw_aadt['AADT_2013']
-    aadt['aadt_2014'] = raw_aadt['AADT_2014']
-    aadt['aadt_2015'] = raw_aadt['AADT_2015']
-    aadt['aadt_2016'] = raw_aadt['AADT_2016']
-    aadt['aadt_2017'] = raw_aadt['AADT_2017']
-    aadt['aadt_2018'] = raw_aadt['AADT_2018']
-    aadt['aadt_2019'] = raw_aadt['AADT_2019']
-    aadt['aadt_2020'] = raw_aadt['AADT_2020']
-    aadt['aadt_2021'] = raw_aadt['AADT_2021']
-    aadt['aadt_2022'] = raw_aadt['AADT_2022']
-
-    aadts.append(aadt)
-
-    if (index + 1) % 200 == 0:
-        print(f"parsed {index + 1} raw aadts")
+run = Run(f'3_extract_{state.lower()}_aadt')
+
+with run.stage('aadts', rows=len(raw_aadts)):
+    for index, raw_aadt in raw_aadts.iterrows():
+        pt = (float(raw_aadt['LAT_DECIMAL']), float(raw_aadt['LON_DECIMAL']))
+        is_ramp = road_is_ramp(raw_aadt['LOCATION_D'])
+        on_road = road_name(raw_aadt['ROUTE_NAME'])
+        pts = None
+
+        aadt = {}
+
+        aadt['aadt_code'] = raw_aadt['Name']
+        aadt['on_road'] = on_road
+        aadt['to_road'] = ''
+        aadt['lat'] = round(pt[0], 5)
+        aadt['lon'] = round(pt[1], 5)
+
+        if not pd.isna(raw_aadt['STREET_TO']):
+            to_road = road_name(raw_aadt['STREET_TO'])
+            aadt['to_road'] = to_road
+            with run.lap('search'):
+                pt2 = towards(pt, on_road, to_road)
+            if pt2 is not None:
+                pts = start_segment_of_line(pt, pt2, 0.00030)
+
+        with telemetry.item():
+            if pts:
+                with run.lap('match'):
+                    score, way_id = match_line(pts, is_ramp)
+                aadt['score'] = int(score)
+                if score >= 95:
+                    aadt['matched'] = 2
+
+            if 'matched' not in aadt:
+                with run.lap('match'):
+                    score, way_id = match_point(pt, is_ramp)
+                aadt['score'] = int(score)
+                if score >= 95:
+                    aadt['matched'] = 1
+                elif score >= 85:
+                    aadt['matched'] = 0
+                elif score >= 70:
+                    aadt['matched'] = -1
+                else:
+                    aadt['matched'] = -2
+        telemetry.grade(aadt['matched'])
+
+        aadt['way_id'] = way_id
+        aadt['aadt_2007'] = raw_aadt['AADT_2007']
+        aadt['aadt_2008'] = raw_aadt['AADT_2008']
+        aadt['aadt_2009'] = raw_aadt['AADT_2009']
+        aadt['aadt_2010'] = raw_aadt['AADT_2010']
+        aadt['aadt_2011'] = raw_aadt['AADT_2011']
+        aadt['aadt_2012'] = raw_aadt['AADT_2012']
+        aadt['aadt_2013'] = raw_aadt['AADT_2013']
+        aadt['aadt_2014'] = raw_aadt['AADT_2014']
+        aadt['aadt_2015'] = raw_aadt['AADT_2015']
+        aadt['aadt_2016'] = raw_aadt['AADT_2016']
+        aadt['aadt_2017'] = raw_aadt['AADT_2017']
+        aadt['aadt_2018'] = raw_aadt['AADT_2018']
+        aadt['aadt_2019'] = raw_aadt['AADT_2019']
+        aadt['aadt_2020'] = raw_aadt['AADT_2020']
+        aadt['aadt_2021'] = raw_aadt['AADT_2021']
+        aadt['aadt_2022'] = raw_aadt['AADT_2022']
+
+        aadts.append(aadt)
+
+        if (index + 1) % 200 == 0:
+            print(f"parsed {index + 1} raw aadts")
 
 aadts = pd.DataFrame(aadts, columns=['aadt_code', 'on_road', 'to_road', 'lat', 'lon', 'matched', 'score', 'way_id', 
                              'aadt_2007', 'aadt_2008', 'aadt_2009', 'aadt_2010', 'aadt_2011', 'aadt_2012', 'aadt_2013', 
                              'aadt_2014', 'aadt_2015', 'aadt_2016', 'aadt_2017', 'aadt_2018', 'aadt_2019', 'aadt_2020', 
                              'aadt_2021', 'aadt_2022']) 
  
-aadts.to_csv("~/data/GNN/NV/AADTS.csv", index=False)
+aadts.to_csv(os.path.join(data_dir, f"GNN/{state}/AADTS.csv"), index=False)
+run.attach('matching', telemetry)
+run.attach('search', search_telemetry)
+run.save()
 
 
 """
@@ -1,36 +1,40 @@
 import os
 import pandas as pd
-from meteostat import Hourly
 from datetime import datetime
+from weather_store import WeatherStore
+from instrument import Run
 
 # 2016, 2019, 2023
 
-map_dir = "~/data/HERE-24Q2"
-gnn_dir = "~/data/GNN"
-state = 'NV'
-year = 2016
+data_dir = os.environ.get('PIPELINE_DATA_DIR', "~/data")
+map_dir = os.path.join(data_dir, os.environ.get('PIPELINE_MAP', "HERE-24Q2"))
+gnn_dir = os.path.join(data_dir, "GNN")
+weather_dir = os.path.join(data_dir, "WEATHER")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+year = int(os.environ.get('PIPELINE_YEAR', 2016))
 
 def get_stations():
     stations = pd.read_csv(os.path.join(gnn_dir, f"{state}/STATIONS.csv"))
     return stations['station'].to_list()
 
-def fetch_weather(start, end, timezone):
-    stations = get_stations()
-    data = Hourly(stations, start, end, timezone)
-    data = data.fetch()
+def fetch_weather(store, start, end, timezone):
+    # only station months not in the store yet, UTC months covering the local year
+    start = pd.Timestamp(start).tz_localize(timezone).tz_convert('UTC').tz_localize(None)
+    end = pd.Timestamp(end).tz_localize(timezone).tz_convert('UTC').tz_localize(None)
+    store.update(get_stations(), start, end)
 
-    weather = data[['temp', 'coco', 'prcp', 'wdir', 'wspd']] 
-    weather.rename(index={s : i for i, s in enumerate(stations)}, inplace=True)
-
-    weather.rename_axis(index=["station", "hour"], inplace=True)
-    weather.to_csv(os.path.join(gnn_dir, f"{state}/WEATHER_{year}.csv"), date_format='%y%m%d%H')
-
-def load_weather():
-    return pd.read_csv(os.path.join(gnn_dir, f"{state}/WEATHER_{year}.csv"), index_col=[0,1], date_format='%y%m%d%H')
+def load_weather(store, start, end, timezone):
+    return store.read(get_stations(), start, end, timezone)
 
 start = datetime(year, 1, 1)
 end = datetime(year + 1, 1, 1)
 
-fetch_weather(start, end, 'US/Pacific')
-weather = load_weather()
-print(weather)
\ No newline at end of file
+run = Run(f'4_extract_nv_weather_{year}')
+store = WeatherStore(weather_dir, offline=os.environ.get('WEATHER_OFFLINE') == '1')
+with run.stage('weather fetch'):
+    fetch_weather(store, start, end, 'US/Pacific')
+with run.stage('weather read') as stage:
+    weather = load_weather(store, start, end, 'US/Pacific')
+    stage.rows = len(weather)
+print(weather)
+run.save()
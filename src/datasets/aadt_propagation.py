@@ -0,0 +1,100 @@
+import os
+import numpy as np
+import scipy.sparse as sp
+
+from aadt_store import load_aadt_store
+from graph_arrays import load_ways, load_nodes, node_ways, transitions
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+AADT propagation from counted ways to all ways of the graph
+
+connectivity W[i, j]: weight of way j feeding way i through a legal transition either way,
+    scaled by the road_class gap of the two ways (volume hardly crosses road classes)
+
+diffusion per year column, counted ways are clamped to their log AADT v (label propagation):
+    num = v if counted else alpha * S @ num
+    den = 1 if counted else alpha * S @ den          S = row normalized W
+estimate = exp(num / den), a geometric mean of counts weighted by alpha ** hops
+confidence = den in [0, 1], the share of the walks from a way that reach a count
+iterations stop when neither num / den (the log estimate) nor den changes by tol or more
+"""
+
+CLASS_WEIGHTS = [1.0, 0.25]  # by road_class difference 0, 1; others do not connect
+
+def way_connectivity(ways, nodes):
+    '''
+    symmetric sparse [way, way] weights over legal transitions, private/walk ways excluded
+    '''
+    oneway = ways['oneway'].to_numpy()
+    road_class = ways['road_class'].to_numpy()
+
+    indptr, signed = node_ways(nodes)
+    from_dirway, _, to_dirway = transitions(indptr, signed, oneway)
+    from_way = np.abs(from_dirway)
+    to_way = np.abs(to_dirway)
+
+    gap = np.abs(road_class[from_way] - road_class[to_way])
+    weight = np.zeros(len(gap))
+    for difference, class_weight in enumerate(CLASS_WEIGHTS):
+        weight[gap == difference] = class_weight
+
+    keep = (weight > 0) & (road_class[from_way] > 0) & (road_class[to_way] > 0) & (from_way != to_way)
+    rows = np.concatenate([from_way[keep], to_way[keep]])
+    cols = np.concatenate([to_way[keep], from_way[keep]])
+    weight = np.concatenate([weight[keep], weight[keep]])
+
+    # a pair of ways shows up once per direction and per shared node
+    _, first = np.unique(rows * len(ways) + cols, return_index=True)
+    return sp.csr_matrix((weight[first], (rows[first], cols[first])), shape=(len(ways), len(ways)))
+
+def propagate(connectivity, aadt, valid, alpha = 0.8, tol = 1e-4, max_iter = 200, return_iterations = False):
+    '''
+    aadt, valid: [way, year] as AadtStore
+    return estimate int32 [way, year], confidence float32 [way, year], and the iterations run if return_iterations
+    '''
+    degree = np.asarray(connectivity.sum(axis=1)).ravel()
+    inverse = np.divide(1.0, degree, out=np.zeros_like(degree), where=degree > 0)
+    transfer = (sp.diags(inverse) @ connectivity).tocsr() * alpha
+
+    counted = np.asarray(valid)
+    source = np.where(counted, np.log(np.maximum(np.asarray(aadt, dtype=np.float64), 1)), 0)
+
+    num = source
+    den = counted.astype(np.float64)
+    log_estimate = np.where(counted, source, 0)
+    for i in range(max_iter):
+        num = np.where(counted, source, transfer @ num)
+        den_ = np.where(counted, 1.0, transfer @ den)
+        log_estimate_ = np.divide(num, den_, out=np.zeros_like(num), where=den_ > 1e-9)
+        delta = max(np.abs(den_ - den).max(initial=0), np.abs(log_estimate_ - log_estimate).max(initial=0))
+
+        den = den_
+        log_estimate = log_estimate_
+        if delta < tol:
+            break
+
+    reached = den > 1e-9
+    estimate = np.zeros(den.shape, dtype=np.int32)
+    estimate[reached] = np.round(np.exp(num[reached] / den[reached]))
+    estimate[counted] = np.asarray(aadt)[counted]
+    if return_iterations:
+        return estimate, den.astype(np.float32), i + 1
+    return estimate, den.astype(np.float32)
+
+if __name__ == '__main__':
+    store_dir = os.path.join(gnn_dir, f"{state}/AADT")
+    store = load_aadt_store(store_dir)
+
+    ways = load_ways(gnn_dir, state, ['oneway', 'road_class'])
+    nodes = load_nodes(gnn_dir, state)
+
+    connectivity = way_connectivity(ways, nodes)
+    store.estimate, store.confidence, iterations = propagate(connectivity, store.aadt, store.valid,
+                                                             return_iterations=True)
+    store.save_estimate(store_dir)
+
+    print(f"propagated aadt in {iterations} iterations")
+    print(f"estimated aadt of {(store.confidence > 0).any(axis=1).sum()} ways in {len(store)} ways")
@@ -0,0 +1,133 @@
+import os
+import numpy as np
+import pandas as pd
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+YEARS = list(range(2007, 2023))
+
+"""
+AADT store: a directory of .npy files, one row per way index of WAYS.csv (row 0 is the dummy way)
+    years:   int32 [year]               2007-2022
+    aadt:    int32 [way, year]          0 where there is no count
+    valid:   bool  [way, year]
+    matched: int8  [way]                matched grade of the count station, -3 if no station on the way
+    score:   int16 [way]                matching score of the count station
+    estimate:   int32   [way, year]     optional, propagated by aadt_propagation.py
+    confidence: float32 [way, year]     optional, 1 for counted ways
+"""
+
+NO_STATION = -3
+
+class AadtStore:
+    '''
+    aadt[way_index] is the AADT history of a way; a way matched by several count stations keeps
+    the best matched one (higher matched grade, then higher score)
+    '''
+    def __init__(self, years, aadt, valid, matched, score):
+        self.years = years
+        self.aadt = aadt
+        self.valid = valid
+        self.matched = matched
+        self.score = score
+        self.estimate = None
+        self.confidence = None
+
+    def __len__(self):
+        return self.aadt.shape[0]
+
+    def get(self, way_index, year = None):
+        if year is None:
+            return self.aadt[way_index], self.valid[way_index]
+
+        column = year - self.years[0]
+        if column < 0 or column >= len(self.years):
+            return 0, False
+
+        return self.aadt[way_index, column], self.valid[way_index, column]
+
+    def gather(self, way_indexes, years):
+        '''
+        way_indexes and years are broadcast against each other, e.g. ways [n] with one year,
+        or ways [n, 1] with years [m] for a [n, m] result; years out of range are not valid
+        '''
+        way_indexes = np.asarray(way_indexes)
+        columns = np.asarray(years) - self.years[0]
+        in_range = (columns >= 0) & (columns < len(self.years))
+        columns = np.where(in_range, columns, 0)
+
+        values = self.aadt[way_indexes, columns]
+        valid = self.valid[way_indexes, columns] & in_range
+        return np.where(valid, values, 0), valid
+
+    def save(self, path):
+        path = os.path.expanduser(path)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'years.npy'), self.years)
+        np.save(os.path.join(path, 'aadt.npy'), self.aadt)
+        np.save(os.path.join(path, 'valid.npy'), self.valid)
+        np.save(os.path.join(path, 'matched.npy'), self.matched)
+        np.save(os.path.join(path, 'score.npy'), self.score)
+        if self.estimate is not None:
+            self.save_estimate(path)
+
+    def save_estimate(self, path):
+        path = os.path.expanduser(path)
+        np.save(os.path.join(path, 'estimate.npy'), self.estimate)
+        np.save(os.path.join(path, 'confidence.npy'), self.confidence)
+
+def load_aadt_store(path, mmap = True):
+    path = os.path.expanduser(path)
+    mmap_mode = 'r' if mmap else None
+
+    def load(name):
+        return np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+
+    store = AadtStore(np.asarray(load('years')), load('aadt'), load('valid'), load('matched'), load('score'))
+    if os.path.exists(os.path.join(path, 'estimate.npy')):
+        store.estimate = load('estimate')
+        store.confidence = load('confidence')
+
+    return store
+
+def build_aadt_store(aadts, ways, min_matched = -1):
+    '''
+    aadts: DataFrame of AADTS.csv
+    ways: DataFrame of WAYS.csv, row index is the way index
+    min_matched: counts with a lower matched grade are dropped (-2 is not matched at all)
+    '''
+    years = np.array(YEARS, dtype=np.int32)
+    columns = [f'aadt_{year}' for year in YEARS]
+
+    aadts = aadts[(aadts['way_id'] != 0) & (aadts['matched'] >= min_matched)]
+    aadts = aadts.sort_values(['matched', 'score'], ascending=False).drop_duplicates('way_id')
+
+    way_indexes = pd.Index(ways['way_id']).get_indexer(aadts['way_id'])
+    aadts = aadts[way_indexes > 0]
+    way_indexes = way_indexes[way_indexes > 0]
+
+    values = aadts[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    valid = np.isfinite(values) & (values > 0)
+
+    store = AadtStore(years,
+        np.zeros((len(ways), len(years)), dtype=np.int32),
+        np.zeros((len(ways), len(years)), dtype=bool),
+        np.full(len(ways), NO_STATION, dtype=np.int8),
+        np.zeros(len(ways), dtype=np.int16))
+
+    store.aadt[way_indexes] = np.where(valid, values, 0).astype(np.int32)
+    store.valid[way_indexes] = valid
+    store.matched[way_indexes] = aadts['matched'].to_numpy()
+    store.score[way_indexes] = aadts['score'].to_numpy()
+
+    return store
+
+if __name__ == '__main__':
+    ways = pd.read_csv(os.path.join(gnn_dir, f"{state}/WAYS.csv"), usecols=['way_id'])
+    aadts = pd.read_csv(os.path.join(gnn_dir, f"{state}/AADTS.csv"))
+
+    store = build_aadt_store(aadts, ways)
+    store.save(os.path.join(gnn_dir, f"{state}/AADT"))
+
+    print(f"stored aadt of {store.valid.any(axis=1).sum()} ways in {len(store)} ways")
@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from instrument import Run
+from synthetic import generate
+from graph_arrays import load_ways, load_nodes, load_relations
+from joints import build_joints
+from crash_labels import build_crash_labels
+from aadt_store import build_aadt_store
+from aadt_propagation import way_connectivity, propagate
+from routing import Router, routing_graph, route_ways
+from sampler import build_sampler
+
+bench_dir = "~/data/BENCH"
+
+"""
+end to end benchmark on synthetic data (synthetic.py) at several grid sizes
+
+stages: the WayGraph build of 1_extract_ways.py (ways, relations, members, complete, export), then
+joints, crash_labels, aadt (store and propagation), routing (landmarks and queries) and sampler
+
+results: {size: run report of instrument.py}; a stage regresses when its rows/sec falls below
+(1 - tolerance) of the baseline for the same size, baseline at {bench_dir}/baseline.json;
+the command exits 1 on regressions
+"""
+
+SIZES = [10, 20, 40]
+
+WAY_COLUMNS = ['way_id', 'length', 'oneway', 'road_class', 'road_type', 'divider', 'urban', 'bipesz',
+               'lane_count', 'forward_lane_count', 'backward_lane_count', 'forward_speed', 'backward_speed',
+               'start_bearing', 'end_bearing', 'curve_left', 'curve_right', 'slope_up', 'slope_down',
+               'from_node', 'to_node']
+
+def build_graph(map_dir, gnn_dir, state, run):
+    '''
+    the stages of 1_extract_ways.py from raw files in map_dir to CSVs in gnn_dir
+    '''
+    from way_graph import WayGraph
+
+    graph = WayGraph()
+    for stage_name, name, append in [('ways', 'WAYS', graph.append_way), ('relations', 'RELATIONS', graph.append_relation)]:
+        with run.stage(stage_name) as stage:
+            raw = pd.read_csv(os.path.join(map_dir, f"{state}/{name}"), delimiter='`', header=None)
+            for _, row in raw.iterrows():
+                append(row)
+            stage.rows = len(raw)
+
+    with run.stage('members') as stage:
+        raw = pd.read_csv(os.path.join(map_dir, f"{state}/RELATION_MEMBERS"), delimiter='`', header=None)
+        graph.add_relation_members(raw)
+        stage.rows = len(raw)
+
+    with run.stage('complete', rows=len(graph.__leaf_ways__)):
+        graph.complete()
+        graph.close()
+
+    ways = pd.DataFrame(graph.ways, columns=WAY_COLUMNS)
+    nodes = pd.DataFrame(graph.nodes, columns=['node_id', 'station', 'ways'])
+    relations = pd.DataFrame(graph.relations, columns=['type', 'value', 'from_way', 'via_node', 'to_way'])
+    with run.stage('export', rows=len(ways) + len(nodes) + len(relations)):
+        os.makedirs(os.path.expanduser(os.path.join(gnn_dir, state)), exist_ok=True)
+        ways.to_csv(os.path.join(gnn_dir, f"{state}/WAYS.csv"), index=False)
+        nodes.to_csv(os.path.join(gnn_dir, f"{state}/NODES.csv"), index=False)
+        relations.to_csv(os.path.join(gnn_dir, f"{state}/RELATIONS.csv"), index=False)
+
+def downstream(map_dir, gnn_dir, state, run, queries = 100):
+    ways = load_ways(gnn_dir, state)
+    nodes = load_nodes(gnn_dir, state)
+    relations = load_relations(gnn_dir, state)
+
+    with run.stage('joints', rows=len(nodes)):
+        joints = build_joints(ways, nodes, relations)
+
+    crashes = pd.read_csv(os.path.join(map_dir, f"{state}/CRASHES.csv"))
+    with run.stage('crash_labels', rows=len(crashes)):
+        labels = build_crash_labels(crashes, ways, 'month')
+
+    aadts = pd.read_csv(os.path.join(map_dir, f"{state}/AADTS.csv"))
+    with run.stage('aadt', rows=len(ways)):
+        store = build_aadt_store(aadts, ways)
+        propagate(way_connectivity(ways, nodes), store.aadt, store.valid)
+
+    counts = np.asarray(labels.matrix.sum(axis=1)).ravel()
+    with run.stage('routing', rows=queries):
+        router = Router(routing_graph(ways, joints, counts / max(counts.max(), 1)), landmarks=8)
+        rng = np.random.default_rng(0)
+        for from_way, to_way in rng.integers(1, len(ways), (queries, 2)):
+            route_ways(router, from_way, to_way)
+
+    with run.stage('sampler', rows=len(ways)):
+        sampler = build_sampler(ways, nodes, counts + 1)
+        for batch, seeds in enumerate(np.array_split(np.arange(1, len(ways)), max(len(ways) // 256, 1))):
+            sampler.sample(seeds, batch)
+
+def benchmark(sizes = SIZES, work_dir = bench_dir, seed = 0, graph = True):
+    '''
+    run every stage at every size; graph False skips the WayGraph build and reuses CSVs of a previous run
+    '''
+    work_dir = os.path.expanduser(work_dir)
+    results = {}
+    for size in sizes:
+        state = f'S{size}'
+        map_dir = os.path.join(work_dir, 'map')
+        gnn_dir = os.path.join(work_dir, 'gnn')
+
+        run = Run(f'benchmark_{state}', quiet=True)
+        with run.stage('generate', rows=size * size):
+            generate(os.path.join(map_dir, state), size, crashes=size * size * 10, aadts=size * 4, seed=seed)
+        if graph:
+            build_graph(map_dir, gnn_dir, state, run)
+        downstream(map_dir, gnn_dir, state, run)
+
+        results[str(size)] = run.report()
+        for stage in results[str(size)]['stages']:
+            print(f"size {size:4d} {stage['stage']:>14}: {stage['wall_s']:8.3f}s {stage['rows_per_sec'] or 0:12.1f} rows/s")
+    return results
+
+def regressions(results, baseline, tolerance = 0.25, min_wall = 0.05):
+    '''
+    (size, stage, rows/sec, baseline rows/sec) of stages slower than the baseline by more than tolerance,
+    stages shorter than min_wall seconds in the baseline are too noisy to compare
+    '''
+    slower = []
+    for size, report in results.items():
+        if size not in baseline:
+            continue
+
+        expected = {stage['stage']: stage['rows_per_sec'] for stage in baseline[size]['stages']
+                    if stage['wall_s'] >= min_wall}
+        for stage in report['stages']:
+            base = expected.get(stage['stage'])
+            if base and stage['rows_per_sec'] is not None and stage['rows_per_sec'] < base * (1 - tolerance):
+                slower.append((size, stage['stage'], stage['rows_per_sec'], base))
+    return slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='end to end benchmark on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--baseline', default=os.path.join(bench_dir, 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--skip-graph', action='store_true', help='skip the WayGraph build, reuse its CSVs')
+    args = parser.parse_args()
+
+    results = benchmark(args.sizes, graph=not args.skip_graph)
+    baseline_path = os.path.expanduser(args.baseline)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"saved baseline {baseline_path}")
+        sys.exit(0)
+
+    if not os.path.exists(baseline_path):
+        print(f"no baseline at {baseline_path}, run with --save-baseline first")
+        sys.exit(0)
+
+    with open(baseline_path) as file:
+        slower = regressions(results, json.load(file), args.tolerance)
+    for size, stage, rate, base in slower:
+        print(f"REGRESSION size {size} {stage}: {rate:.1f} rows/s, baseline {base:.1f} rows/s")
+    sys.exit(1 if slower else 0)
@@ -0,0 +1,350 @@
+import os
+import numpy as np
+import pandas as pd
+import polyline
+import scipy.sparse as sp
+
+from graph_arrays import load_ways, load_nodes, load_relations, graph_frames, node_ways
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+contraction of chains of ways through degree 2 nodes into single ways
+
+a node is contracted when it joins exactly two different ways, is no via_node of a relation and the
+two ways have the same KEYS walked in the direction of the chain (a way walked backward swaps its
+forward/backward columns and oneway 1/2)
+
+a contracted way, with the columns of WAYS.csv:
+    way_id, key columns, start_bearing, from_node: of the first way of the chain
+    end_bearing, to_node: of the last way
+    length: sum; urban: max; bipesz: bitwise or
+    curve_left, curve_right, slope_up, slope_down: length weighted mean of the magnitudes, negative
+        if any way of the chain is derived
+    polyline: the polylines of the chain joined
+nodes keep their order without the contracted ones, relations get the contracted way and node indexes
+
+Contraction maps both ways:
+    way_map: int64 [way] contracted way index, way 0 stays 0
+    way_sign: int64 [way] 1 if the way runs along its contracted way, -1 if against it
+    way_offset: float64 [way] metres from the start of the contracted way to the start of the way
+                along the contracted way
+    indptr: int64 [contracted way + 1], members: int64 [way] signed ways of every contracted way in order
+    node_map: int64 [node] contracted node index, -1 if contracted
+
+{gnn_dir}/{state}/CONTRACTED: WAYS.csv, NODES.csv, RELATIONS.csv, POLYLINES.csv and contraction.npz,
+loaded as any other state with state f"{state}/CONTRACTED"
+"""
+
+KEYS = ['road_class', 'road_type', 'oneway', 'divider', 'lane_count', 'forward_lane_count', 'backward_lane_count',
+        'forward_speed', 'backward_speed']
+WEIGHTED = ['curve_left', 'curve_right', 'slope_up', 'slope_down']
+# columns read the other way round when a way is walked backward
+SWAPPED = {'forward_lane_count': 'backward_lane_count', 'backward_lane_count': 'forward_lane_count',
+           'forward_speed': 'backward_speed', 'backward_speed': 'forward_speed',
+           'curve_left': 'curve_right', 'curve_right': 'curve_left',
+           'slope_up': 'slope_down', 'slope_down': 'slope_up'}
+
+class Contraction:
+
+    def __init__(self, way_map, way_sign, way_offset, indptr, members, node_map, length):
+        '''
+        length: float64 [way] lengths of the full ways
+        '''
+        self.way_map = way_map
+        self.way_sign = way_sign
+        self.way_offset = way_offset
+        self.indptr = indptr
+        self.members = members
+        self.node_map = node_map
+        self.length = length
+
+        n = len(indptr) - 1
+        self.contracted_length = np.bincount(way_map, weights=length, minlength=n)
+        self.matrix = sp.csr_matrix((np.ones(len(way_map)), (way_map, np.arange(len(way_map)))),
+                                    shape=(n, len(way_map)))
+
+    @property
+    def n_ways(self):
+        return len(self.indptr) - 1
+
+    def chain(self, contracted_way):
+        '''
+        signed full ways of a contracted way, in its direction
+        '''
+        return self.members[self.indptr[contracted_way]:self.indptr[contracted_way + 1]]
+
+    def signed(self, ways):
+        '''
+        signed contracted ways of signed full ways, e.g. dirways of routes or joints
+        '''
+        ways = np.asarray(ways)
+        return np.sign(ways) * self.way_sign[np.abs(ways)] * self.way_map[np.abs(ways)]
+
+    def to_contracted(self, values, reduce = 'sum'):
+        '''
+        values [way, ...] (dense or sparse, e.g. crash label counts) to [contracted way, ...];
+        reduce: 'sum' for counts, 'mean' for the length weighted mean, e.g. rates or predictions
+        '''
+        if reduce == 'sum':
+            return self.matrix @ values
+        if reduce == 'mean':
+            weighted = self.matrix @ sp.diags(self.length)
+            total = np.maximum(self.contracted_length, 1e-9)
+            if sp.issparse(values):
+                return sp.diags(1 / total) @ (weighted @ values)
+            return (weighted @ values) / total.reshape((-1,) + (1,) * (np.ndim(values) - 1))
+        raise ValueError(f"unknown reduce {reduce}")
+
+    def to_full(self, values, split = False):
+        '''
+        values [contracted way, ...] to [way, ...]; split shares counts by length instead of repeating them
+        '''
+        if not split:
+            return values[self.way_map]
+
+        share = self.length / np.maximum(self.contracted_length[self.way_map], 1e-9)
+        if sp.issparse(values):
+            return sp.diags(share) @ values.tocsr()[self.way_map]
+        return values[self.way_map] * share.reshape((-1,) + (1,) * (np.ndim(values) - 1))
+
+    def save(self, path):
+        np.savez(os.path.expanduser(path), way_map=self.way_map, way_sign=self.way_sign, way_offset=self.way_offset,
+                 indptr=self.indptr, members=self.members, node_map=self.node_map, length=self.length)
+
+def load_contraction(path):
+    with np.load(os.path.expanduser(path)) as arrays:
+        return Contraction(arrays['way_map'], arrays['way_sign'], arrays['way_offset'], arrays['indptr'],
+                           arrays['members'], arrays['node_map'], arrays['length'])
+
+def contract(ways, nodes, relations = None, polylines = None):
+    '''
+    ways, nodes, relations: DataFrames of WAYS.csv, NODES.csv and RELATIONS.csv; polylines: the
+    'polyline' column by way index, optional
+    returns contracted (ways, nodes, relations, polylines) and the Contraction
+    '''
+    n_ways = len(ways)
+    indptr, signed = node_ways(nodes)
+    link = _links(ways, indptr, signed, relations)
+    chain_indptr, members, cuts = _chains(n_ways, link)
+
+    chains = np.repeat(np.arange(len(chain_indptr) - 1), np.diff(chain_indptr))
+    member_ways = np.abs(members)
+    member_signs = np.sign(members) + (members == 0)
+    length = ways['length'].to_numpy(dtype=np.float64)
+
+    way_map = np.zeros(n_ways, dtype=np.int64)
+    way_map[member_ways] = chains
+    way_sign = np.ones(n_ways, dtype=np.int64)
+    way_sign[member_ways] = member_signs
+    before = np.cumsum(length[member_ways]) - length[member_ways]
+    way_offset = np.zeros(n_ways)
+    way_offset[member_ways] = before - before[chain_indptr[:-1]][chains]
+
+    node_map = np.full(len(nodes), -1, dtype=np.int64)
+    kept = np.ones(len(nodes), dtype=bool)
+    kept[link['nodes']] = False
+    kept[ways['from_node'].to_numpy()[cuts]] = True
+    node_map[kept] = np.arange(kept.sum())
+
+    contraction = Contraction(way_map, way_sign, way_offset, chain_indptr, members, node_map, length)
+    contracted_ways = _contracted_ways(ways, contraction, chains, member_ways, member_signs)
+    contracted_nodes = _contracted_nodes(nodes, indptr, signed, kept, contraction)
+
+    contracted_relations = None
+    if relations is not None:
+        contracted_relations = relations.copy()
+        contracted_relations['from_way'] = way_map[relations['from_way'].to_numpy(dtype=np.int64)]
+        contracted_relations['to_way'] = way_map[relations['to_way'].to_numpy(dtype=np.int64)]
+        via_node = relations['via_node'].to_numpy(dtype=np.int64)
+        contracted_relations['via_node'] = np.where(via_node >= 0, node_map[via_node], via_node)
+
+    contracted_polylines = None
+    if polylines is not None:
+        contracted_polylines = pd.DataFrame({'polyline': [_join_polylines(polylines, contraction.chain(way))
+                                                          for way in range(contraction.n_ways)]})
+
+    return contracted_ways, contracted_nodes, contracted_relations, contracted_polylines, contraction
+
+def contract_graph(graph):
+    '''
+    contract an in-memory WayGraph after complete()
+    '''
+    ways, nodes = graph_frames(graph)
+    relations = pd.DataFrame(graph.relations, columns=['type', 'value', 'from_way', 'via_node', 'to_way'])
+    polylines = ways['polyline'] if 'polyline' in ways else None
+    ways = ways.drop(columns=['polyline'], errors='ignore')
+    ways = ways.fillna({column: -1 for column in ['from_node', 'to_node']}).fillna(0)
+    return contract(ways, nodes, relations, polylines)
+
+def _oriented(ways, columns, backward):
+    '''
+    [way, column] values of ways walked forward, or backward where backward is True
+    '''
+    forward = ways[columns].to_numpy(dtype=np.float64)
+    reverse = ways[[SWAPPED.get(column, column) for column in columns]].to_numpy(dtype=np.float64, copy=True)
+    if 'oneway' in columns:
+        oneway = columns.index('oneway')
+        reverse[:, oneway] = np.array([0, 2, 1])[forward[:, oneway].astype(np.int64)]
+    return np.where(np.asarray(backward)[:, None], reverse, forward)
+
+def _links(ways, indptr, signed, relations):
+    '''
+    link: {'nodes': contracted nodes, 'end': int64 [2 * way + end] the way end joined at the other side of
+    a contracted node, -1 if none}; end 0 is from_node, 1 is to_node
+    '''
+    degree = np.diff(indptr)
+    candidates = np.flatnonzero(degree == 2)
+    if relations is not None and len(relations):
+        candidates = np.setdiff1d(candidates, relations['via_node'].to_numpy(dtype=np.int64))
+
+    first = signed[indptr[candidates]]
+    second = signed[indptr[candidates] + 1]
+    candidates = candidates[np.abs(first) != np.abs(second)]
+    first = signed[indptr[candidates]]
+    second = signed[indptr[candidates] + 1]
+
+    # walking first into the node and second out of it: first backward if the node is its from_node,
+    # second backward if the node is its to_node
+    keys = _oriented(ways, KEYS, np.zeros(len(ways), dtype=bool))
+    reverse = _oriented(ways, KEYS, np.ones(len(ways), dtype=bool))
+    into = np.where((first > 0)[:, None], reverse[np.abs(first)], keys[np.abs(first)])
+    out = np.where((second < 0)[:, None], reverse[np.abs(second)], keys[np.abs(second)])
+    same = (into == out).all(axis=1)
+
+    candidates, first, second = candidates[same], first[same], second[same]
+    first_end = 2 * np.abs(first) + (first < 0)
+    second_end = 2 * np.abs(second) + (second < 0)
+
+    end = np.full(2 * len(ways), -1, dtype=np.int64)
+    end[first_end] = second_end
+    end[second_end] = first_end
+    return {'nodes': candidates, 'end': end}
+
+def _chains(n_ways, link):
+    '''
+    CSR of the chains: indptr [chain + 1], members [way] signed ways in walking order; chains are
+    ordered by their smallest way, so way 0 stays chain 0; cuts: the first ways of cycles, their
+    from_node stays
+    '''
+    end = link['end'].tolist()
+    visited = [False] * n_ways
+    chains = []
+
+    def walk(way, sign):
+        chain = []
+        start = way
+        while True:
+            visited[way] = True
+            chain.append(way * sign if way else 0)
+            other = end[2 * way + (sign > 0)]
+            if other < 0 or other // 2 == start:
+                return chain
+            way = other // 2
+            sign = 1 if other % 2 == 0 else -1
+
+    # chains from a free end first, the ways left are in cycles, cut at their smallest way
+    for way in range(n_ways):
+        if not visited[way] and (end[2 * way] < 0 or end[2 * way + 1] < 0):
+            chains.append(walk(way, 1 if end[2 * way] < 0 else -1))
+    cuts = []
+    for way in range(n_ways):
+        if not visited[way]:
+            chains.append(walk(way, 1))
+            cuts.append(way)
+
+    chains.sort(key=lambda chain: min(abs(way) for way in chain))
+    indptr = np.zeros(len(chains) + 1, dtype=np.int64)
+    np.cumsum([len(chain) for chain in chains], out=indptr[1:])
+    members = np.fromiter((way for chain in chains for way in chain), dtype=np.int64, count=indptr[-1])
+    return indptr, members, np.array(cuts, dtype=np.int64)
+
+def _contracted_ways(ways, contraction, chains, member_ways, member_signs):
+    n = contraction.n_ways
+    first = contraction.indptr[:-1]
+    last = contraction.indptr[1:] - 1
+    backward = member_signs < 0
+
+    contracted = pd.DataFrame({'way_id': ways['way_id'].to_numpy()[member_ways[first]]})
+    contracted['length'] = np.bincount(chains, weights=ways['length'].to_numpy()[member_ways], minlength=n).round()
+
+    oriented = _oriented(ways.iloc[member_ways], KEYS, backward)
+    for i, column in enumerate(KEYS):
+        contracted[column] = oriented[first, i]
+
+    contracted['urban'] = np.maximum.reduceat(ways['urban'].to_numpy()[member_ways], first)
+    contracted['bipesz'] = np.bitwise_or.reduceat(ways['bipesz'].to_numpy().astype(np.int64)[member_ways], first)
+
+    start_bearing = ways['start_bearing'].to_numpy()[member_ways]
+    end_bearing = ways['end_bearing'].to_numpy()[member_ways]
+    # a way walked backward starts at its reversed end bearing, the sign (derived) is kept
+    start = np.where(backward, _reverse_bearing(end_bearing), start_bearing)
+    stop = np.where(backward, _reverse_bearing(start_bearing), end_bearing)
+    contracted['start_bearing'] = start[first]
+    contracted['end_bearing'] = stop[last]
+
+    length = ways['length'].to_numpy(dtype=np.float64)[member_ways]
+    weighted = _oriented(ways.iloc[member_ways], WEIGHTED, backward)
+    for i, column in enumerate(WEIGHTED):
+        magnitude = np.bincount(chains, weights=np.abs(weighted[:, i]) * length, minlength=n) / \
+            np.maximum(np.bincount(chains, weights=length, minlength=n), 1e-9)
+        derived = np.bincount(chains, weights=weighted[:, i] < 0, minlength=n) > 0
+        contracted[column] = np.where(derived, -magnitude, magnitude).round()
+
+    from_node = ways['from_node'].to_numpy()[member_ways]
+    to_node = ways['to_node'].to_numpy()[member_ways]
+    start_node = np.where(backward, to_node, from_node)[first]
+    end_node = np.where(backward, from_node, to_node)[last]
+    contracted['from_node'] = np.where(start_node >= 0, contraction.node_map[np.maximum(start_node, 0)], -1)
+    contracted['to_node'] = np.where(end_node >= 0, contraction.node_map[np.maximum(end_node, 0)], -1)
+
+    return contracted.astype(np.int64)
+
+def _contracted_nodes(nodes, indptr, signed, kept, contraction):
+    '''
+    kept nodes with their signed entries as contracted ways, positive where the node is the from_node
+    '''
+    way = np.abs(signed)
+    at_from = (signed > 0) == (contraction.way_sign[way] > 0)
+    entries = np.where(at_from, contraction.way_map[way], -contraction.way_map[way])
+
+    node_ids = nodes['node_id'].to_numpy()
+    stations = nodes['station'].to_numpy() if 'station' in nodes else np.zeros(len(nodes), dtype=np.int64)
+    kept = np.flatnonzero(kept)
+    return pd.DataFrame({'node_id': node_ids[kept], 'station': stations[kept],
+                         'ways': [entries[indptr[node]:indptr[node + 1]].tolist() for node in kept]})
+
+def _reverse_bearing(bearing):
+    return np.where(bearing < 0, -((-bearing + 180) % 360), (bearing + 180) % 360)
+
+def _join_polylines(polylines, chain):
+    points = []
+    for way in chain.tolist():
+        encoded = polylines.iloc[abs(way)]
+        if not isinstance(encoded, str):
+            continue
+        way_points = polyline.decode(encoded)
+        if way < 0:
+            way_points = way_points[::-1]
+        # the joint point is shared by both ways
+        points += way_points[1:] if points and way_points and points[-1] == way_points[0] else way_points
+    return polyline.encode(points) if points else None
+
+if __name__ == '__main__':
+    ways = load_ways(gnn_dir, state)
+    nodes = load_nodes(gnn_dir, state)
+    relations = load_relations(gnn_dir, state)
+    polylines = pd.read_csv(os.path.join(gnn_dir, f"{state}/POLYLINES.csv"))['polyline']
+
+    contracted_ways, contracted_nodes, contracted_relations, contracted_polylines, contraction = \
+        contract(ways, nodes, relations, polylines)
+
+    output_dir = os.path.expanduser(os.path.join(gnn_dir, f"{state}/CONTRACTED"))
+    os.makedirs(output_dir, exist_ok=True)
+    contracted_ways.to_csv(os.path.join(output_dir, "WAYS.csv"), index=False)
+    contracted_nodes.to_csv(os.path.join(output_dir, "NODES.csv"), index=False)
+    contracted_relations.to_csv(os.path.join(output_dir, "RELATIONS.csv"), index=False)
+    contracted_polylines.to_csv(os.path.join(output_dir, "POLYLINES.csv"), index=False)
+    contraction.save(os.path.join(output_dir, "contraction.npz"))
+    print(f"contracted {len(ways)} ways to {len(contracted_ways)}, {len(nodes)} nodes to {len(contracted_nodes)}")
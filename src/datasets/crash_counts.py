@@ -0,0 +1,202 @@
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from crash_labels import SEVERITIES, CrashLabels, crash_events, time_bins
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+per way and month crash counts kept up to date by deltas, for crash drops appended to CRASHES.csv
+
+{gnn_dir}/{state}/CRASH_COUNTS:
+    counts.json         start month, number of ways, next delta sequence
+    base.npz            compacted counts and crash ids
+    delta_{seq:06d}.npz counts and crash ids of one appended drop
+    an npz: way int64 [entry], column int64 [entry] (month * 3 + severity - 1 as crash_labels.py),
+            count int32 [entry], ids int64 [crash] crash_id (OBJECTID) of every crash applied, sorted
+    {part}_ids.npy      the ids of base or a delta again, memory mapped; an append checks its crashes with a
+                        binary search in each, without reading them all
+
+the counts are base + all deltas; compact() folds the deltas into base, so an append costs its own
+crashes (times the log of all crashes and the parts) and a read costs the base plus the deltas since
+the last compaction
+"""
+
+START = '2000-01-01'
+MAX_DELTAS = 32
+
+class CrashCounts:
+
+    def __init__(self, root, n_ways = None, start = START):
+        self.root = os.path.expanduser(root)
+        meta_path = os.path.join(self.root, 'counts.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as file:
+                self.meta = json.load(file)
+        else:
+            self.meta = {'start': str(pd.Timestamp(start).to_period('M').start_time.date()), 'n_ways': n_ways, 'next': 0}
+
+        self.start = pd.Timestamp(self.meta['start'])
+        self.__ids__ = None
+
+    @property
+    def n_ways(self):
+        return self.meta['n_ways']
+
+    def seen(self, crash_ids):
+        '''
+        bool [crash] if the crash id was already applied
+        '''
+        crash_ids = np.asarray(crash_ids, dtype=np.int64)
+        seen = np.zeros(len(crash_ids), dtype=bool)
+        for ids in self.__id_parts__():
+            if len(ids):
+                position = np.minimum(np.searchsorted(ids, crash_ids), len(ids) - 1)
+                seen |= np.asarray(ids[position]) == crash_ids
+        return seen
+
+    def append(self, crashes, ways):
+        '''
+        apply crashes (rows of CRASHES.csv) not applied before as a delta; returns the number applied
+        '''
+        if self.n_ways is None:
+            self.meta['n_ways'] = len(ways)
+        if len(ways) != self.n_ways:
+            raise ValueError(f"counts of {self.n_ways} ways, not {len(ways)}")
+
+        crashes = crashes[~self.seen(crashes['crash_id'].to_numpy())]
+        if len(crashes) == 0:
+            return 0
+
+        way, column, count = self.__count__(crash_events(crashes, ways))
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, f"delta_{self.meta['next']:06d}.npz")
+        _save_part(path, way, column, count, crashes['crash_id'].to_numpy())
+
+        self.meta['next'] += 1
+        self.__save_meta__()
+        self.__ids__ = self.__id_parts__() + [_load_ids(path)]
+
+        if len(self.__delta_paths__()) > MAX_DELTAS:
+            self.compact()
+        return len(crashes)
+
+    def rebuild(self, crashes, ways):
+        '''
+        drop all counts and count crashes as the new base
+        '''
+        for path in self.__delta_paths__() + [os.path.join(self.root, 'base.npz')]:
+            for file in [path, _ids_path(path)]:
+                if os.path.exists(file):
+                    os.remove(file)
+        self.meta['n_ways'] = len(ways)
+        self.__save_meta__()
+        self.__ids__ = None
+        self.append(crashes, ways)
+        self.compact()
+
+    def matrix(self, parts = None):
+        '''
+        csr [way, month * 3 + severity - 1] of base and deltas
+        '''
+        parts = self.__parts__() if parts is None else parts
+        way = np.concatenate([np.zeros(0, dtype=np.int64)] + [part['way'] for part in parts])
+        column = np.concatenate([np.zeros(0, dtype=np.int64)] + [part['column'] for part in parts])
+        count = np.concatenate([np.zeros(0, dtype=np.int32)] + [part['count'] for part in parts])
+
+        n_bins = int(column.max()) // SEVERITIES + 1 if len(column) else 0
+        matrix = sp.csr_matrix((count, (way, column)), shape=(self.n_ways or 0, n_bins * SEVERITIES))
+        matrix.sum_duplicates()
+        return matrix
+
+    def labels(self):
+        matrix = self.matrix()
+        return CrashLabels(matrix, 'month', matrix.shape[1] // SEVERITIES, self.start)
+
+    def compact(self):
+        '''
+        fold the deltas into base.npz, written before the deltas are removed
+        '''
+        deltas = self.__delta_paths__()
+        if not deltas:
+            return
+
+        coo = self.matrix().tocoo()
+        ids = np.concatenate([np.asarray(ids) for ids in self.__id_parts__()])
+        path = os.path.join(self.root, 'base.npz')
+        _save_part(path, coo.row.astype(np.int64), coo.col.astype(np.int64), coo.data.astype(np.int32), ids)
+        self.__ids__ = None
+        for delta in deltas:
+            os.remove(delta)
+            os.remove(_ids_path(delta))
+
+    def __count__(self, events):
+        bins, _ = time_bins(events['time'], 'month', self.start)
+        keep = bins >= 0
+        column = bins[keep] * SEVERITIES + events['severity'].to_numpy()[keep] - 1
+        way = events['way'].to_numpy()[keep]
+
+        pairs, count = np.unique(np.stack([way, column]), axis=1, return_counts=True)
+        return pairs[0].astype(np.int64), pairs[1].astype(np.int64), count.astype(np.int32)
+
+    def __id_parts__(self):
+        if self.__ids__ is None:
+            self.__ids__ = [_load_ids(path) for path in [os.path.join(self.root, 'base.npz')] + self.__delta_paths__()
+                            if os.path.exists(path)]
+        return self.__ids__
+
+    def __delta_paths__(self):
+        return sorted(glob.glob(os.path.join(self.root, 'delta_*.npz')))
+
+    def __parts__(self):
+        paths = [os.path.join(self.root, 'base.npz')] + self.__delta_paths__()
+        parts = []
+        for path in paths:
+            if os.path.exists(path):
+                with np.load(path) as part:
+                    parts.append({name: part[name] for name in part.files})
+        return parts
+
+    def __save_meta__(self):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, 'counts.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self.meta, file)
+        os.replace(path + '.tmp', path)
+
+def _save_part(path, way, column, count, ids):
+    # written whole then renamed, a crash never leaves a half delta to be read; the sorted ids file
+    # after it is a copy of its ids, made again from the npz when missing
+    ids = np.sort(np.asarray(ids, dtype=np.int64))
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(file, way=way, column=column, count=count, ids=ids)
+    os.replace(path + '.tmp', path)
+    _save_ids(path, ids)
+
+def _ids_path(path):
+    return path[:-len('.npz')] + '_ids.npy'
+
+def _save_ids(path, ids):
+    with open(_ids_path(path) + '.tmp', 'wb') as file:
+        np.save(file, ids)
+    os.replace(_ids_path(path) + '.tmp', _ids_path(path))
+
+def _load_ids(path):
+    '''
+    sorted crash ids of a part, memory mapped
+    '''
+    if not os.path.exists(_ids_path(path)):
+        with np.load(path) as part:
+            _save_ids(path, np.sort(part['ids']))
+    return np.load(_ids_path(path), mmap_mode='r')
+
+if __name__ == '__main__':
+    counts = CrashCounts(os.path.join(gnn_dir, f"{state}/CRASH_COUNTS"))
+    counts.compact()
+    matrix = counts.matrix()
+    print(f"{matrix.sum()} crash events in {matrix.shape[1] // SEVERITIES} months of {matrix.shape[0]} ways")
@@ -0,0 +1,147 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+crash labels: counts of crash events per (way, time bin, severity) as a sparse CSR matrix
+    rows: way index of WAYS.csv
+    columns: time_bin * 3 + severity - 1, severity 1 property damage, 2 injury, 3 fatal
+
+time bins:
+    hour_of_week: 0-167, Monday 0:00 is 0
+    month: months since the first month, e.g. 2016-01
+    hour: hours since the first hour
+    year: years since the first year
+
+an event is a vehicle of a crash matched to a way (v1_way, v2_way), a crash with both vehicles
+on the same way counts once for it
+"""
+
+SEVERITIES = 3
+
+def crash_events(crashes, ways):
+    '''
+    one event per matched vehicle way of CRASHES.csv: way index, local time, severity
+    '''
+    time = pd.to_datetime(crashes['crash_date'] + ' ' + crashes['crash_time'], errors='coerce')
+    vehicles = [column for column in ['v1_way', 'v2_way'] if column in crashes]
+
+    # one lookup for the way ids of all vehicles
+    ids = pd.concat([crashes[column] for column in vehicles]).fillna(0).astype(np.int64).to_numpy()
+    index = pd.Index(ways['way_id']).get_indexer(ids)
+    crash = np.tile(np.arange(len(crashes)), len(vehicles))
+
+    events = pd.DataFrame({'crash': crash, 'way': index})
+    events = events[(events['way'] > 0) & time.notna().to_numpy()[crash]].drop_duplicates()
+    events['time'] = time.to_numpy()[events['crash'].to_numpy()]
+    events['severity'] = crashes['crash_severity'].to_numpy()[events['crash'].to_numpy()]
+    return events.drop(columns='crash').reset_index(drop=True)
+
+def time_bins(times, unit, start = None):
+    '''
+    time bin of every time and the number of bins, start is the first time of the month/hour/year bins
+    '''
+    times = pd.DatetimeIndex(times)
+    if unit == 'hour_of_week':
+        return (times.dayofweek * 24 + times.hour).to_numpy(), 168
+
+    start = pd.Timestamp(start) if start is not None else times.min()
+    if unit == 'month':
+        bins = (times.year - start.year) * 12 + times.month - start.month
+    elif unit == 'year':
+        bins = times.year - start.year
+    elif unit == 'hour':
+        bins = (times - start.floor('h')) // pd.Timedelta(hours=1)
+    else:
+        raise ValueError(f"unknown time bin {unit}")
+
+    bins = np.asarray(bins, dtype=np.int64)
+    return bins, int(bins.max()) + 1 if len(bins) else 0
+
+class CrashLabels:
+
+    def __init__(self, matrix, unit, n_bins, start = None):
+        self.matrix = matrix
+        self.unit = unit
+        self.n_bins = n_bins
+        self.start = start
+
+    def ways(self, way_indexes):
+        '''
+        labels of some ways, e.g. a split, rows in the order given
+        '''
+        return CrashLabels(self.matrix[way_indexes], self.unit, self.n_bins, self.start)
+
+    def bins(self, first, last):
+        '''
+        labels of time bins [first, last), e.g. a temporal split, still sparse
+        '''
+        return CrashLabels(self.matrix[:, first * SEVERITIES:last * SEVERITIES].tocsr(), self.unit,
+                           last - first, self.start)
+
+    def by_severity(self):
+        '''
+        int32 [way, severity] over all time bins
+        '''
+        columns = np.arange(self.matrix.shape[1]) % SEVERITIES
+        selector = sp.csr_matrix((np.ones(len(columns), dtype=np.int32), (np.arange(len(columns)), columns)),
+                                 shape=(len(columns), SEVERITIES))
+        return np.asarray((self.matrix @ selector).todense(), dtype=np.int32)
+
+    def by_bin(self, severities = (1, 2, 3)):
+        '''
+        sparse [way, time bin] of the given severities
+        '''
+        columns = np.arange(self.matrix.shape[1])
+        keep = np.isin(columns % SEVERITIES + 1, severities)
+        selector = sp.csr_matrix((np.ones(keep.sum(), dtype=np.int32), (columns[keep], columns[keep] // SEVERITIES)),
+                                 shape=(len(columns), self.n_bins))
+        return (self.matrix @ selector).tocsr()
+
+    def save(self, path):
+        path = os.path.expanduser(path)
+        sp.save_npz(path + '.npz', self.matrix)
+        with open(path + '.json', 'w') as file:
+            json.dump({'unit': self.unit, 'n_bins': self.n_bins,
+                       'start': str(self.start) if self.start is not None else None}, file)
+
+def load_crash_labels(path):
+    path = os.path.expanduser(path)
+    with open(path + '.json') as file:
+        meta = json.load(file)
+
+    start = pd.Timestamp(meta['start']) if meta['start'] is not None else None
+    return CrashLabels(sp.load_npz(path + '.npz').tocsr(), meta['unit'], meta['n_bins'], start)
+
+def build_crash_labels(crashes, ways, unit = 'month', start = None, events = None):
+    '''
+    crashes, ways: DataFrames of CRASHES.csv and WAYS.csv
+    '''
+    if events is None:
+        events = crash_events(crashes, ways)
+
+    if unit != 'hour_of_week' and start is None and len(events):
+        start = events['time'].min().to_period({'month': 'M', 'year': 'Y', 'hour': 'h'}[unit]).start_time
+    bins, n_bins = time_bins(events['time'], unit, start)
+
+    keep = bins >= 0
+    columns = bins[keep] * SEVERITIES + events['severity'].to_numpy()[keep] - 1
+    matrix = sp.csr_matrix((np.ones(keep.sum(), dtype=np.int32), (events['way'].to_numpy()[keep], columns)),
+                           shape=(len(ways), n_bins * SEVERITIES))
+    matrix.sum_duplicates()
+
+    return CrashLabels(matrix, unit, n_bins, start if unit != 'hour_of_week' else None)
+
+if __name__ == '__main__':
+    ways = pd.read_csv(os.path.join(gnn_dir, f"{state}/WAYS.csv"), usecols=['way_id'])
+    crashes = pd.read_csv(os.path.join(gnn_dir, f"{state}/CRASHES.csv"))
+
+    for unit in ['month', 'hour_of_week']:
+        labels = build_crash_labels(crashes, ways, unit)
+        labels.save(os.path.join(gnn_dir, f"{state}/LABELS_{unit.upper()}"))
+        print(f"{labels.matrix.sum()} crash events in {labels.n_bins} {unit} bins of {len(ways)} ways")
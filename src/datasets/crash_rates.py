@@ -0,0 +1,165 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from aadt_store import load_aadt_store
+from crash_counts import CrashCounts
+from crash_labels import SEVERITIES, build_crash_labels
+from graph_arrays import load_ways
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+crash rates per (way, year) normalized by exposure, with empirical Bayes shrinkage to group priors
+
+exposure [way, year]: million vehicle miles, aadt * length / 1609.344 * days of the year / 1e6
+    aadt of the year from the AadtStore (aadt_store.py), the propagated estimate when there is one;
+    a year without aadt takes the latest earlier year of the way, else its earliest later year
+crashes [way, year]: crash events of crash_labels.py (a vehicle way of a crash), monthly or yearly labels
+
+empirical Bayes (negative binomial, method of moments) over the exposed cells of a group, e.g. road_class:
+    prior rate r = crashes / exposure of the group, expected mu = r * exposure of a cell
+    overdispersion 1/k = max(sum((crashes - mu)^2 - mu) / sum(mu^2), 0)
+    weight w = 1 / (1 + mu / k), eb_rate = (w * mu + (1 - w) * crashes) / exposure
+a cell with few expected crashes stays near the prior, a cell with many keeps its own rate
+
+{gnn_dir}/{state}/RATES.csv: a row per exposed (way, year), unexposed cells are left out
+    way, year, aadt, aadt_year, exposure, crashes, rate, eb_weight, eb_rate (rates in crashes per million vehicle miles)
+{gnn_dir}/{state}/RATE_PRIORS.csv: a row per group
+    road_class, cells, exposure, crashes, rate, overdispersion (1/k)
+"""
+
+METRES_PER_MILE = 1609.344
+
+def year_days(years):
+    return np.array([366 if pd.Timestamp(int(year), 1, 1).is_leap_year else 365 for year in years], dtype=np.float64)
+
+def year_aadt(store, years, estimated = True):
+    '''
+    (aadt [way, year], aadt_year [way, year]) of the requested years, aadt_year -1 for a way without aadt
+    '''
+    if estimated and store.estimate is not None:
+        aadt, valid = np.asarray(store.estimate), np.asarray(store.confidence) > 0
+    else:
+        aadt, valid = np.asarray(store.aadt), np.asarray(store.valid)
+    n_ways, n_years = aadt.shape
+
+    columns = np.arange(n_years)
+    earlier = np.maximum.accumulate(np.where(valid, columns, -1), axis=1)
+    later = np.minimum.accumulate(np.where(valid, columns, n_years)[:, ::-1], axis=1)[:, ::-1]
+
+    wanted = np.clip(np.asarray(years) - store.years[0], 0, n_years - 1)
+    source = np.where(earlier[:, wanted] >= 0, earlier[:, wanted], later[:, wanted])
+    found = source < n_years
+    source = np.where(found, source, 0)
+
+    rows = np.arange(n_ways)[:, None]
+    return (np.where(found, aadt[rows, source], 0).astype(np.float64),
+            np.where(found, store.years[source], -1).astype(np.int64))
+
+def exposure(store, ways, years, estimated = True):
+    '''
+    (million vehicle miles [way, year], aadt [way, year], aadt_year [way, year])
+    '''
+    aadt, aadt_year = year_aadt(store, years, estimated)
+    miles = ways['length'].to_numpy(dtype=np.float64) / METRES_PER_MILE
+    return aadt * miles[:, None] * year_days(years)[None, :] / 1e6, aadt, aadt_year
+
+def yearly_crashes(labels, years, severities = (1, 2, 3)):
+    '''
+    csr int32 [way, year] of crash events in the requested years, labels by month or by year
+    '''
+    if labels.unit not in ('month', 'year'):
+        raise ValueError(f"crash labels by {labels.unit}, month or year needed")
+
+    counts = labels.by_bin(severities)
+    bins = np.arange(labels.n_bins)
+    if labels.unit == 'month':
+        bin_years = labels.start.year + (labels.start.month - 1 + bins) // 12
+    else:
+        bin_years = labels.start.year + bins
+
+    column = np.searchsorted(years, bin_years)
+    keep = (column < len(years)) & (np.asarray(years)[np.minimum(column, len(years) - 1)] == bin_years)
+    selector = sp.csr_matrix((np.ones(keep.sum(), dtype=np.int32), (bins[keep], column[keep])),
+                             shape=(labels.n_bins, len(years)))
+    return (counts @ selector).tocsr()
+
+def label_years(labels):
+    '''
+    the years from the first with a crash event to the last of monthly or yearly labels
+    '''
+    bins = np.flatnonzero(np.asarray(labels.matrix.sum(axis=0)).ravel()) // SEVERITIES
+    if len(bins) == 0:
+        return []
+    if labels.unit == 'month':
+        first, last = (labels.start.month - 1 + bins[0]) // 12, (labels.start.month - 1 + labels.n_bins - 1) // 12
+    else:
+        first, last = bins[0], labels.n_bins - 1
+    return list(range(labels.start.year + int(first), labels.start.year + int(last) + 1))
+
+def eb_shrink(crashes, exposure, group):
+    '''
+    crashes, exposure, group: [cell] of exposed cells; (eb_weight [cell], eb_rate [cell], priors DataFrame by group)
+    '''
+    groups, code = np.unique(group, return_inverse=True)
+    group_crashes = np.bincount(code, weights=crashes, minlength=len(groups))
+    group_exposure = np.bincount(code, weights=exposure, minlength=len(groups))
+    prior = group_crashes / np.maximum(group_exposure, 1e-12)
+
+    mu = prior[code] * exposure
+    excess = np.bincount(code, weights=(crashes - mu) ** 2 - mu, minlength=len(groups))
+    moment = np.bincount(code, weights=mu * mu, minlength=len(groups))
+    overdispersion = np.where(moment > 0, np.maximum(excess, 0) / np.maximum(moment, 1e-12), 0.0)
+
+    weight = 1 / (1 + mu * overdispersion[code])
+    eb_rate = (weight * mu + (1 - weight) * crashes) / exposure
+
+    priors = pd.DataFrame({'cells': np.bincount(code, minlength=len(groups)), 'exposure': group_exposure,
+                           'crashes': group_crashes.astype(np.int64), 'rate': prior,
+                           'overdispersion': overdispersion}, index=pd.Index(groups))
+    return weight, eb_rate, priors
+
+def crash_rates(ways, store, labels, years = None, severities = (1, 2, 3), shrink = True, group = 'road_class',
+                estimated = True):
+    '''
+    (RATES rows, RATE_PRIORS rows, see the layout above); ways: DataFrame of WAYS.csv with length and the
+    group column; years: label_years by default
+    '''
+    years = np.asarray(label_years(labels) if years is None else years, dtype=np.int64)
+
+    vmt, aadt, aadt_year = exposure(store, ways, years, estimated)
+    counts = yearly_crashes(labels, years, severities)
+
+    way, column = np.nonzero(vmt > 0)
+    cell_exposure = vmt[way, column]
+    cell_crashes = np.asarray(counts[way, column], dtype=np.float64).ravel()
+
+    rates = pd.DataFrame({'way': way, 'year': years[column], 'aadt': np.round(aadt[way, column]).astype(np.int64),
+                          'aadt_year': aadt_year[way, column], 'exposure': cell_exposure,
+                          'crashes': cell_crashes.astype(np.int64), 'rate': cell_crashes / cell_exposure})
+
+    weight, eb_rate, priors = eb_shrink(cell_crashes, cell_exposure, ways[group].to_numpy()[way])
+    if shrink:
+        rates['eb_weight'] = weight
+        rates['eb_rate'] = eb_rate
+    priors = priors.rename_axis(group).reset_index()
+    return rates, priors
+
+if __name__ == '__main__':
+    ways = load_ways(gnn_dir, state, ['way_id', 'length', 'road_class'])
+    store = load_aadt_store(os.path.join(gnn_dir, f"{state}/AADT"))
+
+    counts_dir = os.path.join(gnn_dir, f"{state}/CRASH_COUNTS")
+    if os.path.exists(os.path.expanduser(os.path.join(counts_dir, 'counts.json'))):
+        labels = CrashCounts(counts_dir).labels()
+    else:
+        labels = build_crash_labels(pd.read_csv(os.path.join(gnn_dir, f"{state}/CRASHES.csv")), ways, 'year')
+
+    rates, priors = crash_rates(ways, store, labels)
+    rates.round(6).to_csv(os.path.join(gnn_dir, f"{state}/RATES.csv"), index=False)
+    priors.round(6).to_csv(os.path.join(gnn_dir, f"{state}/RATE_PRIORS.csv"), index=False)
+    print(f"{len(rates)} exposed way years of {rates['way'].nunique()} ways, {rates['crashes'].sum()} crash events, "
+          f"{rates['exposure'].sum():.1f} million vehicle miles")
@@ -0,0 +1,159 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+
+from graph_arrays import load_ways, load_nodes, load_relations, dirway_index
+from joints import build_joints
+from routing import routing_graph
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+network distances from every way to the nearest event of a category, both ways along the traffic
+
+an event is at the end of a dirway: arriving at the via_node of a relation on its from_way (the node a
+traffic control or sign applies at), or leaving a ramp for a way that is not a ramp (the ramp end)
+
+per category, over the routing graph of routing.py (dirways, legal joints, to way length as weight):
+    {category}_ahead:        metres from the end of a way to the next event, 0 on the event dirway
+    {category}_ahead_hops:   joints passed on the way there
+    {category}_behind:       metres from the last event to the start of a way
+    {category}_behind_hops:  joints passed since it
+the better direction of a way is kept; -1 if no event within limit metres
+
+one multi-source Dijkstra per category and side: ahead from all event dirways on the reversed graph,
+behind from a virtual vertex before the dirways leaving the events, hops from the predecessor tree
+
+{gnn_dir}/{state}/DISTANCES.csv: a row per way index as WAYS.csv, way 0 all -1
+"""
+
+# relation (type, values), or 'ramp' for ramp ends
+CATEGORIES = {
+    'control': (4, [1, 2, 3, 4]),
+    'signal': (4, [1]),
+    'stop_yield': (4, [2, 3]),
+    'railway_crossing': (4, [4]),
+    'curve_sign': (5, [6]),
+    'merge_sign': (5, [5]),
+    'ramp_end': 'ramp',
+}
+RAMP = 5
+LIMIT = 20000.0
+
+def relation_dirways(ways, relations, relation_type, values):
+    '''
+    dirway indexes arriving at the via_node of the relations on their from_way
+    '''
+    relations = relations[(relations['type'] == relation_type) & relations['value'].isin(values)]
+    from_way = relations['from_way'].to_numpy(dtype=np.int64)
+    via_node = relations['via_node'].to_numpy(dtype=np.int64)
+
+    # forward arrives at to_node, backward at from_node
+    forward = ways['to_node'].to_numpy()[from_way] == via_node
+    backward = ways['from_node'].to_numpy()[from_way] == via_node
+    dirways = np.concatenate([from_way[forward], -from_way[backward & ~forward]])
+    return np.unique(dirway_index(dirways))
+
+def ramp_end_dirways(ways, graph):
+    '''
+    ramp dirway indexes with a joint to a dirway that is not a ramp
+    '''
+    ramp = ways['road_type'].to_numpy() == RAMP
+    coo = graph.tocoo()
+    leaving = ramp[coo.row // 2] & ~ramp[coo.col // 2]
+    return np.unique(coo.row[leaving])
+
+def path_hops(predecessors):
+    '''
+    edges from every vertex back to the root of its predecessor tree (-9999 is none), by pointer jumping
+    '''
+    hops = (predecessors >= 0).astype(np.int64)
+    jump = predecessors.astype(np.int64)
+    while True:
+        valid = np.flatnonzero(jump >= 0)
+        if len(valid) == 0:
+            return hops
+        hops[valid] += hops[jump[valid]]
+        jump[valid] = jump[jump[valid]]
+
+def distances_ahead(reverse, sources, limit = LIMIT):
+    '''
+    distance and hops [dirway] from the end of every dirway to the nearest source dirway
+    '''
+    if len(sources) == 0:
+        return np.full(reverse.shape[0], np.inf), np.full(reverse.shape[0], -1)
+
+    distance, predecessors, _ = dijkstra(reverse, indices=sources, min_only=True, limit=limit,
+                                         return_predecessors=True)
+    return distance, path_hops(predecessors)
+
+def distances_behind(graph, length, sources, limit = LIMIT):
+    '''
+    distance and hops [dirway] from the end of the nearest source dirway to the start of every dirway
+    '''
+    n = graph.shape[0]
+    if len(sources) == 0:
+        return np.full(n, np.inf), np.full(n, -1)
+
+    # a virtual vertex n in front of every dirway leaving a source, the events may be at any distance
+    leaving = np.unique(graph[sources].indices)
+    virtual = sp.csr_matrix((np.maximum(length[leaving // 2], 1e-6), (np.full(len(leaving), n), leaving)),
+                            shape=(n + 1, n + 1))
+    extended = sp.bmat([[graph, None], [None, sp.csr_matrix((1, 1))]]).tocsr() + virtual
+
+    distance, predecessors = dijkstra(extended, indices=n, limit=limit + length.max(), return_predecessors=True)
+    distance = distance[:n] - length[np.arange(n) // 2]
+    hops = path_hops(predecessors)[:n] - 1
+    distance[distance > limit] = np.inf
+    return distance, hops
+
+def distance_features(ways, nodes, relations, joints = None, categories = CATEGORIES, limit = LIMIT):
+    '''
+    DataFrame [way] of the ahead/behind distance and hop columns of every category
+    '''
+    if joints is None:
+        joints = build_joints(ways, nodes, relations)
+    graph = routing_graph(ways, joints)
+    reverse = graph.T.tocsr()
+    length = ways['length'].to_numpy(dtype=np.float64)
+
+    features = {}
+    for category, source in categories.items():
+        if source == 'ramp':
+            sources = ramp_end_dirways(ways, graph)
+        else:
+            sources = relation_dirways(ways, relations, *source)
+
+        for side, (distance, hops) in [('ahead', distances_ahead(reverse, sources, limit)),
+                                       ('behind', distances_behind(graph, length, sources, limit))]:
+            distance, hops = _by_way(distance, hops)
+            features[f'{category}_{side}'] = distance
+            features[f'{category}_{side}_hops'] = hops
+
+    return pd.DataFrame(features)
+
+def _by_way(distance, hops):
+    # the nearer of the two dirways of each way, its hops with it
+    distance = distance.reshape(-1, 2)
+    hops = hops.reshape(-1, 2)
+    nearer = np.argmin(distance, axis=1)
+    rows = np.arange(len(distance))
+    distance, hops = distance[rows, nearer], hops[rows, nearer]
+
+    reached = np.isfinite(distance)
+    return np.where(reached, np.round(distance, 1), -1), np.where(reached, hops, -1)
+
+if __name__ == '__main__':
+    ways = load_ways(gnn_dir, state)
+    nodes = load_nodes(gnn_dir, state)
+    relations = load_relations(gnn_dir, state)
+
+    features = distance_features(ways, nodes, relations)
+    features.iloc[0] = -1
+    features.to_csv(os.path.join(gnn_dir, f"{state}/DISTANCES.csv"), index=False)
+    for column in features.columns[::4]:
+        reached = features[column] >= 0
+        print(f"{column}: {reached.mean():.1%} of ways within {LIMIT:.0f}m, median {features.loc[reached, column].median()}")
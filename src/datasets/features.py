@@ -0,0 +1,191 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+states = os.environ.get('PIPELINE_STATE', 'NV').split(',')
+
+"""
+way features for the model, from WAYS.csv of any number of states (PIPELINE_STATE, comma separated)
+
+signed columns, negative means derived (see ways in way_graph.py):
+    <column>      magnitude, standardized
+    <column>_neg  1 if derived
+numeric columns: standardized
+categorical columns: one-hot of their known values, e.g. road_class_3
+bipesz: one column per bit, bipesz_1 bicycle, bipesz_2 pedestrian, bipesz_4 school
+
+statistics of magnitudes are accumulated in the same pass as encoding: count, mean and M2 merged per
+chunk (Chan et al.), and a reservoir sample per column for quantiles
+"""
+
+SIGNED = ['lane_count', 'forward_speed', 'backward_speed', 'start_bearing', 'end_bearing',
+          'curve_left', 'curve_right', 'slope_up', 'slope_down']
+NUMERIC = ['length', 'forward_lane_count', 'backward_lane_count', 'urban']
+CATEGORICAL = {'oneway': [0, 1, 2], 'road_class': [0, 1, 2, 3, 4], 'road_type': [0, 1, 2, 3, 4, 5, 6, 7, 8],
+               'divider': [0, 1, 2, 3, 4]}
+BITS = {'bipesz': [1, 2, 4]}
+
+RESERVOIR = 10000
+
+class FeatureEncoder:
+
+    def __init__(self, seed = 0):
+        self.columns = list(NUMERIC) + list(SIGNED)
+        self.count = np.zeros(len(self.columns))
+        self.mean = np.zeros(len(self.columns))
+        self.m2 = np.zeros(len(self.columns))
+        self.reservoir = np.zeros((0, len(self.columns)))
+        self.__seen__ = 0
+        self.__rng__ = np.random.default_rng(seed)
+
+    @property
+    def feature_names(self):
+        names = list(NUMERIC)
+        for column in SIGNED:
+            names += [column, f'{column}_neg']
+        for column, values in CATEGORICAL.items():
+            names += [f'{column}_{value}' for value in values]
+        for column, bits in BITS.items():
+            names += [f'{column}_{bit}' for bit in bits]
+        return names
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / np.maximum(self.count - 1, 1))
+
+    def quantiles(self, q):
+        '''
+        approximate quantiles [q, column] of the magnitudes from the reservoir
+        '''
+        return np.quantile(self.reservoir, q, axis=0)
+
+    def encode(self, ways):
+        '''
+        unnormalized float32 features [way, feature] of a WAYS.csv chunk, magnitudes in the first columns
+        '''
+        numeric = ways[NUMERIC].to_numpy(dtype=np.float64)
+        signed = ways[SIGNED].to_numpy(dtype=np.float64)
+
+        features = np.empty((len(ways), len(self.feature_names)), dtype=np.float32)
+        features[:, :len(NUMERIC)] = numeric
+        features[:, len(NUMERIC):len(NUMERIC) + 2 * len(SIGNED):2] = np.abs(signed)
+        features[:, len(NUMERIC) + 1:len(NUMERIC) + 2 * len(SIGNED):2] = signed < 0
+
+        i = len(NUMERIC) + 2 * len(SIGNED)
+        for column, values in CATEGORICAL.items():
+            codes = ways[column].to_numpy()
+            features[:, i:i + len(values)] = codes[:, None] == np.array(values)[None, :]
+            i += len(values)
+        for column, bits in BITS.items():
+            codes = ways[column].to_numpy().astype(np.int64)
+            features[:, i:i + len(bits)] = (codes[:, None] & np.array(bits)[None, :]) > 0
+            i += len(bits)
+
+        return features
+
+    def magnitudes(self, features):
+        return features[:, self.__magnitude_columns__()].astype(np.float64)
+
+    def accumulate(self, magnitudes):
+        '''
+        merge the mean/variance and the reservoir of a chunk of magnitudes [way, column]
+        '''
+        n = len(magnitudes)
+        if n == 0:
+            return
+
+        mean = magnitudes.mean(axis=0)
+        m2 = ((magnitudes - mean) ** 2).sum(axis=0)
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+        # reservoir sampling (algorithm R) of whole rows
+        room = RESERVOIR - len(self.reservoir)
+        if room > 0:
+            self.reservoir = np.concatenate([self.reservoir, magnitudes[:room]])
+        seen = self.__seen__ + np.arange(max(room, 0), n) + 1
+        slots = (self.__rng__.random(len(seen)) * seen).astype(np.int64)
+        replace = slots < RESERVOIR
+        self.reservoir[slots[replace]] = magnitudes[max(room, 0):][replace]
+        self.__seen__ += n
+
+    def normalize(self, features):
+        '''
+        standardize the magnitude columns in place
+        '''
+        columns = self.__magnitude_columns__()
+        std = np.where(self.std > 0, self.std, 1)
+        features[:, columns] = (features[:, columns] - self.mean) / std
+        return features
+
+    def __magnitude_columns__(self):
+        return np.concatenate([np.arange(len(NUMERIC)), len(NUMERIC) + 2 * np.arange(len(SIGNED))])
+
+    def save(self, path):
+        with open(os.path.expanduser(path), 'w') as file:
+            json.dump({'columns': self.columns, 'features': self.feature_names, 'count': self.count.tolist(),
+                       'mean': self.mean.tolist(), 'm2': self.m2.tolist(), 'std': self.std.tolist(),
+                       'quantiles': self.quantiles([0.01, 0.25, 0.5, 0.75, 0.99]).tolist()}, file)
+
+def load_encoder(path):
+    '''
+    statistics to normalize with, the reservoir is not saved
+    '''
+    with open(os.path.expanduser(path)) as file:
+        stats = json.load(file)
+
+    encoder = FeatureEncoder()
+    encoder.count = np.array(stats['count'])
+    encoder.mean = np.array(stats['mean'])
+    encoder.m2 = np.array(stats['m2'])
+    return encoder
+
+def encode_states(gnn_dir, states, chunksize = 200000):
+    '''
+    one pass over WAYS.csv of every state: encode chunks into {state}/FEATURES.npy (memory mapped)
+    while accumulating statistics, then standardize the encoded files in place
+    '''
+    encoder = FeatureEncoder()
+    paths = []
+    for state in states:
+        ways_path = os.path.expanduser(os.path.join(gnn_dir, f"{state}/WAYS.csv"))
+        with open(ways_path) as file:
+            n_ways = sum(1 for _ in file) - 1
+
+        path = os.path.expanduser(os.path.join(gnn_dir, f"{state}/FEATURES.npy"))
+        features = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                             shape=(n_ways, len(encoder.feature_names)))
+        row = 0
+        for ways in pd.read_csv(ways_path, usecols=NUMERIC + SIGNED + list(CATEGORICAL) + list(BITS),
+                                chunksize=chunksize):
+            chunk = encoder.encode(ways.fillna(0))
+            if row == 0:
+                chunk[0] = 0 # dummy way 0, no statistics
+                encoder.accumulate(encoder.magnitudes(chunk[1:]))
+            else:
+                encoder.accumulate(encoder.magnitudes(chunk))
+
+            features[row:row + len(chunk)] = chunk
+            row += len(chunk)
+
+        features.flush()
+        paths.append(path)
+        print(f"encoded {row} ways of {state}")
+
+    for path in paths:
+        features = np.load(path, mmap_mode='r+')
+        for start in range(0, len(features), chunksize):
+            features[start:start + chunksize] = encoder.normalize(np.array(features[start:start + chunksize]))
+        features[0] = 0
+        features.flush()
+
+    return encoder
+
+if __name__ == '__main__':
+    encoder = encode_states(gnn_dir, states)
+    encoder.save(os.path.join(gnn_dir, "FEATURES.json"))
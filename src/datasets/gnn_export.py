@@ -0,0 +1,158 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+from crash_labels import build_crash_labels
+from graph_arrays import load_ways, load_nodes, load_relations, dirway_index
+from joints import build_joints
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+GNN tensors of the way graph, .npy files under {gnn_dir}/{state}/TENSORS
+
+way graph: a node per way index (way 0 is an isolated dummy), an edge per joint from way to way
+    x.npy           float32 [way, feature]          columns in export.json
+    edge_index.npy  int64   [2, joint]              from way, to way
+    edge_attr.npy   float32 [joint, feature]
+    y.npy           int32   [way, 3]                crashes by severity 1, 2, 3 (with crashes)
+
+line graph (turns): a node per dirway index, an edge per joint
+    turn_edge_index.npy int64 [2, joint]            from dirway index, to dirway index
+
+parts/{k}: one partition, ways are the inner ways then the halo ways within halo hops
+    ways.npy, x.npy, y.npy, edge_index.npy (local), edge_attr.npy, part.json (n_inner)
+    edges are all joints between ways of the part, so halo hops carry messages inward; a loss is
+    taken on the first n_inner ways only
+
+partitions cut the reverse Cuthill-McKee order of the way graph into K equal runs, neighbours stay
+close in that order so parts are balanced and mostly local
+"""
+
+WAY_FEATURES = ['length', 'oneway', 'road_class', 'road_type', 'divider', 'urban', 'bipesz', 'lane_count',
+                'forward_lane_count', 'backward_lane_count', 'forward_speed', 'backward_speed', 'start_bearing',
+                'end_bearing', 'curve_left', 'curve_right', 'slope_up', 'slope_down']
+
+JOINT_FEATURES = ['length', 'slope', 'connected_lanes', 'traffic_control', 'restriction', 'barrier', 'traffic_conflicts']
+
+def way_edges(joints):
+    return np.ascontiguousarray(np.stack([np.abs(joints['from_way'].to_numpy()),
+                                          np.abs(joints['to_way'].to_numpy())]).astype(np.int64))
+
+def turn_edges(joints):
+    return np.ascontiguousarray(np.stack([dirway_index(joints['from_way'].to_numpy()),
+                                          dirway_index(joints['to_way'].to_numpy())]).astype(np.int64))
+
+def partition(edge_index, n_ways, k):
+    '''
+    part of every way, k balanced runs of the reverse Cuthill-McKee order
+    '''
+    adjacency = sp.csr_matrix((np.ones(edge_index.shape[1], dtype=np.int8), (edge_index[0], edge_index[1])),
+                              shape=(n_ways, n_ways))
+    adjacency = (adjacency + adjacency.T).tocsr()
+    order = reverse_cuthill_mckee(adjacency, symmetric_mode=True)
+
+    parts = np.empty(n_ways, dtype=np.int32)
+    parts[order] = np.arange(n_ways) * k // n_ways
+    return parts, adjacency
+
+def halo_ways(adjacency, inner, hops = 1):
+    '''
+    ways within hops of the inner ways but not inner, in way index order
+    '''
+    reached = np.zeros(adjacency.shape[0], dtype=bool)
+    reached[inner] = True
+    frontier = reached.copy()
+    for _ in range(hops):
+        frontier = (adjacency.T @ frontier.astype(np.int8) > 0) & ~reached
+        reached |= frontier
+
+    reached[inner] = False
+    return np.flatnonzero(reached)
+
+def export(out_dir, ways, joints, crashes = None, x = None, k = 0, halo = 1, line_graph = False, columns = None):
+    '''
+    ways: DataFrame of WAYS.csv, joints: DataFrame of build_joints(), crashes: DataFrame of CRASHES.csv
+    x: feature matrix of ways to export instead of the raw WAY_FEATURES columns, columns: its feature names
+    k: number of partitions, 0 for none
+    '''
+    out_dir = os.path.expanduser(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    if x is None:
+        x = ways[WAY_FEATURES].to_numpy(dtype=np.float32)
+        columns = WAY_FEATURES
+    elif columns is None:
+        columns = [f'x{i}' for i in range(x.shape[1])]
+    elif len(columns) != x.shape[1]:
+        raise ValueError(f"{len(columns)} feature names for {x.shape[1]} columns of x")
+    x = np.ascontiguousarray(x, dtype=np.float32)
+
+    edge_index = way_edges(joints)
+    edge_attr = np.ascontiguousarray(joints[JOINT_FEATURES].to_numpy(dtype=np.float32))
+    y = build_crash_labels(crashes, ways, 'year').by_severity() if crashes is not None else None
+
+    np.save(os.path.join(out_dir, 'x.npy'), x)
+    np.save(os.path.join(out_dir, 'edge_index.npy'), edge_index)
+    np.save(os.path.join(out_dir, 'edge_attr.npy'), edge_attr)
+    if y is not None:
+        np.save(os.path.join(out_dir, 'y.npy'), y)
+    if line_graph:
+        np.save(os.path.join(out_dir, 'turn_edge_index.npy'), turn_edges(joints))
+
+    meta = {'n_ways': len(ways), 'n_joints': edge_index.shape[1], 'way_features': columns,
+            'joint_features': JOINT_FEATURES, 'parts': k, 'halo': halo}
+    with open(os.path.join(out_dir, 'export.json'), 'w') as file:
+        json.dump(meta, file)
+
+    if k > 0:
+        _export_parts(out_dir, x, y, edge_index, edge_attr, k, halo)
+
+    print(f"exported {len(ways)} ways, {edge_index.shape[1]} joints, {k} parts")
+
+def _export_parts(out_dir, x, y, edge_index, edge_attr, k, halo):
+    n_ways = x.shape[0]
+    parts, adjacency = partition(edge_index, n_ways, k)
+
+    local = np.full(n_ways, -1, dtype=np.int64)
+    for part in range(k):
+        inner = np.flatnonzero(parts == part)
+        part_ways = np.concatenate([inner, halo_ways(adjacency, inner, halo)])
+        local[part_ways] = np.arange(len(part_ways))
+
+        # every edge between ways of the part, halo to halo too
+        keep = (local[edge_index[0]] >= 0) & (local[edge_index[1]] >= 0)
+        part_edges = np.ascontiguousarray(local[edge_index[:, keep]])
+
+        part_dir = os.path.join(out_dir, f'parts/{part:03d}')
+        os.makedirs(part_dir, exist_ok=True)
+        np.save(os.path.join(part_dir, 'ways.npy'), part_ways)
+        np.save(os.path.join(part_dir, 'x.npy'), x[part_ways])
+        np.save(os.path.join(part_dir, 'edge_index.npy'), part_edges)
+        np.save(os.path.join(part_dir, 'edge_attr.npy'), edge_attr[keep])
+        if y is not None:
+            np.save(os.path.join(part_dir, 'y.npy'), y[part_ways])
+        with open(os.path.join(part_dir, 'part.json'), 'w') as file:
+            json.dump({'n_inner': len(inner), 'n_halo': len(part_ways) - len(inner), 'n_edges': int(keep.sum())}, file)
+
+        local[part_ways] = -1
+
+if __name__ == '__main__':
+    ways = load_ways(gnn_dir, state)
+    joints = build_joints(ways, load_nodes(gnn_dir, state), load_relations(gnn_dir, state))
+    crashes = pd.read_csv(os.path.join(gnn_dir, f"{state}/CRASHES.csv"))
+
+    # encoded by features.py if available, feature names from its FEATURES.json
+    features_path = os.path.expanduser(os.path.join(gnn_dir, f"{state}/FEATURES.npy"))
+    x = columns = None
+    if os.path.exists(features_path):
+        x = np.load(features_path)
+        with open(os.path.expanduser(os.path.join(gnn_dir, "FEATURES.json"))) as file:
+            columns = json.load(file)['features']
+
+    export(os.path.join(gnn_dir, f"{state}/TENSORS"), ways, joints, crashes, x, k=16, line_graph=True,
+           columns=columns)
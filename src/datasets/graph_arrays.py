@@ -0,0 +1,102 @@
+import os
+import numpy as np
+import pandas as pd
+
+"""
+array views of the extracted way graph
+
+node_ways (CSR of NODES.csv 'ways'):
+    indptr: int64 [node + 1]
+    signed: int64 [sum of node degrees], positive is at from_node, negative is at to_node
+
+directed way (dirway): forward is positive, backward is negative, as joints in way_graph.py
+    a signed entry e at a node is the dirway leaving the node, -e is the dirway arriving at it
+    dirway index: 2 * way for forward, 2 * way + 1 for backward, e.g. rows of line graph arrays
+
+transitions (dirway to dirway through a node):
+    from_dirway, via_node, to_dirway: int64 [transition]
+"""
+
+def load_ways(gnn_dir, state, columns = None):
+    '''
+    the dummy way 0 has no attributes in WAYS.csv, it gets no nodes (-1) and zeros
+    '''
+    ways = pd.read_csv(os.path.join(gnn_dir, f"{state}/WAYS.csv"), usecols=columns)
+    ways = ways.fillna({column: -1 for column in ['from_node', 'to_node'] if column in ways}).fillna(0)
+    return ways.astype({column: np.int64 for column in ways.columns if column != 'polyline'})
+
+def load_nodes(gnn_dir, state):
+    return pd.read_csv(os.path.join(gnn_dir, f"{state}/NODES.csv"))
+
+def load_relations(gnn_dir, state):
+    return pd.read_csv(os.path.join(gnn_dir, f"{state}/RELATIONS.csv"))
+
+def graph_frames(graph):
+    '''
+    DataFrames of an in-memory WayGraph in the layout of WAYS.csv and NODES.csv
+    '''
+    ways = graph.ways if isinstance(graph.ways, pd.DataFrame) else pd.DataFrame(graph.ways)
+    nodes = graph.nodes if isinstance(graph.nodes, pd.DataFrame) else pd.DataFrame(graph.nodes)
+    return ways, nodes
+
+def node_ways(nodes):
+    '''
+    nodes['ways'] is a list per node, or its string form "[1, -3]" when read from NODES.csv
+    '''
+    ways = nodes['ways']
+    if len(ways) and isinstance(ways.iloc[0], str):
+        ways = ways.str.strip('[]')
+        counts = ways.str.count(',').to_numpy() + 1
+        counts[(ways.str.len() == 0).to_numpy()] = 0
+        signed = np.array(','.join(ways[counts > 0]).split(','), dtype=np.int64)
+    else:
+        counts = ways.map(len).to_numpy()
+        signed = np.fromiter((index for node_ways in ways for index in node_ways), dtype=np.int64, count=counts.sum())
+
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, signed
+
+def entry_nodes(indptr):
+    '''
+    node index of every signed entry of node_ways
+    '''
+    return np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+
+def dirway_allowed(oneway, dirways):
+    '''
+    oneway: 'oneway' column of ways by way index; twoway(0), forward(1), backward(2)
+    '''
+    restriction = oneway[np.abs(dirways)]
+    return (restriction == 0) | ((dirways > 0) & (restriction == 1)) | ((dirways < 0) & (restriction == 2))
+
+def transitions(indptr, signed, oneway, u_turn = False):
+    '''
+    all legal dirway to dirway transitions through every node, in node order
+    '''
+    degrees = np.diff(indptr)
+    pair_counts = degrees * degrees
+    via_node = np.repeat(np.arange(len(degrees), dtype=np.int64), pair_counts)
+
+    pair_start = np.zeros(len(degrees), dtype=np.int64)
+    np.cumsum(pair_counts[:-1], out=pair_start[1:])
+    offset = np.arange(pair_counts.sum(), dtype=np.int64) - pair_start[via_node]
+    degree = degrees[via_node]
+
+    from_dirway = -signed[indptr[via_node] + offset // degree]
+    to_dirway = signed[indptr[via_node] + offset % degree]
+
+    legal = dirway_allowed(oneway, from_dirway) & dirway_allowed(oneway, to_dirway)
+    legal &= from_dirway != to_dirway
+    if not u_turn:
+        legal &= from_dirway != -to_dirway
+
+    return from_dirway[legal], via_node[legal], to_dirway[legal]
+
+def dirway_index(dirways):
+    dirways = np.asarray(dirways)
+    return 2 * np.abs(dirways) + (dirways < 0)
+
+def index_dirway(indexes):
+    indexes = np.asarray(indexes)
+    return np.where(indexes % 2 == 0, indexes // 2, -(indexes // 2))
@@ -0,0 +1,204 @@
+import os
+import numpy as np
+import pandas as pd
+import polyline
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from graph_arrays import load_ways
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+crash hotspots of CRASHES.csv by density clustering (DBSCAN) with severity weights
+
+crashes are projected to metres around their median point (project, projection_origin); a crash weighs
+SEVERITY_WEIGHTS[crash_severity]; a crash is core when the weights of the crashes within eps metres,
+itself included, reach min_weight; clusters are the connected core crashes, a crash that is not core
+joins the cluster of a core crash within eps; a hotspot is a cluster with crashes in at least min_years years
+
+neighbors are found over a grid of eps cells hashed to int64 keys, only the 3 x 3 cells around a crash
+are compared, so the cost is the crashes times their neighbors instead of all pairs
+
+{gnn_dir}/{state}/HOTSPOTS.csv: a row per hotspot
+    lat, lon: weighted centroid; radius: metres of the farthest crash; crashes, weight, years
+    type, value, from_way, via_node, to_way: the blackspot relation, additional(6) value 1 as in
+        way_graph.py; from_way the way with the most weight of matched vehicles, via_node its end nearer
+        the centroid, to_way the next heaviest way at via_node or 0
+{gnn_dir}/{state}/BLACKSPOTS.csv: the relation columns only, in the layout of RELATIONS.csv
+"""
+
+SEVERITY_WEIGHTS = {1: 1.0, 2: 3.0, 3: 10.0}
+EPS = 50.0
+MIN_WEIGHT = 15.0
+MIN_YEARS = 2
+EARTH_RADIUS = 6371008.8
+CHUNK = 1 << 20
+
+def project(lat, lon, origin):
+    '''
+    metres east and north of origin (lat, lon), spherical transverse Mercator about the origin meridian;
+    conformal, so short distances in any direction scale alike, by less than 0.2% within 500 km of it
+    '''
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64) - origin[1])
+    b = np.cos(lat) * np.sin(lon)
+    return (EARTH_RADIUS * np.arctanh(b),
+            EARTH_RADIUS * (np.arctan2(np.tan(lat), np.cos(lon)) - np.radians(origin[0])))
+
+def projection_origin(lat, lon):
+    '''
+    median (lat, lon) of the crashes
+    '''
+    return (float(np.median(lat)), float(np.median(lon))) if len(lat) else (0.0, 0.0)
+
+def grid_neighbors(x, y, eps):
+    '''
+    (i, j) int64 pairs of points within eps of each other, i != j, both orders
+    '''
+    cell_x = np.floor(x / eps).astype(np.int64)
+    cell_y = np.floor(y / eps).astype(np.int64)
+    cell_x -= cell_x.min() - 1
+    cell_y -= cell_y.min() - 1
+    width = int(cell_y.max()) + 2
+    keys = cell_x * width + cell_y
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    rows, columns = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbor = keys + dx * width + dy
+            start = np.searchsorted(sorted_keys, neighbor, side='left')
+            stop = np.searchsorted(sorted_keys, neighbor, side='right')
+            # points in chunks of about CHUNK candidate pairs, dense cells stay bounded in memory
+            counts = stop - start
+            cumulative = np.cumsum(counts)
+            cuts = np.minimum(np.searchsorted(cumulative, np.arange(CHUNK, cumulative[-1], CHUNK)) + 1, len(x))
+            cuts = np.unique(np.concatenate([[0], cuts, [len(x)]]))
+            for first, last in zip(cuts[:-1], cuts[1:]):
+                chunk = counts[first:last]
+                i = np.repeat(np.arange(first, last), chunk)
+                j = order[np.repeat(start[first:last] - (np.cumsum(chunk) - chunk), chunk) + np.arange(len(i))]
+                near = (i != j) & ((x[i] - x[j]) ** 2 + (y[i] - y[j]) ** 2 <= eps * eps)
+                rows.append(i[near])
+                columns.append(j[near])
+
+    empty = np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows + [empty]), np.concatenate(columns + [empty])
+
+def dbscan(x, y, weight, eps = EPS, min_weight = MIN_WEIGHT):
+    '''
+    cluster label [point], -1 for noise
+    '''
+    n = len(x)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    i, j = grid_neighbors(x, y, eps)
+    density = weight + np.bincount(i, weights=weight[j], minlength=n)
+    core = density >= min_weight
+
+    both = core[i] & core[j]
+    graph = sp.csr_matrix((np.ones(both.sum()), (i[both], j[both])), shape=(n, n))
+    _, components = connected_components(graph, directed=False)
+
+    labels = np.full(n, -1, dtype=np.int64)
+    core_index = np.flatnonzero(core)
+    # components numbered again over the core points only
+    _, labels[core_index] = np.unique(components[core_index], return_inverse=True)
+
+    # a border point joins the cluster of its first core neighbor
+    border = ~core[i] & core[j]
+    first = np.unique(i[border], return_index=True)
+    labels[first[0]] = labels[j[border][first[1]]]
+    return labels
+
+def find_hotspots(crashes, ways, polylines = None, eps = EPS, min_weight = MIN_WEIGHT, min_years = MIN_YEARS,
+                  weights = SEVERITY_WEIGHTS):
+    '''
+    crashes, ways: DataFrames of CRASHES.csv and WAYS.csv; polylines: the 'polyline' column of
+    POLYLINES.csv to place via_node, from_node of from_way without it
+    '''
+    crashes = crashes[crashes['lat'].notna() & crashes['lon'].notna()].reset_index(drop=True)
+    origin = projection_origin(crashes['lat'], crashes['lon'])
+    x, y = project(crashes['lat'], crashes['lon'], origin)
+    weight = crashes['crash_severity'].map(weights).fillna(1.0).to_numpy()
+    labels = dbscan(x, y, weight, eps, min_weight)
+
+    clustered = labels >= 0
+    crashes = crashes[clustered].assign(cluster=labels[clustered], weight=weight[clustered],
+                                        x=x[clustered], y=y[clustered],
+                                        year=pd.to_datetime(crashes['crash_date'][clustered], errors='coerce').dt.year)
+    if len(crashes) == 0:
+        return pd.DataFrame(columns=['lat', 'lon', 'radius', 'crashes', 'weight', 'years',
+                                     'type', 'value', 'from_way', 'via_node', 'to_way'])
+
+    groups = crashes.groupby('cluster')
+    hotspots = pd.DataFrame({'crashes': groups.size(), 'weight': groups['weight'].sum(),
+                             'years': groups['year'].nunique()})
+    for column in ['lat', 'lon', 'x', 'y']:
+        hotspots[column] = (crashes[column] * crashes['weight']).groupby(crashes['cluster']).sum() / hotspots['weight']
+    center = hotspots.loc[crashes['cluster'], ['x', 'y']].to_numpy()
+    distance = np.hypot(crashes['x'].to_numpy() - center[:, 0], crashes['y'].to_numpy() - center[:, 1])
+    hotspots['radius'] = pd.Series(distance, index=crashes.index).groupby(crashes['cluster']).max().round(1)
+    hotspots = hotspots[hotspots['years'] >= min_years]
+
+    relations = _snap(crashes[crashes['cluster'].isin(hotspots.index)], hotspots, ways, polylines, origin)
+    hotspots = hotspots.join(relations)
+    hotspots['lat'] = hotspots['lat'].round(5)
+    hotspots['lon'] = hotspots['lon'].round(5)
+    hotspots['weight'] = hotspots['weight'].round(1)
+    hotspots = hotspots[hotspots['from_way'] > 0].sort_values('weight', ascending=False).reset_index(drop=True)
+    return hotspots[['lat', 'lon', 'radius', 'crashes', 'weight', 'years', 'type', 'value', 'from_way', 'via_node', 'to_way']]
+
+def blackspot_relations(hotspots):
+    '''
+    hotspots as relations in the layout of RELATIONS.csv, to append to the relations of a graph
+    '''
+    return hotspots[['type', 'value', 'from_way', 'via_node', 'to_way']].astype(np.int64).reset_index(drop=True)
+
+def _snap(crashes, hotspots, ways, polylines, origin):
+    '''
+    [type, value, from_way, via_node, to_way] by cluster
+    '''
+    vehicles = [column for column in ['v1_way', 'v2_way'] if column in crashes]
+    ids = pd.concat([crashes[column] for column in vehicles]).fillna(0).astype(np.int64).to_numpy()
+    votes = pd.DataFrame({'cluster': np.tile(crashes['cluster'].to_numpy(), len(vehicles)),
+                          'way': pd.Index(ways['way_id']).get_indexer(ids),
+                          'weight': np.tile(crashes['weight'].to_numpy(), len(vehicles))})
+    votes = votes[votes['way'] > 0].groupby(['cluster', 'way'])['weight'].sum().reset_index()
+    votes = votes.sort_values(['cluster', 'weight', 'way'], ascending=[True, False, True])
+
+    from_node = ways['from_node'].to_numpy()
+    to_node = ways['to_node'].to_numpy()
+    relations = {}
+    for cluster, cluster_votes in votes.groupby('cluster', sort=False):
+        candidates = cluster_votes['way'].tolist()
+        from_way = candidates[0]
+        via_node = _nearer_end(from_way, hotspots.loc[cluster], from_node, to_node, polylines, origin)
+        to_way = next((way for way in candidates[1:] if via_node >= 0 and via_node in (from_node[way], to_node[way])), 0)
+        relations[cluster] = [6, 1, from_way, via_node, to_way]
+
+    return pd.DataFrame.from_dict(relations, orient='index', columns=['type', 'value', 'from_way', 'via_node', 'to_way'])
+
+def _nearer_end(way, hotspot, from_node, to_node, polylines, origin):
+    ends = [from_node[way], to_node[way]]
+    if polylines is not None and isinstance(polylines.iloc[way], str):
+        points = polyline.decode(polylines.iloc[way])
+        x, y = project([points[0][0], points[-1][0]], [points[0][1], points[-1][1]], origin)
+        distance = np.hypot(x - hotspot['x'], y - hotspot['y'])
+        ends = [ends[int(np.argmin(distance))], ends[int(np.argmax(distance))]]
+    return next((node for node in ends if node >= 0), -1)
+
+if __name__ == '__main__':
+    ways = load_ways(gnn_dir, state, ['way_id', 'from_node', 'to_node'])
+    crashes = pd.read_csv(os.path.join(gnn_dir, f"{state}/CRASHES.csv"))
+    polylines_path = os.path.join(gnn_dir, f"{state}/POLYLINES.csv")
+    polylines = pd.read_csv(polylines_path)['polyline'] if os.path.exists(os.path.expanduser(polylines_path)) else None
+
+    hotspots = find_hotspots(crashes, ways, polylines)
+    hotspots.to_csv(os.path.join(gnn_dir, f"{state}/HOTSPOTS.csv"), index=False)
+    blackspot_relations(hotspots).to_csv(os.path.join(gnn_dir, f"{state}/BLACKSPOTS.csv"), index=False)
+    print(f"{len(hotspots)} hotspots of {hotspots['crashes'].sum()} crashes out of {len(crashes)}")
@@ -0,0 +1,222 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+"""
+id to index maps of WayGraph (way_graph.py) for 64-bit HERE ids of ways, nodes and relations
+
+index = new_id_index('sorted')          # 'dict', 'sorted' or 'disk', PIPELINE_ID_INDEX by default
+index[id] = i                           # single insert, buffered
+index.get(id), id in index, index[id]   # single lookup, the buffer first, then the runs newest first
+index.insert_many(ids, indexes)         # bulk insert, int64 arrays
+index.lookup_many(ids)                  # bulk lookup, int64 [query], -1 where missing
+index.close()                           # the files of a disk index are removed
+
+DictIdIndex:    a python dict, about 100 bytes an id
+SortedIdIndex:  sorted runs of int64 ids and int64 indexes in memory, 16 bytes an id
+DiskIdIndex:    sorted runs as memory mapped .npy files in directory (PIPELINE_ID_INDEX_DIR or a temporary
+                one), RAM is the buffer and a merge block, pages of the runs are cached by the OS
+
+single inserts go to a dict buffer of buffer ids that becomes a run when full, a bulk insert is a run;
+runs are merged while the older is not larger than the newer (external merge in blocks of block rows),
+so there are about log2(ids / buffer) runs and an id is merged about as often
+an id inserted again maps to its newer index; indexes are >= 0
+"""
+
+BUFFER = 1 << 16
+BLOCK = 1 << 20
+
+def new_id_index(kind = None, name = 'ids', directory = None):
+    kind = kind or os.environ.get('PIPELINE_ID_INDEX', 'dict')
+    if kind == 'dict':
+        return DictIdIndex()
+    if kind == 'sorted':
+        return SortedIdIndex()
+    if kind == 'disk':
+        return DiskIdIndex(directory or os.environ.get('PIPELINE_ID_INDEX_DIR'), name)
+    raise ValueError(f"unknown id index {kind}, one of dict, sorted and disk")
+
+class DictIdIndex(dict):
+
+    def insert_many(self, ids, indexes):
+        self.update(zip(np.asarray(ids, dtype=np.int64).tolist(), np.asarray(indexes, dtype=np.int64).tolist()))
+
+    def lookup_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        return np.fromiter((self.get(id, -1) for id in ids.tolist()), dtype=np.int64, count=len(ids))
+
+    def close(self):
+        self.clear()
+
+class SortedIdIndex:
+
+    def __init__(self, buffer = BUFFER, block = BLOCK):
+        self.runs = [] # [(ids, indexes)], oldest first
+        self.__buffer__ = {}
+        self.__buffer_size__ = buffer
+        self.__block__ = block
+
+    def __setitem__(self, id, index):
+        self.__buffer__[int(id)] = int(index)
+        if len(self.__buffer__) >= self.__buffer_size__:
+            self.flush()
+
+    def __getitem__(self, id):
+        index = self.get(id)
+        if index is None:
+            raise KeyError(id)
+        return index
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def get(self, id, default = None):
+        index = self.__buffer__.get(id)
+        if index is not None:
+            return index
+
+        for ids, indexes in reversed(self.runs):
+            position = int(np.searchsorted(ids, id))
+            if position < len(ids) and ids[position] == id:
+                return int(indexes[position])
+        return default
+
+    def insert_many(self, ids, indexes):
+        self.flush()
+        self.__add_run__(*_sorted_run(ids, indexes))
+
+    def lookup_many(self, ids):
+        self.flush()
+        ids = np.asarray(ids, dtype=np.int64)
+        result = np.full(len(ids), -1, dtype=np.int64)
+        # sorted queries walk the runs in order, a disk run is read page by page
+        order = np.argsort(ids, kind='stable')
+        queries = ids[order]
+        missing = np.arange(len(ids))
+        for run_ids, run_indexes in reversed(self.runs):
+            if len(missing) == 0 or len(run_ids) == 0:
+                continue
+            position = np.minimum(np.searchsorted(run_ids, queries[missing]), len(run_ids) - 1)
+            found = np.asarray(run_ids[position]) == queries[missing]
+            result[order[missing[found]]] = np.asarray(run_indexes[position[found]])
+            missing = missing[~found]
+        return result
+
+    def flush(self):
+        '''
+        the buffer into a run
+        '''
+        if self.__buffer__:
+            ids = np.fromiter(self.__buffer__.keys(), dtype=np.int64, count=len(self.__buffer__))
+            indexes = np.fromiter(self.__buffer__.values(), dtype=np.int64, count=len(self.__buffer__))
+            self.__buffer__.clear()
+            self.__add_run__(*_sorted_run(ids, indexes))
+
+    def close(self):
+        self.runs = []
+        self.__buffer__.clear()
+
+    def __add_run__(self, ids, indexes):
+        if len(ids) == 0:
+            return
+        self.runs.append(self.__store__(ids, indexes))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= len(self.runs[-1][0]):
+            newer = self.runs.pop()
+            older = self.runs.pop()
+            out_ids, out_indexes = self.__allocate__(len(older[0]) + len(newer[0]))
+            count = _merge_runs(older, newer, out_ids, out_indexes, self.__block__)
+            self.__release__(older)
+            self.__release__(newer)
+            self.runs.append(self.__seal__(out_ids, out_indexes, count))
+
+    def __store__(self, ids, indexes):
+        return ids, indexes
+
+    def __allocate__(self, size):
+        return np.empty(size, dtype=np.int64), np.empty(size, dtype=np.int64)
+
+    def __seal__(self, ids, indexes, count):
+        if count < len(ids):
+            return ids[:count].copy(), indexes[:count].copy()
+        return ids, indexes
+
+    def __release__(self, run):
+        pass
+
+class DiskIdIndex(SortedIdIndex):
+
+    def __init__(self, directory = None, name = 'ids', buffer = BUFFER, block = BLOCK):
+        super().__init__(buffer, block)
+        self.__temporary__ = directory is None
+        self.directory = tempfile.mkdtemp(prefix='id_index_') if directory is None else os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.name = name
+        self.__serial__ = 0
+
+    def close(self):
+        for run in self.runs:
+            self.__release__(run)
+        super().close()
+        if self.__temporary__:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __store__(self, ids, indexes):
+        out_ids, out_indexes = self.__allocate__(len(ids))
+        out_ids[:] = ids
+        out_indexes[:] = indexes
+        return self.__seal__(out_ids, out_indexes, len(ids))
+
+    def __allocate__(self, size):
+        path = os.path.join(self.directory, f"{self.name}_{self.__serial__}")
+        self.__serial__ += 1
+        return (np.lib.format.open_memmap(f"{path}_ids.npy", mode='w+', dtype=np.int64, shape=(size,)),
+                np.lib.format.open_memmap(f"{path}_indexes.npy", mode='w+', dtype=np.int64, shape=(size,)))
+
+    def __seal__(self, ids, indexes, count):
+        ids.flush()
+        indexes.flush()
+        # read only from here on, the rows past count (duplicates dropped in the merge) stay unused
+        return (np.load(ids.filename, mmap_mode='r')[:count], np.load(indexes.filename, mmap_mode='r')[:count])
+
+    def __release__(self, run):
+        for array in run:
+            if os.path.exists(array.filename):
+                os.remove(array.filename)
+
+def _sorted_run(ids, indexes):
+    '''
+    (ids, indexes) sorted by id, the last of a repeated id kept
+    '''
+    ids = np.asarray(ids, dtype=np.int64)
+    indexes = np.asarray(indexes, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    ids, indexes = ids[order], indexes[order]
+    last = np.append(ids[1:] != ids[:-1], True) if len(ids) else np.zeros(0, dtype=bool)
+    return ids[last], indexes[last]
+
+def _merge_runs(older, newer, out_ids, out_indexes, block):
+    '''
+    merge two sorted runs into out_ids and out_indexes block by block, the newer index of an id in
+    both kept; the count of rows written
+    '''
+    runs = [older, newer]
+    positions = [0, 0]
+    written = 0
+    while positions[0] < len(older[0]) or positions[1] < len(newer[0]):
+        # up to the smaller of the block-th remaining ids of both runs, so each side reads at most block rows
+        # and an id in both runs is in the same block
+        bounds = [ids[position + block - 1] for (ids, _), position in zip(runs, positions)
+                  if position + block <= len(ids)]
+        ends = [len(ids) if not bounds else position + int(np.searchsorted(ids[position:], min(bounds), side='right'))
+                for (ids, _), position in zip(runs, positions)]
+
+        ids = np.concatenate([np.asarray(run[0][start:end]) for run, start, end in zip(runs, positions, ends)])
+        indexes = np.concatenate([np.asarray(run[1][start:end]) for run, start, end in zip(runs, positions, ends)])
+        ids, indexes = _sorted_run(ids, indexes)
+
+        out_ids[written:written + len(ids)] = ids
+        out_indexes[written:written + len(ids)] = indexes
+        written += len(ids)
+        positions = ends
+    return written
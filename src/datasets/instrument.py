@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+
+run_dir = "~/data/RUNS"
+
+"""
+stage level instrumentation of the extraction scripts
+
+run = Run('1_extract_ways')
+with run.stage('ways') as stage:
+    for ...:
+        with run.lap('parse'):      # optional, cheap timers accumulated inside a stage
+            ...
+    stage.rows = len(raw_ways)
+run.attach('matching', telemetry)   # optional, anything with report() -> dict, e.g. match_telemetry.py
+run.save()                          # {run_dir}/{name}_{yyyymmdd_hhmmss}.json, also printed per stage
+
+a stage: wall_s, cpu_s, rows, rows_per_sec, rss_mb (at exit), peak_rss_mb (of the process so far),
+    laps: {lap: {wall_s, cpu_s, calls}}
+    with tracemalloc (INSTRUMENT_TRACEMALLOC=1): traced_peak_mb and top allocators of the stage by line
+    with the profiler (INSTRUMENT_PROFILE=append_way,match_line): samples of the main thread every
+        INSTRUMENT_INTERVAL seconds, share of samples in each watched function and top leaf functions
+"""
+
+TOP = 10
+
+class Stage:
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.laps = {}
+        self.rss = None
+        self.peak_rss = None
+        self.traced_peak = None
+        self.allocations = []
+        self.samples = 0
+        self.watched = Counter()
+        self.leaves = Counter()
+
+    def report(self):
+        report = {'stage': self.name, 'wall_s': round(self.wall, 3), 'cpu_s': round(self.cpu, 3), 'rows': self.rows,
+                  'rows_per_sec': round(self.rows / self.wall, 1) if self.wall > 0 else None,
+                  'rss_mb': self.rss, 'peak_rss_mb': self.peak_rss}
+        if self.laps:
+            report['laps'] = {name: {'wall_s': round(lap[0], 3), 'cpu_s': round(lap[1], 3), 'calls': lap[2]}
+                              for name, lap in self.laps.items()}
+        if self.traced_peak is not None:
+            report['traced_peak_mb'] = self.traced_peak
+            report['top_allocations'] = self.allocations
+        if self.samples:
+            report['profile'] = {'samples': self.samples,
+                                 'watched': {name: round(count / self.samples, 4) for name, count in self.watched.items()},
+                                 'top': [{'function': name, 'share': round(count / self.samples, 4)}
+                                         for name, count in self.leaves.most_common(TOP)]}
+        return report
+
+class Run:
+
+    def __init__(self, name, trace_memory = None, profile = None, interval = None, quiet = False):
+        '''
+        trace_memory, profile (function names) and interval default to the INSTRUMENT_* environment
+        variables, so the scripts stay unchanged to opt in
+        '''
+        self.name = name
+        self.started = datetime.now()
+        self.stages = []
+        self.quiet = quiet
+        self.__start__ = (time.perf_counter(), time.process_time())
+        self.__current__ = None
+        self.__attached__ = {}
+
+        if trace_memory is None:
+            trace_memory = os.environ.get('INSTRUMENT_TRACEMALLOC') == '1'
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        if profile is None:
+            profile = [name for name in os.environ.get('INSTRUMENT_PROFILE', '').split(',') if name]
+        self.__profiler__ = None
+        if profile:
+            interval = interval or float(os.environ.get('INSTRUMENT_INTERVAL', 0.005))
+            self.__profiler__ = SamplingProfiler(self, profile, interval)
+            self.__profiler__.start()
+
+    @contextmanager
+    def stage(self, name, rows = 0):
+        stage = Stage(name)
+        stage.rows = rows
+        self.stages.append(stage)
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+
+        previous = self.__current__
+        self.__current__ = stage
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.wall = time.perf_counter() - wall
+            stage.cpu = time.process_time() - cpu
+            self.__current__ = previous
+
+            stage.rss = _rss_mb()
+            stage.peak_rss = _peak_rss_mb()
+            if self.trace_memory:
+                stage.traced_peak = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+                stage.allocations = _top_allocations(tracemalloc.take_snapshot(), before)
+
+            if not self.quiet:
+                print(f"[{self.name}] {name}: {stage.wall:.1f}s wall, {stage.cpu:.1f}s cpu, {stage.rows} rows"
+                      + (f", {stage.rows / stage.wall:.0f} rows/s" if stage.wall > 0 and stage.rows else '')
+                      + (f", peak rss {stage.peak_rss}MB" if stage.peak_rss is not None else ''))
+
+    @contextmanager
+    def lap(self, name):
+        '''
+        accumulate wall and cpu time of a repeated step into the current stage
+        '''
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.__current__
+            if stage is not None:
+                lap = stage.laps.setdefault(name, [0.0, 0.0, 0])
+                lap[0] += time.perf_counter() - wall
+                lap[1] += time.process_time() - cpu
+                lap[2] += 1
+
+    def attach(self, name, source):
+        '''
+        report source.report() under name in the run report
+        '''
+        self.__attached__[name] = source
+
+    def report(self):
+        wall, cpu = self.__start__
+        report = {'run': self.name, 'started': self.started.isoformat(timespec='seconds'), 'host': socket.gethostname(),
+                'argv': sys.argv, 'python': sys.version.split()[0],
+                'wall_s': round(time.perf_counter() - wall, 3), 'cpu_s': round(time.process_time() - cpu, 3),
+                'peak_rss_mb': _peak_rss_mb(), 'stages': [stage.report() for stage in self.stages]}
+        for name, source in self.__attached__.items():
+            report[name] = source.report()
+        return report
+
+    def save(self, path = None):
+        '''
+        stop the profiler and write the JSON run report
+        '''
+        if self.__profiler__ is not None:
+            self.__profiler__.stop()
+
+        if path is None:
+            directory = os.path.expanduser(os.environ.get('INSTRUMENT_DIR', run_dir))
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{self.name}_{self.started:%Y%m%d_%H%M%S}.json")
+
+        with open(os.path.expanduser(path), 'w') as file:
+            json.dump(self.report(), file, indent=2)
+        if not self.quiet:
+            print(f"[{self.name}] run report {path}")
+        return path
+
+class SamplingProfiler(threading.Thread):
+    '''
+    samples the stack of the thread that created it and counts into the stage open at sample time
+    '''
+
+    def __init__(self, run, functions, interval):
+        super().__init__(daemon=True)
+        self.owner = run
+        self.functions = set(functions)
+        self.interval = interval
+        self.__thread_id__ = threading.get_ident()
+        self.__stop__ = threading.Event()
+
+    def stop(self):
+        self.__stop__.set()
+        self.join()
+
+    def run(self):
+        while not self.__stop__.wait(self.interval):
+            stage = self.owner.__current__
+            frame = sys._current_frames().get(self.__thread_id__)
+            if stage is None or frame is None:
+                continue
+
+            stage.samples += 1
+            code = frame.f_code
+            stage.leaves[f"{os.path.basename(code.co_filename)}:{code.co_name}"] += 1
+
+            seen = set()
+            while frame is not None:
+                name = frame.f_code.co_name
+                if name in self.functions and name not in seen:
+                    stage.watched[name] += 1
+                    seen.add(name)
+                frame = frame.f_back
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as file:
+            return round(int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20, 1)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+
+def _top_allocations(snapshot, before):
+    # not the allocations of tracemalloc and the profiler themselves
+    exclude = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    statistics = snapshot.filter_traces(exclude).compare_to(before.filter_traces(exclude), 'lineno')
+    return [{'where': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+             'size_kb': round(stat.size_diff / 1024, 1), 'count': stat.count_diff}
+            for stat in statistics[:TOP]]
@@ -0,0 +1,189 @@
+import os
+import numpy as np
+import pandas as pd
+
+from graph_arrays import load_ways, load_nodes, load_relations, node_ways, entry_nodes, dirway_allowed
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+intersection geometry and movement conflicts of every node
+
+a leg is a signed entry of node_ways at the node, its bearing points away from the node:
+    start_bearing at the from_node, end_bearing + 180 at the to_node (magnitudes, see ways in way_graph.py)
+a movement is a joint, from the leg -from_way into the node to the leg to_way out of it;
+legs are ranked clockwise by bearing around the node, a leg of rank r has its inbound side at 2r and its
+outbound side at 2r + 1 (right hand traffic); two movements without a common side cross when exactly
+one side of one lies between the sides of the other, clockwise
+
+node (INTERSECTIONS.csv, a row per node index):
+    legs, approaches, exits: entries, entries a dirway may arrive on, entries a dirway may leave on
+    lanes_in, lanes_out: lanes of the approaches and exits
+    min_angle: smallest angle between neighboring legs; skew: largest deviation of an angle between
+        neighboring legs from 360 / legs
+    movements, crossing, merging, diverging: joints and conflicting pairs of them
+movement (MOVEMENTS.csv, a row per joint of JOINTS.csv):
+    turn_angle: -180 to 180, 0 straight, positive to the right
+    turn: straight(0) within TURN_STRAIGHT degrees, right(1), left(2), u_turn(3) beyond TURN_BACK
+    crossing, merging (into the same leg), diverging (out of the same leg): other movements at the node
+the traffic_conflicts of a joint are its crossing + merging
+"""
+
+TURN_STRAIGHT = 30
+TURN_BACK = 150
+
+def leg_bearings(ways, signed):
+    '''
+    bearing [entry] of every leg pointing away from its node
+    '''
+    way = np.abs(signed)
+    start = np.abs(ways['start_bearing'].to_numpy())[way]
+    end = np.abs(ways['end_bearing'].to_numpy())[way]
+    return np.where(signed > 0, start, (end + 180) % 360).astype(np.float64)
+
+def leg_ranks(indptr, bearing):
+    '''
+    clockwise rank [entry] of every leg around its node
+    '''
+    node = entry_nodes(indptr)
+    order = np.lexsort((np.arange(len(bearing)), bearing, node))
+    rank = np.empty(len(bearing), dtype=np.int64)
+    rank[order] = np.arange(len(bearing)) - indptr[node[order]]
+    return rank
+
+def entry_index(indptr, signed, nodes, ways):
+    '''
+    index of the entry of signed way ways at node nodes
+    '''
+    width = 2 * (int(np.abs(signed).max()) if len(signed) else 0) + 3
+    keys = entry_nodes(indptr) * width + signed + width // 2
+    order = np.argsort(keys, kind='stable')
+    query = np.asarray(nodes, dtype=np.int64) * width + np.asarray(ways, dtype=np.int64) + width // 2
+    return order[np.searchsorted(keys, query, sorter=order)]
+
+def movement_conflicts(ways, indptr, signed, joints):
+    '''
+    DataFrame [joint] of turn_angle, turn, crossing, merging and diverging; joints: from_way, via_node, to_way
+    '''
+    via_node = joints['via_node'].to_numpy(dtype=np.int64)
+    in_entry = entry_index(indptr, signed, via_node, -joints['from_way'].to_numpy(dtype=np.int64))
+    out_entry = entry_index(indptr, signed, via_node, joints['to_way'].to_numpy(dtype=np.int64))
+
+    bearing = leg_bearings(ways, signed)
+    # heading into the node is the in leg bearing + 180, the turn is the out leg bearing less it
+    turn_angle = (bearing[out_entry] - bearing[in_entry]) % 360 - 180
+    turn = np.select([np.abs(turn_angle) <= TURN_STRAIGHT, np.abs(turn_angle) > TURN_BACK, turn_angle > 0],
+                     [0, 3, 1], 2)
+
+    rank = leg_ranks(indptr, bearing)
+    degree = np.diff(indptr)[via_node]
+    first, second = _node_pairs(via_node)
+    a, b = 2 * rank[in_entry[first]], 2 * rank[out_entry[first]] + 1
+    c, d = 2 * rank[in_entry[second]], 2 * rank[out_entry[second]] + 1
+    n = 2 * degree[first]
+
+    merging = (b == d) & (a != c)
+    diverging = (a == c) & (b != d)
+    crossing = (a != c) & (b != d) & (_between(a, b, c, n) != _between(a, b, d, n))
+
+    count = lambda pairs: np.bincount(first[pairs], minlength=len(joints)).astype(np.int64)
+    return pd.DataFrame({'turn_angle': np.round(turn_angle).astype(np.int64), 'turn': turn.astype(np.int64),
+                         'crossing': count(crossing), 'merging': count(merging), 'diverging': count(diverging)})
+
+def node_geometry(ways, indptr, signed):
+    '''
+    DataFrame [node] of legs, approaches, exits, lanes_in, lanes_out, min_angle and skew
+    '''
+    n_nodes = len(indptr) - 1
+    node = entry_nodes(indptr)
+    legs = np.diff(indptr)
+    oneway = ways['oneway'].to_numpy()
+
+    arriving = dirway_allowed(oneway, -signed)
+    leaving = dirway_allowed(oneway, signed)
+    forward_lanes, backward_lanes = _lanes(ways)
+    way = np.abs(signed)
+    # arriving on the forward dirway at the to_node (entry negative)
+    lanes_in = np.where(signed < 0, forward_lanes[way], backward_lanes[way]) * arriving
+    lanes_out = np.where(signed > 0, forward_lanes[way], backward_lanes[way]) * leaving
+
+    bearing = leg_bearings(ways, signed)
+    order = np.lexsort((bearing, node))
+    sorted_bearing = bearing[order]
+    sorted_node = node[order]
+    gap = np.empty(len(order))
+    gap[:-1] = sorted_bearing[1:] - sorted_bearing[:-1]
+    # the last leg of a node closes the circle to its first
+    last = np.append(sorted_node[1:] != sorted_node[:-1], True) if len(order) else np.zeros(0, dtype=bool)
+    gap[last] = sorted_bearing[indptr[sorted_node[last]]] + 360 - sorted_bearing[last]
+
+    min_angle = np.full(n_nodes, 360.0)
+    np.minimum.at(min_angle, sorted_node, gap)
+    skew = np.zeros(n_nodes)
+    np.maximum.at(skew, sorted_node, np.abs(gap - 360 / np.maximum(legs[sorted_node], 1)))
+
+    return pd.DataFrame({'legs': legs,
+                         'approaches': np.bincount(node, weights=arriving, minlength=n_nodes).astype(np.int64),
+                         'exits': np.bincount(node, weights=leaving, minlength=n_nodes).astype(np.int64),
+                         'lanes_in': np.bincount(node, weights=lanes_in, minlength=n_nodes).astype(np.int64),
+                         'lanes_out': np.bincount(node, weights=lanes_out, minlength=n_nodes).astype(np.int64),
+                         'min_angle': np.round(np.where(legs > 1, min_angle, 0)).astype(np.int64),
+                         'skew': np.round(np.where(legs > 1, skew, 0)).astype(np.int64)})
+
+def intersection_features(ways, nodes, joints):
+    '''
+    (node features, movement features) of a whole state, see the layout above
+    '''
+    indptr, signed = node_ways(nodes)
+    movements = movement_conflicts(ways, indptr, signed, joints)
+    features = node_geometry(ways, indptr, signed)
+
+    via_node = joints['via_node'].to_numpy(dtype=np.int64)
+    features['movements'] = np.bincount(via_node, minlength=len(features)).astype(np.int64)
+    # every conflicting pair is counted at both of its movements
+    for column in ['crossing', 'merging', 'diverging']:
+        features[column] = np.bincount(via_node, weights=movements[column], minlength=len(features)).astype(np.int64) // 2
+    return features, movements
+
+def _node_pairs(via_node):
+    '''
+    (first, second) joint indexes of all ordered pairs of different joints at the same node
+    '''
+    order = np.argsort(via_node, kind='stable')
+    nodes, start, counts = np.unique(via_node[order], return_index=True, return_counts=True)
+    pair_counts = counts * counts
+    group = np.repeat(np.arange(len(nodes)), pair_counts)
+    offset = np.arange(pair_counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    first = order[start[group] + offset // counts[group]]
+    second = order[start[group] + offset % counts[group]]
+    different = first != second
+    return first[different], second[different]
+
+def _between(a, b, r, n):
+    # r strictly inside the clockwise arc from a to b of n ranks
+    return ((r - a) % n > 0) & ((r - a) % n < (b - a) % n)
+
+def _lanes(ways):
+    '''
+    lanes of the forward and backward dirway of every way, from lane_count when not counted by direction
+    '''
+    oneway = ways['oneway'].to_numpy()
+    total = np.abs(ways['lane_count'].to_numpy())
+    shared = np.maximum(np.where(oneway == 0, total // 2, total), 1)
+    forward = np.where(ways['forward_lane_count'].to_numpy() > 0, ways['forward_lane_count'].to_numpy(), shared)
+    backward = np.where(ways['backward_lane_count'].to_numpy() > 0, ways['backward_lane_count'].to_numpy(), shared)
+    return forward, backward
+
+if __name__ == '__main__':
+    from joints import build_joints
+
+    ways = load_ways(gnn_dir, state)
+    nodes = load_nodes(gnn_dir, state)
+    joints = build_joints(ways, nodes, load_relations(gnn_dir, state))
+
+    features, movements = intersection_features(ways, nodes, joints)
+    features.to_csv(os.path.join(gnn_dir, f"{state}/INTERSECTIONS.csv"), index=False)
+    movements.to_csv(os.path.join(gnn_dir, f"{state}/MOVEMENTS.csv"), index=False)
+    crossing = features[features['crossing'] > 0]
+    print(f"{len(crossing)} of {len(features)} nodes with crossing movements, {features['crossing'].sum()} crossings")
@@ -0,0 +1,98 @@
+import os
+import numpy as np
+import pandas as pd
+
+from graph_arrays import load_ways, load_nodes, load_relations, node_ways, transitions
+from relation_index import RelationIndex, build_relation_index
+from intersections import movement_conflicts
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+joints: legal dirway to dirway transitions through a node, see joints in way_graph.py
+    from_way, to_way: signed way index, forward is positive, backward is negative
+    via_node: node index
+    length: half of from_way and to_way lengths, the distance between their middles
+    slope: slope_up - slope_down of to_way in the direction of travel, magnitudes
+    connected_lanes: lane_connectivity(3) value of the transition, 0 if none
+    traffic_control: no_sign(0), signal(1), stop(2), yield(3), railway_crossing(4), merge(5), branch(6)
+    restriction: value of a timed restriction(1) on the transition, 0 if none
+    barrier: barrier(2) value at via_node when arriving from from_way, 0 if none
+    traffic_conflicts: other joints at via_node crossing or merging with it, see intersections.py
+
+restrictions that are not timed remove the transition; merge and branch are oneway ways only meeting
+oneway ways, e.g. ramps, with several ways into the to_way (merge) or out of the from_way (branch)
+"""
+
+CONTROLS = {'signal': 1, 'stop': 2, 'yield': 3, 'railway_crossing': 4, 'merge': 5, 'branch': 6}
+
+def build_joints(ways, nodes, relations):
+    '''
+    ways, nodes, relations: DataFrames of WAYS.csv, NODES.csv and RELATIONS.csv, or a RelationIndex
+    '''
+    if not isinstance(relations, RelationIndex):
+        relations = build_relation_index(relations, len(nodes), len(ways))
+
+    oneway = ways['oneway'].to_numpy()
+    indptr, signed = node_ways(nodes)
+    from_dirway, via_node, to_dirway = transitions(indptr, signed, oneway)
+    from_way = np.abs(from_dirway)
+    to_way = np.abs(to_dirway)
+
+    restriction = relations.lookup(1, from_way, via_node, to_way)
+    legal = restriction <= 0
+    from_dirway, via_node, to_dirway = from_dirway[legal], via_node[legal], to_dirway[legal]
+    from_way, to_way, restriction = from_way[legal], to_way[legal], restriction[legal]
+
+    length = ways['length'].to_numpy()
+    slope = np.abs(ways['slope_up'].to_numpy()) - np.abs(ways['slope_down'].to_numpy())
+
+    joints = pd.DataFrame({'from_way': from_dirway, 'via_node': via_node, 'to_way': to_dirway})
+    joints['length'] = np.round((length[from_way] + length[to_way]) / 2).astype(np.int64)
+    joints['slope'] = np.where(to_dirway > 0, slope[to_way], -slope[to_way])
+    joints['connected_lanes'] = relations.lookup(3, from_way, via_node, to_way)
+    joints['traffic_control'] = _traffic_control(joints, oneway, relations, from_way, to_way)
+    joints['restriction'] = restriction.astype(np.int64)
+    joints['barrier'] = relations.lookup(2, from_way, via_node, to_way).astype(np.int64)
+
+    conflicts = movement_conflicts(ways, indptr, signed, joints)
+    joints['traffic_conflicts'] = conflicts['crossing'] + conflicts['merging']
+    return joints
+
+def _traffic_control(joints, oneway, relations, from_way, to_way):
+    via_node = joints['via_node'].to_numpy()
+    control = relations.lookup(4, from_way, via_node, to_way).astype(np.int64)
+
+    # signals and railway crossings may only be tagged at the node, stops and yields there are left out
+    # before reducing; a railway crossing (4) goes before a signal (1)
+    nodes, inverse = np.unique(via_node, return_inverse=True)
+    indptr, node_relations = relations.at_nodes(nodes, 4)
+    value = relations.value[node_relations].astype(np.int64)
+    node_control = np.zeros(len(nodes), dtype=np.int64)
+    np.maximum.at(node_control, np.repeat(np.arange(len(nodes)), np.diff(indptr)),
+                  np.where((value == 1) | (value == 4), value, 0))
+    control = np.where(control > 0, control, node_control[inverse])
+
+    # oneway ways only meeting oneway ways
+    node_twoway = pd.Series(np.concatenate([oneway[from_way] == 0, oneway[to_way] == 0])).groupby(
+        np.concatenate([via_node, via_node])).any()
+    oneway_only = ~node_twoway.reindex(via_node).to_numpy()
+
+    into = joints.groupby(['via_node', 'to_way'])['from_way'].transform('size').to_numpy()
+    out_of = joints.groupby(['via_node', 'from_way'])['to_way'].transform('size').to_numpy()
+
+    free = (control == 0) & oneway_only
+    control[free & (into > 1)] = CONTROLS['merge']
+    control[free & (into == 1) & (out_of > 1)] = CONTROLS['branch']
+    return control
+
+if __name__ == '__main__':
+    ways = load_ways(gnn_dir, state)
+    nodes = load_nodes(gnn_dir, state)
+    relations = load_relations(gnn_dir, state)
+
+    joints = build_joints(ways, nodes, relations)
+    joints.to_csv(os.path.join(gnn_dir, f"{state}/JOINTS.csv"), index=False)
+
+    print(f"built {joints.shape[0]} joints at {joints['via_node'].nunique()} nodes")
@@ -0,0 +1,121 @@
+import time
+import threading
+import numpy as np
+import requests
+from collections import Counter
+from contextlib import contextmanager
+
+"""
+telemetry of the map matching and search requests of matching.py and 3_extract_nv_aadt.py
+
+telemetry = MatchTelemetry()
+response = telemetry.get(MATCHING_URL, params)      # requests.get, timed with its HTTP status
+telemetry.point(probes, score, early_exit)          # one match_point: requests made, final score,
+                                                    #   stopped before the last probe at score > 99
+with telemetry.item():                              # requests made for an item, e.g. both vehicles
+    match_maneuver(crash)                           #   of a crash
+telemetry.grade(aadt['matched'])
+run.attach('matching', telemetry)                   # report() in the run report of instrument.py
+
+a histogram: {edges, counts, count, mean, p50, p90, p99, max}, counts[i] of values in [edges[i-1], edges[i]),
+    counts[0] below edges[0] and counts[-1] at or above edges[-1]; quantiles from the values themselves
+"""
+
+LATENCY_EDGES = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000] # ms
+PROBE_EDGES = list(range(1, 11))
+SCORE_EDGES = list(range(0, 101, 5))
+
+class Histogram:
+
+    def __init__(self, edges):
+        self.edges = list(edges)
+        self.values = []
+
+    def add(self, value):
+        self.values.append(float(value))
+
+    def report(self):
+        values = np.asarray(self.values)
+        counts = np.bincount(np.searchsorted(self.edges, values, side='right'), minlength=len(self.edges) + 1)
+        report = {'edges': self.edges, 'counts': counts.tolist(), 'count': len(values)}
+        if len(values):
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            report.update({'mean': round(float(values.mean()), 3), 'p50': round(float(p50), 3),
+                           'p90': round(float(p90), 3), 'p99': round(float(p99), 3),
+                           'max': round(float(values.max()), 3)})
+        return report
+
+class MatchTelemetry:
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_EDGES)
+        self.status = Counter()
+        self.probes = Histogram(PROBE_EDGES)
+        self.item_probes = Histogram(PROBE_EDGES + [12, 16, 20])
+        self.scores = Histogram(SCORE_EDGES)
+        self.grades = Counter()
+        self.points = 0
+        self.early_exits = 0
+        self.__lock__ = threading.Lock()
+        self.__items__ = threading.local()
+
+    def get(self, url, params):
+        '''
+        requests.get timed; status is the HTTP status code, or the exception name if none came back
+        '''
+        start = time.perf_counter()
+        try:
+            response = requests.get(url = url, params = params)
+        except requests.RequestException as error:
+            self.__request__(time.perf_counter() - start, type(error).__name__)
+            raise
+
+        self.__request__(time.perf_counter() - start, response.status_code)
+        return response
+
+    def point(self, probes, score, early_exit):
+        with self.__lock__:
+            self.points += 1
+            self.early_exits += bool(early_exit)
+            self.probes.add(probes)
+            self.scores.add(score)
+
+    @contextmanager
+    def item(self):
+        '''
+        count the requests made inside, by this thread, into one item
+        '''
+        self.__items__.requests = 0
+        try:
+            yield
+        finally:
+            probes = self.__items__.requests
+            self.__items__.requests = None
+            with self.__lock__:
+                self.item_probes.add(probes)
+
+    def grade(self, matched):
+        with self.__lock__:
+            self.grades[str(matched)] += 1
+
+    def report(self):
+        with self.__lock__:
+            requests_made = len(self.latency.values)
+            return {'requests': requests_made,
+                    'errors': sum(count for status, count in self.status.items()
+                                  if not (isinstance(status, int) and status < 400)),
+                    'status': {str(status): count for status, count in self.status.items()},
+                    'latency_ms': self.latency.report(),
+                    'points': self.points,
+                    'early_exit_rate': round(self.early_exits / self.points, 4) if self.points else None,
+                    'probes_per_point': self.probes.report(),
+                    'probes_per_item': self.item_probes.report(),
+                    'scores': self.scores.report(),
+                    'grades': dict(sorted(self.grades.items()))}
+
+    def __request__(self, seconds, status):
+        if getattr(self.__items__, 'requests', None) is not None:
+            self.__items__.requests += 1
+        with self.__lock__:
+            self.latency.add(seconds * 1000)
+            self.status[status] += 1
@@ -1,5 +1,9 @@
+import os
+import threading
+import numpy as np
 import pandas as pd
-import requests
+
+from match_telemetry import MatchTelemetry
 
 DIRS = ['S', 'E', 'N', 'W']
 OFFSET = 0.0002
@@ -24,6 +28,9 @@ def point_from_dir(dir, to_point):
 
 MATCHING_URL = 'http://10.230.31.156:9080/api/v2/map-match/match?'
 
+# requests, probes and scores of this process, attached to the run report by 2_extract_nv_crashes.py
+telemetry = MatchTelemetry()
+
 def get_route_dir(road_names):
     for road_name in road_names:
        if road_name['type'] == 'ROUTE_NUMBER':
@@ -45,7 +52,7 @@ def match_line(points, dir = False):
         # 'multiplePath':'true'    
     }
     
-    response = requests.get(url = MATCHING_URL, params = matching_params)
+    response = telemetry.get(MATCHING_URL, matching_params)
     if not response.ok:
         return (0, 0, 0)
     
@@ -66,35 +73,210 @@ def match_line(points, dir = False):
 
     return (matchingPath['confidence'], way_ids[-1], dirs[-1])
 
-def match_point(to_point, dir = None):
-    if dir:
-        from_point = point_from_dir(dir, to_point)
-        score, way_id, _ = match_line([from_point, to_point])
-    else:
-        score = 0
-        
-    if score < 99:
-        for devi in DEVIS:
+def match_trace(points):
+    '''
+    way ids of the best matching path of a trace, in driving order
+    '''
+    coordinates = ''
+    for point in points:
+        coordinates += '{},{};'.format(point[0], point[1])
+
+    response = telemetry.get(MATCHING_URL, {'coordinate': coordinates, 'wayField': 'basic'})
+    if not response.ok:
+        return []
+    
+    data = response.json()
+    if data['matched'] == 0:
+        return []
+
+    return [nav_way['wayId'] for nav_way in data['matchingResult'][0]['matchingPath'][0]['navWay']]
+
+# the DEVIS offset of the directional probe of point_from_dir
+DIR_DEVI = {dir: DEVIS.index(list(point_from_dir(dir, (0, 0)))) for dir in DIRS}
+PRIOR_WEIGHT = 8
+AXIS_SECTOR = 45 # degrees of a road axis sector, axes are 0-180
+
+class ProbeOrder:
+    '''
+    order of the DEVIS offsets for match_point: a prior from the reported direction (offsets behind the
+    vehicle first) and the road of the directional probe (offsets along it first), blended with how often
+    each offset won before for the same (direction, road) pair
+
+    the road is the axis of the bearing of the matched way (start_bearing of WAYS.csv given to
+    set_bearings) in AXIS_SECTOR sectors; the matching service returns no bearing, so without bearings,
+    or for a way not in them, it is the direction suffix of the way's ROUTE_NUMBER name, or unknown
+
+    the order decides which ambiguous probes _scan sees before a score over 99 stops it, so it can change
+    results: adaptive (MATCH_ADAPTIVE_ORDER=1) is off by default, the order is DEVIS then and match_point
+    returns what it always did; to measure agreement and requests saved, every compare_every points
+    (MATCH_COMPARE_EVERY, off by default) the DEVIS order is replayed on the same point, which requests the
+    probes the adaptive order skipped
+    '''
+
+    def __init__(self, adaptive = None, prior = PRIOR_WEIGHT, compare_every = None):
+        if adaptive is None:
+            adaptive = os.environ.get('MATCH_ADAPTIVE_ORDER') == '1'
+        self.adaptive = adaptive
+        self.prior = prior
+        if compare_every is None:
+            compare_every = int(os.environ.get('MATCH_COMPARE_EVERY', 0))
+        self.compare_every = compare_every
+        self.bearings = {}
+        self.wins = {}
+        self.points = 0
+        self.requests = 0
+        self.exhaustive = 0
+        self.compared = 0
+        self.fixed_requests = 0
+        self.compared_requests = 0
+        self.agreed = 0
+        self.__lock__ = threading.Lock()
+
+    def set_bearings(self, way_ids, bearings):
+        '''
+        bearings (degrees) of way ids, e.g. WAYS.csv way_id and the magnitude of start_bearing
+        '''
+        self.bearings = dict(zip(np.asarray(way_ids).tolist(), np.abs(np.asarray(bearings, dtype=np.float64)).tolist()))
+
+    def road(self, way_id, route_dir):
+        '''
+        ('axis', sector) of the way bearing, else ('route', route_dir), None if neither is known
+        '''
+        bearing = self.bearings.get(way_id)
+        if bearing is not None:
+            return ('axis', int(round((bearing % 180) / AXIS_SECTOR)) % (180 // AXIS_SECTOR))
+        if route_dir in DIR_DEVI:
+            return ('route', route_dir)
+        return None
+
+    def order(self, dir, road):
+        if not self.adaptive:
+            return list(range(len(DEVIS)))
+
+        weights = _prior(dir, road)
+        with self.__lock__:
+            wins = self.wins.get((dir, road))
+            if wins is not None:
+                weights = (wins + self.prior * weights) / (wins.sum() + self.prior)
+        return [int(index) for index in np.argsort(-weights, kind='stable')]
+
+    def update(self, dir, road, winner, requests):
+        '''
+        winner: the offset of the returned way, None if nothing matched
+        '''
+        with self.__lock__:
+            self.points += 1
+            self.requests += requests
+            self.exhaustive += len(DEVIS) + bool(dir)
+            if winner is not None:
+                wins = self.wins.setdefault((dir, road), np.zeros(len(DEVIS)))
+                wins[winner] += 1
+            return self.compare_every > 0 and self.points % self.compare_every == 0
+
+    def compare(self, fixed_requests, requests, agreed):
+        with self.__lock__:
+            self.compared += 1
+            self.fixed_requests += fixed_requests
+            self.compared_requests += requests
+            self.agreed += bool(agreed)
+
+    def report(self):
+        with self.__lock__:
+            report = {'adaptive': self.adaptive, 'points': self.points,
+                      'requests_per_point': round(self.requests / self.points, 3) if self.points else None,
+                      'saved_vs_all_probes': round((self.exhaustive - self.requests) / self.points, 3) if self.points else None,
+                      'compared': self.compared}
+            if self.compared:
+                report['saved_vs_devis_order'] = round((self.fixed_requests - self.compared_requests) / self.compared, 3)
+                report['agreement'] = round(self.agreed / self.compared, 4)
+            return report
+
+def _prior(dir, road):
+    # DEVIS offsets are (lat, lon), a bearing b points along (cos b, sin b)
+    units = np.asarray(DEVIS) / np.linalg.norm(DEVIS, axis=1)[:, None]
+    weights = np.ones(len(DEVIS))
+    if dir in DIR_DEVI:
+        # 1 + cosine, an offset opposite the reported one still keeps a little weight
+        weights *= 1.05 + units @ units[DIR_DEVI[dir]]
+    if road is not None:
+        if road[0] == 'axis':
+            angle = np.radians(road[1] * AXIS_SECTOR)
+            axis = np.array([np.cos(angle), np.sin(angle)])
+        else:
+            axis = units[DIR_DEVI[road[1]]]
+        weights *= 0.5 + np.abs(units @ axis)
+    return weights / weights.sum()
+
+def _scan(dir, score, way_id, winner, order, probe):
+    '''
+    the scoring rules of match_point over the offsets in order, probe(index) -> match_line of the offset;
+    (score, way_id, winning offset, early exit)
+    '''
+    for position, index in enumerate(order):
+        score_, way_id_, dir_ = probe(index)
+        if dir_ == dir:
+            score_ += 1.5
+
+        if score_ < 90:
+            continue
+        elif abs(score - score_) < 1:
+            score = 0
+        elif score_ > score:
+            score = score_
+            way_id = way_id_
+            winner = index
+
+        if score > 99:
+            return (score, way_id, winner, position < len(order) - 1)
+
+    return (score, way_id, winner, False)
+
+# shared by the match_point calls of this process, reported with telemetry by 2_extract_nv_crashes.py
+probe_order = ProbeOrder()
+
+def match_point(to_point, dir = None, order = None):
+    '''
+    way id matched at to_point with a score of 98 or more, else 0; every probe is requested at most once,
+    the directional probe is the DEVIS offset of dir
+    '''
+    order = probe_order if order is None else order
+    responses = {}
+
+    def probe(index):
+        if index not in responses:
+            devi = DEVIS[index]
             from_point = (to_point[0] + devi[0], to_point[1] + devi[1])
-            score_, way_id_, dir_ = match_line([from_point, to_point], True)
-            if dir_ == dir:
-                score_ += 1.5
-            
-            if score_ < 90:
-                continue
-            elif abs(score - score_) < 1:
-                score = 0
-            elif score_ > score:
-                score = score_
-                way_id = way_id_
-
-            if score > 99:
-                break
-        
-    if score >= 98:
-        return way_id
-    else:
-        return 0
+            responses[index] = match_line([from_point, to_point], True)
+        return responses[index]
+
+    def decide(offsets, fetch):
+        score, way_id, winner, road = 0, 0, None, None
+        if dir:
+            winner = DIR_DEVI[dir]
+            score, way_id, route_dir = fetch(winner)
+            road = order.road(way_id, route_dir)
+
+        early_exit = score >= 99
+        if score < 99:
+            score, way_id, winner, early_exit = _scan(dir, score, way_id, winner, offsets(road), fetch)
+        return (score, way_id, winner, road, early_exit)
+
+    score, way_id, winner, road, early_exit = decide(lambda road: order.order(dir, road), probe)
+    requests = len(responses)
+    telemetry.point(requests, score, early_exit)
+    matched = way_id if score >= 98 else 0
+
+    if order.update(dir, road, winner if matched else None, requests):
+        # the same point in DEVIS order; the original match_point sent a request per probe, the directional
+        # one and its DEVIS twin both, so every call counts; probes already made are reused here
+        calls = []
+        def replay(index):
+            calls.append(index)
+            return probe(index)
+        fixed_score, fixed_way_id, _, _, _ = decide(lambda road: list(range(len(DEVIS))), replay)
+        order.compare(len(calls), requests, (fixed_way_id if fixed_score >= 98 else 0) == matched)
+
+    return matched
 
 def match_maneuver(crash):
     to_point = (crash['lat'], crash['lon'])
@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import ast
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+"""
+pipeline runner of the extraction scripts and the steps after them
+
+a stage runs a script of this directory with parameters in environment variables:
+    PIPELINE_DATA_DIR   ~/data
+    PIPELINE_STATE      NV
+    PIPELINE_YEAR       crash and weather year
+    PIPELINE_MAP        map version, {data_dir}/{map}, e.g. HERE-24Q2
+
+inputs and outputs are paths under the data directory with {state}, {year} and {map} filled in;
+a stage needs the stages writing its inputs, and is skipped when its outputs exist and the content
+hashes of its inputs, its script, the modules of this directory the script imports (directly or through
+each other) and its parameters are those of its last successful run; the record of a stage is saved
+as soon as it finishes
+
+run records at {data_dir}/.pipeline/{state}.json: {stage: {'fingerprint': sha256, 'seconds': s, 'finished': iso time}}
+file hashes are cached by (size, mtime) in {data_dir}/.pipeline/hashes.json, a directory input hashes all its files
+"""
+
+def local_modules(script, directory = None):
+    '''
+    paths of script and the modules of directory (this one by default) it imports, directly or through them
+    '''
+    directory = directory or os.path.dirname(os.path.abspath(__file__))
+    paths = []
+    pending = [os.path.join(directory, script)]
+    while pending:
+        path = pending.pop()
+        if path in paths or not os.path.isfile(path):
+            continue
+        paths.append(path)
+        with open(path) as file:
+            tree = ast.parse(file.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            pending += [os.path.join(directory, name.split('.')[0] + '.py') for name in names]
+    return sorted(paths)
+
+class Stage:
+
+    def __init__(self, name, script, inputs = (), outputs = (), params = ('state',)):
+        self.name = name
+        self.script = script
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = list(params)
+
+STAGES = [
+    Stage('ways', '1_extract_ways.py',
+          ['{map}/{state}/WAYS', '{map}/{state}/RELATIONS', '{map}/{state}/RELATION_MEMBERS'],
+          ['GNN/{state}/WAYS.csv', 'GNN/{state}/POLYLINES.csv', 'GNN/{state}/NODES.csv',
+           'GNN/{state}/STATIONS.csv', 'GNN/{state}/RELATIONS.csv'], ['state', 'map']),
+    Stage('crashes', '2_extract_nv_crashes.py',
+          ['CRASH/{state}/Crash_2016-2020.csv', 'GNN/{state}/WAYS.csv'],
+          ['GNN/{state}/CRASHES.csv', 'GNN/{state}/CRASH_COUNTS/counts.json'], ['state', 'year']),
+    Stage('aadts', '3_extract_nv_aadt.py',
+          ['AADT/{state}/{state}_AADT.csv'], ['GNN/{state}/AADTS.csv']),
+    Stage('weather', '4_extract_nv_weather.py',
+          ['GNN/{state}/STATIONS.csv'], ['WEATHER'], ['state', 'year']),
+    Stage('snapshots', 'snapshots.py',
+          ['GNN/{state}/WAYS.csv', 'GNN/{state}/NODES.csv', 'GNN/{state}/STATIONS.csv', 'GNN/{state}/CRASHES.csv',
+           'WEATHER'],
+          ['GNN/{state}/SNAPSHOTS_{year}/snapshots.json'], ['state', 'year']),
+    Stage('joints', 'joints.py',
+          ['GNN/{state}/WAYS.csv', 'GNN/{state}/NODES.csv', 'GNN/{state}/RELATIONS.csv'], ['GNN/{state}/JOINTS.csv']),
+    Stage('crash_labels', 'crash_labels.py',
+          ['GNN/{state}/WAYS.csv', 'GNN/{state}/CRASHES.csv'],
+          ['GNN/{state}/LABELS_MONTH.npz', 'GNN/{state}/LABELS_HOUR_OF_WEEK.npz']),
+    Stage('aadt_store', 'aadt_store.py',
+          ['GNN/{state}/WAYS.csv', 'GNN/{state}/AADTS.csv'], ['GNN/{state}/AADT/aadt.npy']),
+    Stage('aadt_propagation', 'aadt_propagation.py',
+          ['GNN/{state}/AADT/aadt.npy', 'GNN/{state}/WAYS.csv', 'GNN/{state}/NODES.csv'],
+          ['GNN/{state}/AADT/estimate.npy']),
+    Stage('distances', 'distance_features.py',
+          ['GNN/{state}/WAYS.csv', 'GNN/{state}/NODES.csv', 'GNN/{state}/RELATIONS.csv'], ['GNN/{state}/DISTANCES.csv']),
+    Stage('contraction', 'contraction.py',
+          ['GNN/{state}/WAYS.csv', 'GNN/{state}/NODES.csv', 'GNN/{state}/RELATIONS.csv', 'GNN/{state}/POLYLINES.csv'],
+          ['GNN/{state}/CONTRACTED/WAYS.csv', 'GNN/{state}/CONTRACTED/contraction.npz']),
+    Stage('hotspots', 'hotspots.py',
+          ['GNN/{state}/WAYS.csv', 'GNN/{state}/POLYLINES.csv', 'GNN/{state}/CRASHES.csv'],
+          ['GNN/{state}/HOTSPOTS.csv', 'GNN/{state}/BLACKSPOTS.csv']),
+    Stage('intersections', 'intersections.py',
+          ['GNN/{state}/WAYS.csv', 'GNN/{state}/NODES.csv', 'GNN/{state}/RELATIONS.csv'],
+          ['GNN/{state}/INTERSECTIONS.csv', 'GNN/{state}/MOVEMENTS.csv']),
+    Stage('crash_rates', 'crash_rates.py',
+          ['GNN/{state}/WAYS.csv', 'GNN/{state}/AADT/estimate.npy', 'GNN/{state}/CRASHES.csv',
+           'GNN/{state}/CRASH_COUNTS/counts.json'],
+          ['GNN/{state}/RATES.csv', 'GNN/{state}/RATE_PRIORS.csv']),
+]
+
+class Pipeline:
+
+    def __init__(self, stages = STAGES, data_dir = "~/data", state = 'NV', year = 2019, map_version = 'HERE-24Q2',
+                 workers = 4):
+        self.stages = {stage.name: stage for stage in stages}
+        self.data_dir = os.path.expanduser(data_dir)
+        self.values = {'state': state, 'year': str(year), 'map': map_version}
+        self.workers = workers
+
+        self.__record_dir__ = os.path.join(self.data_dir, '.pipeline')
+        self.__records__ = self.__load__(f"{state}.json")
+        self.__hashes__ = self.__load__('hashes.json')
+
+    def path(self, pattern):
+        return os.path.join(self.data_dir, pattern.format(**self.values))
+
+    def dependencies(self, stage):
+        '''
+        stages writing an input of stage
+        '''
+        inputs = {self.path(path) for path in stage.inputs}
+        return [other.name for other in self.stages.values()
+                if other is not stage and inputs & {self.path(path) for path in other.outputs}]
+
+    def fingerprint(self, stage):
+        digest = hashlib.sha256()
+        digest.update(json.dumps({param: self.values[param] for param in stage.params}, sort_keys=True).encode())
+        for path in local_modules(stage.script) + [self.path(path) for path in stage.inputs]:
+            digest.update(path.encode())
+            digest.update(self.file_hash(path).encode())
+        return digest.hexdigest()
+
+    def file_hash(self, path):
+        '''
+        sha256 of a file read in blocks, cached while its size and mtime stay the same; of a directory,
+        sha256 of the relative paths and hashes of its files; '' if missing
+        '''
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for root, directories, files in os.walk(path):
+                directories.sort()
+                for name in sorted(files):
+                    file = os.path.join(root, name)
+                    digest.update(os.path.relpath(file, path).encode())
+                    digest.update(self.file_hash(file).encode())
+            return digest.hexdigest()
+        if not os.path.isfile(path):
+            return ''
+
+        status = os.stat(path)
+        key = f"{status.st_size}:{status.st_mtime_ns}"
+        cached = self.__hashes__.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        self.__hashes__[path] = [key, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def up_to_date(self, stage):
+        record = self.__records__.get(stage.name)
+        return (record is not None and all(os.path.exists(self.path(path)) for path in stage.outputs)
+                and record['fingerprint'] == self.fingerprint(stage))
+
+    def run(self, only = None, force = (), dry_run = False):
+        '''
+        run the stages in only (all by default) and the stages they need, independent ones concurrently;
+        returns {stage: 'ran', 'skipped', 'failed' or 'blocked'}
+        '''
+        selected = self.__closure__(only or list(self.stages))
+        needs = {name: set(self.dependencies(self.stages[name])) & selected for name in selected}
+        status = {}
+        running = {}
+        os.makedirs(self.__record_dir__, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while len(status) < len(selected):
+                for name in sorted(selected - set(status) - set(running)):
+                    if any(status.get(need) in ('failed', 'blocked') for need in needs[name]):
+                        status[name] = 'blocked'
+                        print(f"[pipeline] {name}: blocked")
+                    elif all(status.get(need) in ('ran', 'skipped') for need in needs[name]):
+                        # an input rewritten with the same content still skips the stage
+                        stage = self.stages[name]
+                        if name not in force and self.up_to_date(stage):
+                            status[name] = 'skipped'
+                            print(f"[pipeline] {name}: up to date")
+                        elif dry_run:
+                            status[name] = 'ran'
+                            print(f"[pipeline] {name}: would run {stage.script}")
+                        else:
+                            running[name] = executor.submit(self.__execute__, stage)
+
+                if not running:
+                    continue
+                done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                for name in [name for name, future in running.items() if future in done]:
+                    seconds = running.pop(name).result()
+                    status[name] = 'failed' if seconds is None else 'ran'
+                    if seconds is not None:
+                        # fingerprinted after the run, the inputs may have been written by a stage before;
+                        # saved per stage, so an interrupted run keeps the stages it finished
+                        self.__records__[name] = {'fingerprint': self.fingerprint(self.stages[name]),
+                                                  'seconds': round(seconds, 1),
+                                                  'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                        self.__save_records__()
+
+        self.__save_records__()
+        return status
+
+    def __closure__(self, names):
+        selected = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise KeyError(f"unknown stage {name}")
+            if name not in selected:
+                selected.add(name)
+                pending += self.dependencies(self.stages[name])
+        return selected
+
+    def __execute__(self, stage):
+        print(f"[pipeline] {stage.name}: running {stage.script}")
+        env = dict(os.environ, PIPELINE_DATA_DIR=self.data_dir, PIPELINE_STATE=self.values['state'],
+                   PIPELINE_YEAR=self.values['year'], PIPELINE_MAP=self.values['map'])
+        directory = os.path.dirname(os.path.abspath(__file__))
+        start = time.perf_counter()
+        with open(os.path.join(self.__record_dir__, f"{self.values['state']}_{stage.name}.log"), 'w') as log:
+            result = subprocess.run([sys.executable, stage.script], cwd=directory, env=env, stdout=log,
+                                    stderr=subprocess.STDOUT)
+        seconds = time.perf_counter() - start
+
+        if result.returncode != 0:
+            print(f"[pipeline] {stage.name}: failed after {seconds:.1f}s, see {log.name}")
+            return None
+
+        print(f"[pipeline] {stage.name}: done in {seconds:.1f}s")
+        return seconds
+
+    def __save_records__(self):
+        self.__save__(f"{self.values['state']}.json", self.__records__)
+        self.__save__('hashes.json', self.__hashes__)
+
+    def __load__(self, name):
+        path = os.path.join(self.__record_dir__, name)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            return json.load(file)
+
+    def __save__(self, name, records):
+        os.makedirs(self.__record_dir__, exist_ok=True)
+        path = os.path.join(self.__record_dir__, name)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(records, file, indent=1)
+        os.replace(path + '.tmp', path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run the extraction pipeline')
+    parser.add_argument('stages', nargs='*', help=f"stages to run with the stages they need: {', '.join(stage.name for stage in STAGES)}")
+    parser.add_argument('--data-dir', default="~/data")
+    parser.add_argument('--state', default='NV')
+    parser.add_argument('--year', type=int, default=2019)
+    parser.add_argument('--map', default='HERE-24Q2', help='map version, a directory of the data directory')
+    parser.add_argument('--workers', '-j', type=int, default=4)
+    parser.add_argument('--force', nargs='*', default=[], help='stages to run even if up to date')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    pipeline = Pipeline(STAGES, args.data_dir, args.state, args.year, args.map, args.workers)
+    status = pipeline.run(args.stages, set(args.force), args.dry_run)
+    print(json.dumps(status))
+    sys.exit(1 if any(value in ('failed', 'blocked') for value in status.values()) else 0)
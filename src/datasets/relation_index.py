@@ -0,0 +1,203 @@
+import os
+import numpy as np
+import pandas as pd
+
+from graph_arrays import load_relations
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+columnar relations of RELATIONS.csv (see relations in way_graph.py) with indexes for batch lookups
+
+columns: int64 [relation] type, from_way, via_node, to_way; float64 [relation] value
+
+CSR indexes, relation ids grouped by a key:
+    by_via_node: indptr [node + 1], relations
+    by_from_way: indptr [way + 1], relations
+    by_to_way:   indptr [way + 1], relations
+
+hashed indexes:
+    transitions: unique (from_way, via_node, to_way) -> CSR of relation ids
+    typed:       (type, from_way, via_node, to_way) -> first relation of the type, for values
+
+queries take arrays and return one result per query, or (indptr, relation ids) for a variable number
+"""
+
+class RelationIndex:
+
+    def __init__(self, types, values, from_way, via_node, to_way, n_nodes, n_ways):
+        self.type = np.asarray(types, dtype=np.int64)
+        self.value = np.asarray(values, dtype=np.float64)
+        self.from_way = np.asarray(from_way, dtype=np.int64)
+        self.via_node = np.asarray(via_node, dtype=np.int64)
+        self.to_way = np.asarray(to_way, dtype=np.int64)
+        self.n_nodes = n_nodes
+        self.n_ways = n_ways
+
+        self.by_via_node = _csr(self.via_node, n_nodes)
+        self.by_from_way = _csr(self.from_way, n_ways)
+        self.by_to_way = _csr(self.to_way, n_ways)
+
+        # relations sorted by transition, then type, so the first of a type is the first in file order
+        order = np.lexsort((np.arange(len(self)), self.type, self.to_way, self.via_node, self.from_way))
+        columns = [self.from_way[order], self.via_node[order], self.to_way[order]]
+        first = _first_of_runs(columns)
+        self.__transitions__ = pd.MultiIndex.from_arrays([column[first] for column in columns])
+        self.__transition_indptr__ = np.append(first, len(order))
+        self.__transition_relations__ = order
+
+        columns = [self.type[order]] + columns
+        first = _first_of_runs(columns)
+        self.__typed__ = pd.MultiIndex.from_arrays([column[first] for column in columns])
+        self.__typed_relation__ = order[first]
+
+    def __len__(self):
+        return len(self.type)
+
+    def at_nodes(self, nodes, relation_type = None):
+        '''
+        relations with via_node in nodes: (indptr [query + 1], relation ids)
+        '''
+        return self.__select__(_gather(self.by_via_node, nodes), relation_type)
+
+    def from_ways(self, ways, relation_type = None):
+        '''
+        relations with from_way in ways: (indptr [query + 1], relation ids)
+        '''
+        return self.__select__(_gather(self.by_from_way, ways), relation_type)
+
+    def to_ways(self, ways, relation_type = None):
+        '''
+        relations with to_way in ways: (indptr [query + 1], relation ids)
+        '''
+        return self.__select__(_gather(self.by_to_way, ways), relation_type)
+
+    def at_transitions(self, from_way, via_node, to_way, relation_type = None):
+        '''
+        relations on each exact (from_way, via_node, to_way), unsigned way indexes: (indptr [query + 1], relation ids)
+        '''
+        if len(self) == 0:
+            return np.zeros(len(np.asarray(from_way)) + 1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        found = self.__transitions__.get_indexer(pd.MultiIndex.from_arrays([np.asarray(from_way), np.asarray(via_node),
+                                                                            np.asarray(to_way)]))
+        starts = np.where(found >= 0, self.__transition_indptr__[np.maximum(found, 0)], 0)
+        ends = np.where(found >= 0, self.__transition_indptr__[np.maximum(found, 0) + 1], 0)
+        return self.__select__(_ranges(starts, ends, self.__transition_relations__), relation_type)
+
+    def lookup(self, relation_type, from_way, via_node, to_way):
+        '''
+        value of the first relation of relation_type on each (from_way, via_node, to_way), 0 if none;
+        relations without to_way (0) apply to every to_way
+        '''
+        from_way = np.asarray(from_way)
+        via_node = np.asarray(via_node)
+        to_way = np.asarray(to_way)
+        types = np.full(len(from_way), relation_type)
+        if len(self) == 0:
+            return np.zeros(len(from_way), dtype=np.float64)
+
+        found = self.__typed__.get_indexer(pd.MultiIndex.from_arrays([types, from_way, via_node, to_way]))
+        anyway = self.__typed__.get_indexer(pd.MultiIndex.from_arrays([types, from_way, via_node, np.zeros_like(to_way)]))
+        found = np.where(found >= 0, found, anyway)
+
+        return np.where(found >= 0, self.value[self.__typed_relation__[np.maximum(found, 0)]], 0)
+
+    def node_values(self, relation_type, nodes, reduce = np.minimum):
+        '''
+        value of relation_type at each node reduced over its relations (reduce.reduceat), 0 if none
+        '''
+        indptr, relations = self.at_nodes(nodes, relation_type)
+        result = np.zeros(len(indptr) - 1, dtype=np.float64)
+        present = np.diff(indptr) > 0
+        if present.any():
+            result[present] = reduce.reduceat(self.value[relations], indptr[:-1][present])
+        return result
+
+    def frame(self, relations = None):
+        '''
+        DataFrame in the layout of RELATIONS.csv, of all relations or the given relation ids
+        '''
+        relations = slice(None) if relations is None else relations
+        return pd.DataFrame({'type': self.type[relations], 'value': self.value[relations],
+                             'from_way': self.from_way[relations], 'via_node': self.via_node[relations],
+                             'to_way': self.to_way[relations]})
+
+    def __select__(self, csr, relation_type):
+        if relation_type is None:
+            return csr
+
+        indptr, relations = csr
+        keep = self.type[relations] == relation_type
+        query = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        counts = np.bincount(query[keep], minlength=len(indptr) - 1)
+
+        selected = np.zeros(len(indptr), dtype=np.int64)
+        np.cumsum(counts, out=selected[1:])
+        return selected, relations[keep]
+
+    def save(self, path):
+        np.savez(os.path.expanduser(path), type=self.type, value=self.value, from_way=self.from_way,
+                 via_node=self.via_node, to_way=self.to_way, shape=np.array([self.n_nodes, self.n_ways]))
+
+def load_relation_index(path):
+    with np.load(os.path.expanduser(path)) as arrays:
+        n_nodes, n_ways = arrays['shape'].tolist()
+        return RelationIndex(arrays['type'], arrays['value'], arrays['from_way'], arrays['via_node'],
+                             arrays['to_way'], n_nodes, n_ways)
+
+def build_relation_index(relations, n_nodes, n_ways):
+    '''
+    relations: DataFrame of RELATIONS.csv, or the list of [type, value, from_way, via_node, to_way]
+    of a WayGraph
+    '''
+    if not isinstance(relations, pd.DataFrame):
+        relations = pd.DataFrame(relations, columns=['type', 'value', 'from_way', 'via_node', 'to_way'])
+
+    return RelationIndex(relations['type'], relations['value'], relations['from_way'], relations['via_node'],
+                         relations['to_way'], n_nodes, n_ways)
+
+def relation_index_from_graph(graph):
+    return build_relation_index(graph.relations, len(graph.nodes), len(graph.ways))
+
+def _csr(keys, n):
+    '''
+    indptr [n + 1] and relation ids sorted by key, stable so file order holds within a key
+    '''
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n), out=indptr[1:])
+    return indptr, np.argsort(keys, kind='stable')
+
+def _gather(csr, queries):
+    indptr, relations = csr
+    queries = np.asarray(queries, dtype=np.int64)
+    return _ranges(indptr[queries], indptr[queries + 1], relations)
+
+def _ranges(starts, ends, relations):
+    '''
+    concatenated relations[start:end] of every query as (indptr, relation ids)
+    '''
+    counts = ends - starts
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    offsets = np.arange(indptr[-1]) - np.repeat(indptr[:-1], counts)
+    return indptr, relations[np.repeat(starts, counts) + offsets]
+
+def _first_of_runs(columns):
+    '''
+    positions of the first of each run of equal rows of sorted columns
+    '''
+    change = np.zeros(len(columns[0]), dtype=bool)
+    change[:1] = True
+    for column in columns:
+        change[1:] |= column[1:] != column[:-1]
+    return np.flatnonzero(change)
+
+if __name__ == '__main__':
+    ways = pd.read_csv(os.path.join(gnn_dir, f"{state}/WAYS.csv"), usecols=['way_id'])
+    nodes = pd.read_csv(os.path.join(gnn_dir, f"{state}/NODES.csv"), usecols=['node_id'])
+
+    index = build_relation_index(load_relations(gnn_dir, state), len(nodes), len(ways))
+    index.save(os.path.join(gnn_dir, f"{state}/RELATIONS_INDEX.npz"))
+    print(f"indexed {len(index)} relations at {np.count_nonzero(np.diff(index.by_via_node[0]))} nodes")
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import argparse
+import threading
+import urllib.request
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+route risk scoring service
+
+POST /score {"routes": [{"ways": [way_id, ...]}, {"trace": [[lat, lon], ...]}, ...]}
+    => {"routes": [{"total": 1.23, "ways": [...], "joints": [...], "unknown": [way_id, ...]}, ...]}
+
+risk inputs under {gnn_dir}/{state}/RISK:
+    way_risk.npy    float32 [way]       risk of traversing a way, by way index of WAYS.csv
+    joint_risk.npy  float32 [joint]     risk of a turn, by row of JOINTS.csv (optional)
+
+a joint is looked up by (from way, to way) of consecutive ways, unsigned; a route total is the sum of
+its way and joint risks, unknown way ids count 0
+"""
+
+class RouteScorer:
+
+    def __init__(self, way_ids, way_risk, joint_from = None, joint_to = None, joint_risk = None, cache_size = 10000):
+        order = np.argsort(way_ids)
+        self.__sorted_ids__ = np.asarray(way_ids)[order]
+        self.__sorted_index__ = order
+        self.way_risk = np.asarray(way_risk, dtype=np.float32)
+        self.n_ways = len(way_ids)
+
+        if joint_risk is not None:
+            keys = np.asarray(joint_from, dtype=np.int64) * self.n_ways + np.asarray(joint_to, dtype=np.int64)
+            keys, first = np.unique(keys, return_index=True)
+            self.__joint_keys__ = keys
+            self.__joint_risk__ = np.asarray(joint_risk, dtype=np.float32)[first]
+        else:
+            self.__joint_keys__ = np.zeros(0, dtype=np.int64)
+            self.__joint_risk__ = np.zeros(0, dtype=np.float32)
+
+        self.cache_size = cache_size
+        self.__cache__ = OrderedDict()
+        self.__lock__ = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def way_index(self, way_ids):
+        '''
+        way index of HERE way ids, -1 if not in the graph
+        '''
+        way_ids = np.asarray(way_ids, dtype=np.int64)
+        position = np.searchsorted(self.__sorted_ids__, way_ids)
+        position = np.minimum(position, len(self.__sorted_ids__) - 1)
+        found = self.__sorted_ids__[position] == way_ids
+        return np.where(found, self.__sorted_index__[position], -1)
+
+    def score(self, routes):
+        '''
+        routes: lists of way ids; cached routes are answered first, the others are scored in one batch
+        '''
+        results = [None] * len(routes)
+        misses = []
+        with self.__lock__:
+            for i, route in enumerate(routes):
+                key = tuple(route)
+                if key in self.__cache__:
+                    self.__cache__.move_to_end(key)
+                    results[i] = self.__cache__[key]
+                    self.hits += 1
+                else:
+                    misses.append(i)
+                    self.misses += 1
+
+        if misses:
+            scored = self.score_batch([routes[i] for i in misses])
+            with self.__lock__:
+                for i, result in zip(misses, scored):
+                    results[i] = result
+                    self.__cache__[tuple(routes[i])] = result
+                while len(self.__cache__) > self.cache_size:
+                    self.__cache__.popitem(last=False)
+
+        return results
+
+    def score_batch(self, routes):
+        '''
+        all routes concatenated, so one gather of way risks and one search of joint keys per batch
+        '''
+        lengths = np.array([len(route) for route in routes], dtype=np.int64)
+        way_ids = np.array([way_id for route in routes for way_id in route], dtype=np.int64)
+        route = np.repeat(np.arange(len(routes)), lengths)
+
+        ways = self.way_index(way_ids)
+        way_risk = np.where(ways >= 0, self.way_risk[np.maximum(ways, 0)], 0)
+
+        # a joint between consecutive known ways of the same route
+        pair = (route[:-1] == route[1:]) & (ways[:-1] >= 0) & (ways[1:] >= 0)
+        keys = ways[:-1] * self.n_ways + ways[1:]
+        position = np.searchsorted(self.__joint_keys__, keys)
+        pair &= position < len(self.__joint_keys__)
+        position = np.where(pair, position, 0)
+        pair[pair] = self.__joint_keys__[position[pair]] == keys[pair]
+        joint_risk = np.zeros(len(keys), dtype=np.float32)
+        joint_risk[pair] = self.__joint_risk__[position[pair]]
+
+        totals = np.bincount(route, weights=way_risk, minlength=len(routes))
+        totals += np.bincount(route[:-1], weights=joint_risk, minlength=len(routes))
+
+        results = []
+        ends = np.cumsum(lengths)
+        for i, (start, end) in enumerate(zip(ends - lengths, ends)):
+            results.append({'total': float(totals[i]),
+                            'ways': way_risk[start:end].tolist(),
+                            'joints': joint_risk[start:max(end - 1, start)].tolist(),
+                            'unknown': way_ids[start:end][ways[start:end] < 0].tolist()})
+        return results
+
+def load_scorer(gnn_dir, state, cache_size = 10000):
+    ways = pd.read_csv(os.path.join(gnn_dir, f"{state}/WAYS.csv"), usecols=['way_id'])
+    risk_dir = os.path.expanduser(os.path.join(gnn_dir, f"{state}/RISK"))
+    way_risk = np.load(os.path.join(risk_dir, 'way_risk.npy'))
+
+    joint_risk_path = os.path.join(risk_dir, 'joint_risk.npy')
+    if not os.path.exists(joint_risk_path):
+        return RouteScorer(ways['way_id'].to_numpy(), way_risk, cache_size=cache_size)
+
+    joints = pd.read_csv(os.path.join(gnn_dir, f"{state}/JOINTS.csv"), usecols=['from_way', 'to_way'])
+    return RouteScorer(ways['way_id'].to_numpy(), way_risk, joints['from_way'].abs().to_numpy(),
+                       joints['to_way'].abs().to_numpy(), np.load(joint_risk_path), cache_size)
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    scorer = None
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.send_error(404)
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            routes = [_route_ways(route) for route in request['routes']]
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_error(400, str(error))
+            return
+
+        body = json.dumps({'routes': self.scorer.score(routes)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def _route_ways(route):
+    if 'ways' in route:
+        return [int(way_id) for way_id in route['ways']]
+
+    from matching import match_trace
+    return match_trace(route['trace'])
+
+def serve(scorer, port = 8700):
+    ScoringHandler.scorer = scorer
+    server = ThreadingHTTPServer(('127.0.0.1', port), ScoringHandler)
+    print(f"scoring routes on http://127.0.0.1:{server.server_port}/score")
+    return server
+
+def random_routes(scorer, joint_from, joint_to, n, length, seed = 0):
+    '''
+    random walks over joints as way id routes, for load tests
+    '''
+    rng = np.random.default_rng(seed)
+    order = np.argsort(joint_from, kind='stable')
+    to_sorted = np.asarray(joint_to)[order]
+    indptr = np.searchsorted(np.asarray(joint_from)[order], np.arange(scorer.n_ways + 1))
+    way_ids = np.empty(scorer.n_ways, dtype=np.int64)
+    way_ids[scorer.__sorted_index__] = scorer.__sorted_ids__
+
+    starts = np.flatnonzero(np.diff(indptr) > 0)
+    routes = []
+    for way in rng.choice(starts, n):
+        route = [way]
+        while len(route) < length and indptr[way + 1] > indptr[way]:
+            way = to_sorted[rng.integers(indptr[way], indptr[way + 1])]
+            route.append(way)
+        routes.append(way_ids[route].tolist())
+    return routes
+
+def load_test(scorer, routes, batch = 32, clients = 8, repeat = 0.5):
+    '''
+    post batches of routes from concurrent clients; repeat is the share of batches sent twice (cache hits)
+    '''
+    server = serve(scorer, 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/score'
+
+    batches = [routes[i:i + batch] for i in range(0, len(routes), batch)]
+    batches += batches[:int(len(batches) * repeat)]
+
+    def post(routes):
+        body = json.dumps({'routes': [{'ways': route} for route in routes]}).encode()
+        start = time.perf_counter()
+        with urllib.request.urlopen(urllib.request.Request(url, body, {'Content-Type': 'application/json'})) as response:
+            response.read()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = np.array(list(executor.map(post, batches)))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    report = {'batches': len(batches), 'routes': sum(len(routes) for routes in batches),
+              'p50_ms': float(np.percentile(latencies, 50) * 1000), 'p99_ms': float(np.percentile(latencies, 99) * 1000),
+              'routes_per_sec': sum(len(routes) for routes in batches) / elapsed,
+              'cache_hits': scorer.hits, 'cache_misses': scorer.misses}
+    print(json.dumps(report))
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='route risk scoring service')
+    parser.add_argument('--state', default=state)
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--cache', type=int, default=10000)
+    parser.add_argument('--load-test', type=int, default=0, metavar='ROUTES', help='run a load test instead of serving')
+    args = parser.parse_args()
+
+    scorer = load_scorer(gnn_dir, args.state, args.cache)
+    if args.load_test:
+        joints = pd.read_csv(os.path.join(gnn_dir, f"{args.state}/JOINTS.csv"), usecols=['from_way', 'to_way'])
+        routes = random_routes(scorer, joints['from_way'].abs().to_numpy(), joints['to_way'].abs().to_numpy(),
+                               args.load_test, 30)
+        load_test(scorer, routes)
+    else:
+        serve(scorer, args.port).serve_forever()
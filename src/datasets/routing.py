@@ -0,0 +1,261 @@
+import os
+import time
+import heapq
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+
+from graph_arrays import load_ways, load_nodes, load_relations, dirway_index, index_dirway
+from joints import build_joints
+
+gnn_dir = os.path.join(os.environ.get('PIPELINE_DATA_DIR', "~/data"), "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+
+"""
+edge based routing over joints: a vertex is a dirway index, an edge is a joint, so oneway and turn
+restrictions (1) hold by construction of the joints; gated barriers (2) are removed, toll booths cost
+toll_cost, timed restrictions are removed if block_timed
+
+edge weight = cost of the to way + risk of the joint
+    cost of a way = length * (1 + risk_weight * way_risk), way_risk 0 for the shortest route
+
+queries run from a source way to a target way (either direction of each) with bidirectional A*;
+the potentials come from landmarks (ALT): distances from and to a few far apart dirways give lower
+bounds d(v, t) >= d(L, t) - d(L, v) and d(v, t) >= d(v, L) - d(t, L)
+"""
+
+class Router:
+
+    def __init__(self, graph, landmarks = 0, seed = 0):
+        '''
+        graph: csr [dirway index, dirway index] of edge weights
+        '''
+        self.graph = graph.tocsr()
+        self.reverse = self.graph.T.tocsr()
+        self.n = self.graph.shape[0]
+
+        # lists are faster than numpy for the one vertex at a time search
+        self.__forward__ = (self.graph.indptr.tolist(), self.graph.indices.tolist(), self.graph.data.tolist())
+        self.__backward__ = (self.reverse.indptr.tolist(), self.reverse.indices.tolist(), self.reverse.data.tolist())
+
+        self.landmarks = np.zeros(0, dtype=np.int64)
+        self.from_landmark = np.zeros((0, self.n))
+        self.to_landmark = np.zeros((0, self.n))
+        if landmarks > 0:
+            self.preprocess(landmarks, seed)
+
+    def preprocess(self, count, seed = 0):
+        '''
+        choose landmarks by farthest insertion and keep their distances [landmark, dirway] both ways
+        '''
+        rng = np.random.default_rng(seed)
+        candidates = np.flatnonzero(np.diff(self.graph.indptr) > 0)
+        landmarks = [int(rng.choice(candidates))]
+        from_landmark = [dijkstra(self.graph, indices=landmarks[0])]
+        to_landmark = [dijkstra(self.reverse, indices=landmarks[0])]
+
+        for _ in range(count - 1):
+            reach = np.minimum(np.stack(from_landmark), np.stack(to_landmark)).min(axis=0)
+            reach[~np.isfinite(reach)] = -1
+            landmark = int(np.argmax(reach))
+            if reach[landmark] <= 0:
+                break
+
+            landmarks.append(landmark)
+            from_landmark.append(dijkstra(self.graph, indices=landmark))
+            to_landmark.append(dijkstra(self.reverse, indices=landmark))
+
+        self.landmarks = np.array(landmarks)
+        self.from_landmark = np.stack(from_landmark)
+        self.to_landmark = np.stack(to_landmark)
+
+    def lower_bound(self, targets, vertices):
+        '''
+        ALT lower bound of the distance from each of vertices to the nearest of targets, [vertex]
+        '''
+        if len(self.landmarks) == 0:
+            return np.zeros(len(vertices))
+
+        with np.errstate(invalid='ignore'):
+            ahead = self.from_landmark[:, None, targets] - self.from_landmark[:, vertices, None]
+            behind = self.to_landmark[:, vertices, None] - self.to_landmark[:, None, targets]
+            bound = np.fmax(ahead, behind).max(axis=0)
+        return np.maximum(np.where(np.isnan(bound), 0, bound).min(axis=1), 0)
+
+    def lower_bound_reverse(self, sources, vertices):
+        '''
+        ALT lower bound of the distance from the nearest of sources to each of vertices, [vertex]
+        '''
+        if len(self.landmarks) == 0:
+            return np.zeros(len(vertices))
+
+        with np.errstate(invalid='ignore'):
+            ahead = self.from_landmark[:, vertices, None] - self.from_landmark[:, None, sources]
+            behind = self.to_landmark[:, None, sources] - self.to_landmark[:, vertices, None]
+            bound = np.fmax(ahead, behind).max(axis=0)
+        return np.maximum(np.where(np.isnan(bound), 0, bound).min(axis=1), 0)
+
+    def route(self, sources, targets):
+        '''
+        cheapest path from any of source dirway indexes to any of target ones: (cost, [dirway index])
+        '''
+        sources = [int(source) for source in sources]
+        targets = [int(target) for target in targets]
+        # bounds only of the dirways a search reaches, not of all: {dirway: (potential, to target, to source)}
+        bounds = {}
+
+        def bound(vertices):
+            vertices = [vertex for vertex in vertices if vertex not in bounds]
+            if vertices:
+                to_target = self.lower_bound(targets, vertices)
+                to_source = self.lower_bound_reverse(sources, vertices)
+                # unreachable dirways have an infinite bound and are never pushed
+                with np.errstate(invalid='ignore'):
+                    potential = (to_target - to_source) / 2
+                bounds.update(zip(vertices, zip(potential.tolist(), to_target.tolist(), to_source.tolist())))
+            return bounds
+
+        bound(sources + targets)
+        forward_dist = {}
+        backward_dist = {}
+        forward_parent = {}
+        backward_parent = {}
+        forward_heap = []
+        backward_heap = []
+        for source in sources:
+            forward_dist[source] = 0.0
+            forward_parent[source] = -1
+            heapq.heappush(forward_heap, (bounds[source][0], source))
+        for target in targets:
+            backward_dist[target] = 0.0
+            backward_parent[target] = -1
+            heapq.heappush(backward_heap, (-bounds[target][0], target))
+
+        best = np.inf
+        meet = -1
+        for source in sources:
+            if source in backward_dist:
+                best, meet = 0.0, source
+
+        forward_done = set()
+        backward_done = set()
+        while forward_heap and backward_heap:
+            if forward_heap[0][0] + backward_heap[0][0] >= best:
+                break
+
+            if forward_heap[0][0] <= backward_heap[0][0]:
+                best, meet = self.__settle__(forward_heap, forward_dist, forward_parent, forward_done,
+                                             backward_dist, self.__forward__, bound, 1, best, meet)
+            else:
+                best, meet = self.__settle__(backward_heap, backward_dist, backward_parent, backward_done,
+                                             forward_dist, self.__backward__, bound, -1, best, meet)
+
+        if meet < 0:
+            return np.inf, []
+
+        path = []
+        vertex = meet
+        while vertex >= 0:
+            path.append(vertex)
+            vertex = forward_parent[vertex]
+        path.reverse()
+        vertex = backward_parent[meet]
+        while vertex >= 0:
+            path.append(vertex)
+            vertex = backward_parent[vertex]
+
+        return best, path
+
+    def __settle__(self, heap, dist, parent, done, other_dist, adjacency, bound, sign, best, meet):
+        _, vertex = heapq.heappop(heap)
+        if vertex in done:
+            return best, meet
+        done.add(vertex)
+
+        indptr, indices, weights = adjacency
+        distance = dist[vertex]
+        bounds = bound(indices[indptr[vertex]:indptr[vertex + 1]])
+        for i in range(indptr[vertex], indptr[vertex + 1]):
+            neighbor = indices[i]
+            candidate = distance + weights[i]
+            potential, to_target, to_source = bounds[neighbor]
+            if candidate >= dist.get(neighbor, np.inf) or (to_target if sign > 0 else to_source) == np.inf:
+                continue
+
+            dist[neighbor] = candidate
+            parent[neighbor] = vertex
+            heapq.heappush(heap, (candidate + sign * potential, neighbor))
+
+            if neighbor in other_dist and candidate + other_dist[neighbor] < best:
+                best = candidate + other_dist[neighbor]
+                meet = neighbor
+
+        return best, meet
+
+    def many_to_many(self, sources, targets):
+        '''
+        cost [source, target] between groups of dirway indexes, e.g. both directions of ways,
+        one multi-source Dijkstra in C per source group, distances [dirway] from the nearest of the group
+        '''
+        costs = np.full((len(sources), len(targets)), np.inf)
+        group_targets = [np.asarray(group) for group in targets]
+        for i, group in enumerate(sources):
+            distances = dijkstra(self.graph, indices=np.asarray(group), min_only=True)
+            costs[i] = [distances[target_group].min() for target_group in group_targets]
+
+        return costs
+
+def routing_graph(ways, joints, way_risk = None, joint_risk = None, risk_weight = 1.0, toll_cost = 0.0,
+                  block_timed = False):
+    '''
+    csr of joint weights between dirway indexes
+    '''
+    length = ways['length'].to_numpy(dtype=np.float64)
+    cost = length * (1 + risk_weight * np.asarray(way_risk)) if way_risk is not None else length
+
+    keep = joints['barrier'].to_numpy() != 1
+    if block_timed:
+        keep &= joints['restriction'].to_numpy() == 0
+
+    to_way = joints['to_way'].to_numpy()
+    weight = cost[np.abs(to_way)] + np.where(joints['barrier'].to_numpy() == 2, toll_cost, 0)
+    if joint_risk is not None:
+        weight = weight + risk_weight * np.asarray(joint_risk)
+
+    # a weight of 0 would be dropped as no edge by the sparse matrix
+    weight = np.maximum(weight, 1e-6)
+    n = 2 * len(ways)
+    return sp.csr_matrix((weight[keep], (dirway_index(joints['from_way'].to_numpy()[keep]), dirway_index(to_way[keep]))),
+                         shape=(n, n))
+
+def way_dirways(way_indexes):
+    '''
+    both dirway indexes of every way
+    '''
+    way_indexes = np.asarray(way_indexes)
+    return [[2 * way, 2 * way + 1] for way in way_indexes.tolist()]
+
+def route_ways(router, from_way, to_way):
+    '''
+    safest route between two way indexes as signed way indexes (forward positive)
+    '''
+    cost, path = router.route(*way_dirways([from_way, to_way]))
+    return cost, index_dirway(np.array(path, dtype=np.int64)).tolist()
+
+if __name__ == '__main__':
+    ways = load_ways(gnn_dir, state)
+    joints = build_joints(ways, load_nodes(gnn_dir, state), load_relations(gnn_dir, state))
+
+    risk_path = os.path.expanduser(os.path.join(gnn_dir, f"{state}/RISK/way_risk.npy"))
+    way_risk = np.load(risk_path) if os.path.exists(risk_path) else None
+
+    start = time.perf_counter()
+    router = Router(routing_graph(ways, joints, way_risk), landmarks=16)
+    print(f"preprocessed {len(router.landmarks)} landmarks in {time.perf_counter() - start:.1f}s")
+
+    rng = np.random.default_rng(0)
+    pairs = rng.integers(1, len(ways), (100, 2))
+    start = time.perf_counter()
+    for from_way, to_way in pairs:
+        route_ways(router, from_way, to_way)
+    print(f"{(time.perf_counter() - start) * 10:.1f}ms per query")
@@ -0,0 +1,135 @@
+import os
+import numpy as np
+from multiprocessing import Pool
+
+from graph_arrays import graph_frames, node_ways, transitions
+
+"""
+k-hop neighborhood sampler over the way graph
+
+CSR by target way of the ways with a transition into it (message senders):
+    indptr:  int64 [way + 1]
+    indices: int64 [edge]       sender way
+    weights: float32 [edge]     optional importance of a sender, e.g. its crash count + 1
+
+a sampled subgraph: ways (global way indexes, seeds first), edge_index (local, sender to target), n_seeds
+"""
+
+class NeighborSampler:
+
+    def __init__(self, indptr, indices, weights = None, fanouts = (10, 5), seed = 0):
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.fanouts = list(fanouts)
+        self.seed = seed
+
+    def save(self, path):
+        path = os.path.expanduser(path)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'indptr.npy'), self.indptr)
+        np.save(os.path.join(path, 'indices.npy'), self.indices)
+        if self.weights is not None:
+            np.save(os.path.join(path, 'weights.npy'), self.weights)
+
+    def sample(self, seeds, batch = 0):
+        '''
+        sampled k-hop subgraph of seed ways; the same seed and batch give the same subgraph in any process
+        '''
+        rng = np.random.default_rng([self.seed, batch])
+        seeds = np.unique(np.asarray(seeds, dtype=np.int64))
+
+        ways = [seeds]
+        senders = []
+        targets = []
+        frontier = seeds
+        for fanout in self.fanouts:
+            sender, target = self.__sample_hop__(frontier, fanout, rng)
+            senders.append(sender)
+            targets.append(target)
+
+            known = np.concatenate(ways)
+            frontier = np.setdiff1d(np.unique(sender), known, assume_unique=True)
+            ways.append(frontier)
+
+        ways = np.concatenate(ways)
+        order = np.argsort(ways, kind='stable')
+        sender = np.concatenate(senders)
+        target = np.concatenate(targets)
+        edge_index = np.stack([order[np.searchsorted(ways, sender, sorter=order)],
+                               order[np.searchsorted(ways, target, sorter=order)]])
+
+        return ways, edge_index, len(seeds)
+
+    def __sample_hop__(self, frontier, fanout, rng):
+        '''
+        up to fanout (-1 for all) senders of each frontier way without replacement, by weight if any:
+        the fanout largest random keys per way, log(u) / weight for weighted (Efraimidis-Spirakis)
+        '''
+        starts = self.indptr[frontier]
+        degrees = self.indptr[frontier + 1] - starts
+        target = np.repeat(frontier, degrees)
+        offsets = np.arange(degrees.sum()) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+        edges = np.repeat(starts, degrees) + offsets
+
+        keys = rng.random(len(edges))
+        if self.weights is not None:
+            keys = np.log(keys) / np.maximum(np.asarray(self.weights[edges], dtype=np.float64), 1e-12)
+
+        # edges of a way stay together sorted by descending key, so offsets are now ranks
+        row = np.repeat(np.arange(len(frontier)), degrees)
+        order = np.lexsort((-keys, row))
+        chosen = order[offsets < fanout] if fanout >= 0 else order
+        return np.asarray(self.indices[edges[chosen]]), target[chosen]
+
+def build_sampler(ways, nodes, weights = None, fanouts = (10, 5), seed = 0):
+    '''
+    ways, nodes: DataFrames of WAYS.csv and NODES.csv, or graph_frames(graph) of a WayGraph
+    weights: importance of every way [way] as a sender, None for uniform sampling
+    '''
+    indptr, signed = node_ways(nodes)
+    from_dirway, _, to_dirway = transitions(indptr, signed, ways['oneway'].to_numpy())
+    sender = np.abs(from_dirway)
+    target = np.abs(to_dirway)
+
+    n_ways = len(ways)
+    pairs = np.unique(target * n_ways + sender)
+    target, sender = pairs // n_ways, pairs % n_ways
+
+    csr_indptr = np.zeros(n_ways + 1, dtype=np.int64)
+    np.cumsum(np.bincount(target, minlength=n_ways), out=csr_indptr[1:])
+    csr_weights = np.asarray(weights, dtype=np.float32)[sender] if weights is not None else None
+
+    return NeighborSampler(csr_indptr, sender, csr_weights, fanouts, seed)
+
+def sampler_from_graph(graph, weights = None, fanouts = (10, 5), seed = 0):
+    ways, nodes = graph_frames(graph)
+    return build_sampler(ways, nodes, weights, fanouts, seed)
+
+def load_sampler(path, fanouts = (10, 5), seed = 0, mmap = True):
+    path = os.path.expanduser(path)
+    mmap_mode = 'r' if mmap else None
+    weights_path = os.path.join(path, 'weights.npy')
+    weights = np.load(weights_path, mmap_mode=mmap_mode) if os.path.exists(weights_path) else None
+
+    return NeighborSampler(np.load(os.path.join(path, 'indptr.npy'), mmap_mode=mmap_mode),
+                           np.load(os.path.join(path, 'indices.npy'), mmap_mode=mmap_mode),
+                           weights, fanouts, seed)
+
+_worker_sampler = None
+
+def _init_worker(path, fanouts, seed):
+    global _worker_sampler
+    _worker_sampler = load_sampler(path, fanouts, seed)
+
+def _sample_in_worker(task):
+    batch, seeds = task
+    return _worker_sampler.sample(seeds, batch)
+
+def sample_batches(path, batches, fanouts = (10, 5), seed = 0, workers = 4):
+    '''
+    sample batches of seed ways in worker processes sharing the CSR saved at path (memory mapped);
+    yield subgraphs in batch order
+    '''
+    with Pool(workers, initializer=_init_worker, initargs=(path, fanouts, seed)) as pool:
+        yield from pool.imap(_sample_in_worker, enumerate(batches))
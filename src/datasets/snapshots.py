@@ -0,0 +1,187 @@
+import os
+import json
+import numpy as np
+
+from crash_labels import crash_events
+from weather_store import COLUMNS
+from weather_tensor import way_stations
+
+data_dir = os.environ.get('PIPELINE_DATA_DIR', "~/data")
+gnn_dir = os.path.join(data_dir, "GNN")
+state = os.environ.get('PIPELINE_STATE', 'NV')
+year = int(os.environ.get('PIPELINE_YEAR', 2019))
+
+"""
+dynamic graph snapshots, one per hour (step 1) or per day (step 24) of a WeatherTensor period
+
+{root}/
+    snapshots.json          first_hour, step, n_times, chunk, n_nodes, n_ways, columns
+    times.npy               int64 [time]               hours since epoch (UTC) each snapshot starts at
+    node_weather_{c}.npy    float16 [chunk, node, var]  snapshots c * chunk ... (c + 1) * chunk - 1
+    way_weather_{c}.npy     float16 [chunk, way, var]   optional
+    crash_ptr.npy           int64 [time + 1]           CSR of crash events by snapshot
+    crash_way.npy           int32 [event]              way index
+    crash_severity.npy      int8  [event]
+
+a daily snapshot takes the mean of its hours, the sum for prcp, ignoring missing hours
+
+run as a script: daily snapshots (SNAPSHOT_STEP, 24 by default) of the year from the offline weather store
+of 4_extract_nv_weather.py, with the crashes of CRASHES.csv, into {gnn_dir}/{state}/SNAPSHOTS_{year}
+"""
+
+SUMMED = ['prcp']
+
+def iter_snapshots(tensor, node_station, way_station = None, events = None, step = 1):
+    '''
+    yield (time, node_weather [node, var], way_weather [way, var] or None, crash_way, crash_severity)
+    per snapshot, only one snapshot of node features is in memory at a time
+    '''
+    n_times = tensor.shape[1] // step
+    summed = np.array([column in SUMMED for column in COLUMNS])
+
+    if events is not None:
+        hours = tensor.hour_index(events['time'].to_numpy())
+        keep = hours >= 0
+        times = hours[keep] // step
+        order = np.argsort(times, kind='stable')
+        crash_ptr = np.searchsorted(times[order], np.arange(n_times + 1))
+        crash_way = events['way'].to_numpy()[keep][order].astype(np.int32)
+        crash_severity = events['severity'].to_numpy()[keep][order].astype(np.int8)
+
+    for time in range(n_times):
+        station_weather = np.asarray(tensor.values[:, time * step:(time + 1) * step])
+        if step == 1:
+            station_weather = station_weather[:, 0]
+        else:
+            with np.errstate(all='ignore'):
+                station_weather = np.where(summed, np.nansum(station_weather, axis=1),
+                                           np.nanmean(station_weather, axis=1))
+
+        node_weather = station_weather[node_station]
+        way_weather = station_weather[way_station] if way_station is not None else None
+
+        if events is not None:
+            events_ = slice(crash_ptr[time], crash_ptr[time + 1])
+            yield time, node_weather, way_weather, crash_way[events_], crash_severity[events_]
+        else:
+            yield time, node_weather, way_weather, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int8)
+
+def write_snapshots(root, tensor, nodes, ways = None, crashes = None, way_weather = False, step = 1, chunk = 168):
+    '''
+    stream the snapshots of a WeatherTensor into memory mapped chunks under root;
+    crashes (CRASHES.csv) and way_weather need ways (WAYS.csv)
+    '''
+    root = os.path.expanduser(root)
+    os.makedirs(root, exist_ok=True)
+
+    node_station = nodes['station'].to_numpy()
+    way_station = way_stations(ways, nodes) if way_weather else None
+    events = crash_events(crashes, ways) if crashes is not None else None
+
+    n_times = tensor.shape[1] // step
+    n_ways = len(ways) if ways is not None else 0
+    meta = {'first_hour': tensor.first_hour, 'step': step, 'n_times': n_times, 'chunk': chunk,
+            'n_nodes': len(nodes), 'n_ways': n_ways, 'way_weather': way_station is not None, 'columns': COLUMNS}
+
+    crash_ptr = [0]
+    crash_way = []
+    crash_severity = []
+
+    node_chunk = way_chunk = None
+    for time, node_values, way_values, crash_ways, severities in iter_snapshots(tensor, node_station, way_station, events, step):
+        c, row = divmod(time, chunk)
+        if row == 0:
+            rows = min(chunk, n_times - time)
+            node_chunk = _open_chunk(root, 'node', c, (rows, len(nodes), len(COLUMNS)))
+            if way_station is not None:
+                way_chunk = _open_chunk(root, 'way', c, (rows, n_ways, len(COLUMNS)))
+
+        node_chunk[row] = node_values
+        if way_station is not None:
+            way_chunk[row] = way_values
+
+        if row == node_chunk.shape[0] - 1:
+            node_chunk.flush()
+            if way_chunk is not None:
+                way_chunk.flush()
+
+        crash_ptr.append(crash_ptr[-1] + len(crash_ways))
+        crash_way.append(crash_ways)
+        crash_severity.append(severities)
+
+    np.save(os.path.join(root, 'times.npy'), tensor.first_hour + np.arange(n_times, dtype=np.int64) * step)
+    np.save(os.path.join(root, 'crash_ptr.npy'), np.array(crash_ptr, dtype=np.int64))
+    np.save(os.path.join(root, 'crash_way.npy'), np.concatenate(crash_way or [np.zeros(0, dtype=np.int32)]))
+    np.save(os.path.join(root, 'crash_severity.npy'), np.concatenate(crash_severity or [np.zeros(0, dtype=np.int8)]))
+    with open(os.path.join(root, 'snapshots.json'), 'w') as file:
+        json.dump(meta, file)
+
+    print(f"wrote {n_times} snapshots of {len(nodes)} nodes, {crash_ptr[-1]} crash events")
+
+class SnapshotReader:
+
+    def __init__(self, root):
+        self.root = os.path.expanduser(root)
+        with open(os.path.join(self.root, 'snapshots.json')) as file:
+            self.meta = json.load(file)
+
+        self.times = np.load(os.path.join(self.root, 'times.npy'))
+        self.crash_ptr = np.load(os.path.join(self.root, 'crash_ptr.npy'))
+        self.crash_way = np.load(os.path.join(self.root, 'crash_way.npy'), mmap_mode='r')
+        self.crash_severity = np.load(os.path.join(self.root, 'crash_severity.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.times)
+
+    def time_index(self, hours):
+        '''
+        snapshot index of hours since epoch (UTC)
+        '''
+        return np.searchsorted(self.times, hours, side='right') - 1
+
+    def weather(self, start, end, level = 'node'):
+        '''
+        weather of snapshots [start, end) as float32 [time, node or way, var], read chunk by chunk
+        '''
+        chunk = self.meta['chunk']
+        if end <= start:
+            n = self.meta['n_nodes'] if level == 'node' else self.meta['n_ways']
+            return np.zeros((0, n, len(self.meta['columns'])), dtype=np.float32)
+
+        parts = []
+        for c in range(start // chunk, (end - 1) // chunk + 1):
+            values = np.load(os.path.join(self.root, f'{level}_weather_{c:05d}.npy'), mmap_mode='r')
+            first = max(start - c * chunk, 0)
+            last = min(end - c * chunk, values.shape[0])
+            parts.append(values[first:last])
+
+        return np.concatenate(parts).astype(np.float32)
+
+    def crashes(self, start, end):
+        '''
+        snapshot index, way index and severity of crash events in snapshots [start, end)
+        '''
+        first, last = self.crash_ptr[start], self.crash_ptr[end]
+        times = np.repeat(np.arange(start, end), np.diff(self.crash_ptr[start:end + 1]))
+        return times, np.asarray(self.crash_way[first:last]), np.asarray(self.crash_severity[first:last])
+
+def _open_chunk(root, level, c, shape):
+    path = os.path.join(root, f'{level}_weather_{c:05d}.npy')
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=shape)
+
+if __name__ == '__main__':
+    import pandas as pd
+    from datetime import datetime
+    from graph_arrays import load_ways, load_nodes
+    from weather_store import WeatherStore
+    from weather_tensor import build_weather_tensor
+
+    stations = pd.read_csv(os.path.join(gnn_dir, f"{state}/STATIONS.csv"))['station'].to_list()
+    store = WeatherStore(os.path.join(data_dir, "WEATHER"), offline=True)
+    tensor = build_weather_tensor(store, stations, datetime(year, 1, 1), datetime(year + 1, 1, 1), 'US/Pacific')
+
+    ways = load_ways(gnn_dir, state, ['way_id', 'from_node', 'to_node'])
+    nodes = load_nodes(gnn_dir, state)
+    crashes = pd.read_csv(os.path.join(gnn_dir, f"{state}/CRASHES.csv"))
+    write_snapshots(os.path.join(gnn_dir, f"{state}/SNAPSHOTS_{year}"), tensor, nodes, ways, crashes,
+                    step=int(os.environ.get('SNAPSHOT_STEP', 24)))
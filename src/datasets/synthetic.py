@@ -0,0 +1,310 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+synth_dir = "~/data/SYNTH"
+state = 'SY'
+
+"""
+synthetic map, crash and AADT data in the formats read by the extraction scripts, for benchmarks
+and regression runs without licensed data or live services
+
+{synth_dir}/{state}/WAYS, RELATIONS, RELATION_MEMBERS: backtick delimited, no header, as HERE-24Q2
+    WAYS:             id (way_id * 1000), version, user_id, tstamp, changeset_id, tags, nodes, bbox, LINESTRING(lon lat,...)
+    RELATIONS:        id, version, user_id, tstamp, changeset_id, tags
+    RELATION_MEMBERS: relation id, member id (way_id * 1000 or node_id), type (W, N), role (from, via, to), sequence
+    tags: hstore text, e.g. "rt"=>"3", "fc"=>"4", "rst"=>"1", "adas:chs"=>"511;0;25|498;0;-10"
+
+the map is a size x size grid of intersections:
+    streets: twoway or oneway local (rt 3-4, fc 1-2), artery (fc 3-4) or slow (rt 6) ways between neighbor intersections
+    avenues: every dual_every-th row, two oneway ways (rst 2) between the same intersections
+    highways: every highway_every-th column, rt 1 and oneway dual as avenues
+    leaf ways: private (rt 7) and walkway (rt 8) ways off some intersections
+    relations: turn restrictions, signals, stop signs, gates and lane connectivity at intersections
+
+{synth_dir}/{state}/CRASHES.csv and AADTS.csv: as written by 2_extract_nv_crashes.py and 3_extract_nv_aadt.py,
+    matched to way ids of the map
+"""
+
+ORIGIN = (39.50, -119.85)
+SPACING = 0.002 # degrees between intersections, about 200m
+
+YEARS = list(range(2007, 2023))
+
+class SyntheticMap:
+    '''
+    raw rows of a synthetic map and the road ways it has: way_id, lat, lon (middle), rt, length (meters)
+    '''
+    def __init__(self, size = 20, seed = 0, dual_every = 5, highway_every = 10):
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.dual_every = dual_every
+        self.highway_every = highway_every
+
+        self.raw_ways = []
+        self.raw_relations = []
+        self.raw_members = []
+        self.roads = []
+        self.__way_id__ = 100000000
+        self.__leaf_node_id__ = 900000000
+        self.__relation_id__ = 500000000
+
+        # jittered intersections, node ids are grid positions
+        self.points = np.stack(np.meshgrid(np.arange(size), np.arange(size), indexing='ij'), axis=-1) * SPACING
+        self.points = self.points + self.rng.normal(0, SPACING / 20, self.points.shape) + np.array(ORIGIN)
+        self.at_node = {}
+
+        self.__build__()
+
+    def node_id(self, i, j):
+        return 200000000 + i * self.size + j
+
+    def __build__(self):
+        for i in range(self.size):
+            for j in range(self.size):
+                if j + 1 < self.size:
+                    self.__edge__((i, j), (i, j + 1), self.dual_every and i % self.dual_every == 0, False)
+                if i + 1 < self.size:
+                    self.__edge__((i, j), (i + 1, j), False, self.highway_every and j % self.highway_every == 0)
+
+        for i in range(self.size):
+            for j in range(self.size):
+                if self.rng.random() < 0.05:
+                    self.__leaf__((i, j), 7 if self.rng.random() < 0.5 else 8)
+                self.__relations__((i, j))
+
+    def __edge__(self, a, b, dual, highway):
+        if highway:
+            tags = {'rt': 1, 'fc': 1, 'rst': 2}
+        elif dual:
+            tags = {'rt': 3, 'fc': 3, 'rst': 2}
+        else:
+            rt = int(self.rng.choice([3, 4, 6], p=[0.5, 0.45, 0.05]))
+            tags = {'rt': rt, 'fc': int(self.rng.choice([1, 2, 3, 4], p=[0.3, 0.5, 0.15, 0.05])),
+                    'rst': int(self.rng.choice([1, 3, 4, 11, 12], p=[0.85, 0.05, 0.05, 0.025, 0.025]))}
+
+        if dual or highway:
+            self.__way__(a, b, dict(tags, oneway='yes'), offset=1)
+            self.__way__(b, a, dict(tags, oneway='yes'), offset=1)
+        else:
+            oneway = self.rng.choice([None, 'yes', '-1'], p=[0.85, 0.1, 0.05])
+            self.__way__(a, b, dict(tags, oneway=oneway) if oneway else tags)
+
+    def __way__(self, a, b, tags, offset = 0):
+        '''
+        a way from intersection a to b with 2 to 5 shape points, offset to the right for dual ways
+        '''
+        way_id = self.__way_id__
+        self.__way_id__ += 1
+
+        start, end = self.points[a], self.points[b]
+        n_points = int(self.rng.integers(2, 6))
+        t = np.linspace(0, 1, n_points)[:, None]
+        direction = end - start
+        normal = np.array([-direction[1], direction[0]])
+        bend = np.sin(np.pi * t) * self.rng.normal(0, 0.05) + offset * 0.004 * (t > 0) * (t < 1)
+        points = start + t * direction + bend * normal
+        length = float(np.sum(np.hypot(np.diff(points[:, 0]) * 111000, np.diff(points[:, 1]) * 86000)))
+
+        tags = dict(tags)
+        self.__way_tags__(tags, n_points)
+        nodes = [self.node_id(*a)] + [300000000 + way_id * 10 + k for k in range(1, n_points - 1)] + [self.node_id(*b)]
+        self.__raw_way__(way_id, tags, nodes, points)
+
+        middle = points[n_points // 2] if n_points > 2 else (start + end) / 2
+        self.roads.append({'way_id': way_id, 'lat': round(middle[0], 5), 'lon': round(middle[1], 5),
+                           'rt': tags['rt'], 'fc': tags['fc'], 'length': length})
+        self.at_node.setdefault(a, []).append(way_id)
+        self.at_node.setdefault(b, []).append(way_id)
+        return way_id
+
+    def __way_tags__(self, tags, n_points):
+        rng = self.rng
+        lanes = 4 if tags['rt'] == 1 else int(rng.choice([1, 2, 3, 4], p=[0.2, 0.5, 0.15, 0.15]))
+        if rng.random() < 0.6:
+            tags['lanes'] = lanes
+        if tags.get('oneway') is None and rng.random() < 0.5:
+            tags['lanes:forward'] = max(lanes // 2, 1)
+            tags['lanes:backward'] = max(lanes // 2, 1)
+        if rng.random() < 0.05:
+            tags['type:lanes'] = '|'.join(['1'] * lanes + ['65536'])
+        if rng.random() < 0.2:
+            tags['lane_cat'] = int(rng.integers(1, 4))
+
+        speed = {1: 65, 3: 45, 4: 35, 6: 15}[tags['rt']]
+        if rng.random() < 0.4:
+            tags['maxspeed:forward'] = speed
+            tags['maxspeed:backward'] = speed
+        tags['spd_kph:f'] = round(speed * 1.609 * rng.uniform(0.8, 1.1), 1)
+        tags['spd_kph:t'] = round(speed * 1.609 * rng.uniform(0.8, 1.1), 1)
+
+        if n_points > 2 and rng.random() < 0.7:
+            # curvature and slope of every interior shape point
+            tags['adas:chs'] = '|'.join(f"{int(rng.normal(511, 40))};0;{int(rng.normal(0, 300))}"
+                                        for _ in range(n_points - 2))
+        elif rng.random() < 0.5:
+            height = rng.uniform(1200, 1500)
+            tags['f_node_height'] = round(height, 2)
+            tags['t_node_height'] = round(height + rng.normal(0, 3), 2)
+
+        if rng.random() < 0.7:
+            tags['adas:urban'] = 'yes'
+        if rng.random() < 0.1:
+            tags['divider:lanes'] = rng.choice(['1|9|1', '1|7|1', '1|2|1', '1|1|1'])
+        if tags['rt'] == 4 and rng.random() < 0.3:
+            tags['highway'] = 'residential'
+
+    def __raw_way__(self, way_id, tags, nodes, points):
+        text = ', '.join(f'"{key}"=>"{value}"' for key, value in tags.items())
+        linestring = 'LINESTRING(' + ','.join(f"{lon:.6f} {lat:.6f}" for lat, lon in points) + ')'
+        bbox = f"{points[:, 1].min():.6f},{points[:, 0].min():.6f},{points[:, 1].max():.6f},{points[:, 0].max():.6f}"
+        self.raw_ways.append([way_id * 1000, 1, 0, '2024-04-01 00:00:00', 0, text,
+                              '{' + ','.join(str(node) for node in nodes) + '}', bbox, linestring])
+
+    def __leaf__(self, a, rt):
+        '''
+        a dead end private or walk way off intersection a
+        '''
+        way_id = self.__way_id__
+        self.__way_id__ += 1
+        start = self.points[a]
+        end = start + self.rng.normal(0, SPACING / 4, 2)
+        tags = {'rt': rt, 'fc': 1, 'rst': 1}
+        self.__leaf_node_id__ += 1
+        self.__raw_way__(way_id, tags, [self.node_id(*a), self.__leaf_node_id__], np.stack([start, end]))
+
+    def __relations__(self, a):
+        ways = self.at_node.get(a, [])
+        if len(ways) < 3:
+            return
+
+        node_id = self.node_id(*a)
+        roll = self.rng.random()
+        if roll < 0.15:
+            from_way, to_way = self.rng.choice(ways, 2, replace=False)
+            rdm_type = str(self.rng.choice(['1', '2', '3']))
+            timed = {'time': '(h7){h2}'} if self.rng.random() < 0.2 else {}
+            self.__relation__(dict({'type': 'restriction', 'rdm_type': rdm_type}, **timed),
+                              [(from_way, 'from'), (node_id, 'via'), (to_way, 'to')])
+        elif roll < 0.35:
+            self.__relation__({'type': 'traffic_signals'}, [(ways[0], 'from'), (node_id, 'via')])
+        elif roll < 0.5:
+            self.__relation__({'type': 'traffic_sign', 'traffic_sign': str(self.rng.choice(['stop', 'yield']))},
+                              [(ways[0], 'from'), (node_id, 'via')])
+        elif roll < 0.52:
+            self.__relation__({'type': 'barrier', 'barrier': 'gate'}, [(ways[0], 'from'), (node_id, 'via')])
+
+        if self.rng.random() < 0.2:
+            from_way, to_way = self.rng.choice(ways, 2, replace=False)
+            self.__relation__({'type': 'lane_connectivity', 'lane_conn': '1|2'},
+                              [(from_way, 'from'), (node_id, 'via'), (to_way, 'to')])
+        if self.rng.random() < 0.05:
+            self.__relation__({'type': 'traffic_sign', 'traffic_sign': 'pedestrian_crossing'},
+                              [(ways[0], 'from'), (node_id, 'via')])
+
+    def __relation__(self, tags, members):
+        relation_id = self.__relation_id__
+        self.__relation_id__ += 1
+        text = ', '.join(f'"{key}"=>"{value}"' for key, value in tags.items())
+        self.raw_relations.append([relation_id, 1, 0, '2024-04-01 00:00:00', 0, text])
+
+        for sequence, (member, role) in enumerate(members):
+            if role == 'via':
+                self.raw_members.append([relation_id, int(member), 'N', role, sequence])
+            else:
+                self.raw_members.append([relation_id, int(member) * 1000, 'W', role, sequence])
+
+    def write(self, out_dir):
+        out_dir = os.path.expanduser(out_dir)
+        os.makedirs(out_dir, exist_ok=True)
+        for name, rows in [('WAYS', self.raw_ways), ('RELATIONS', self.raw_relations),
+                           ('RELATION_MEMBERS', self.raw_members)]:
+            pd.DataFrame(rows).to_csv(os.path.join(out_dir, name), sep='`', header=False, index=False)
+
+def synthetic_crashes(roads, n, years = (2016, 2020), seed = 0):
+    '''
+    roads: SyntheticMap.roads as a DataFrame; crashes on random roads, more on longer and bigger ones
+    '''
+    rng = np.random.default_rng(seed)
+    weight = roads['length'].to_numpy() * np.where(roads['rt'].to_numpy() <= 3, 3.0, 1.0)
+    way = rng.choice(len(roads), n, p=weight / weight.sum())
+    second = np.where(rng.random(n) < 0.6, np.where(rng.random(n) < 0.7, way, rng.choice(len(roads), n)), -1)
+
+    start = pd.Timestamp(f"{years[0]}-01-01")
+    seconds = int((pd.Timestamp(f"{years[1] + 1}-01-01") - start).total_seconds())
+    # more in rush hours
+    times = start + pd.to_timedelta(rng.integers(0, seconds // 86400, n), unit='D') + \
+        pd.to_timedelta(np.clip(rng.choice([8, 17, 12], n) + rng.normal(0, 3, n), 0, 23.99) * 3600, unit='s')
+
+    maneuvers = ['going-straight', 'turning-left', 'turning-right', 'changing-lanes', 'leaving-lane',
+                 'passing-intersection', 'stopped', 'speeding']
+    faults = ['right-of-way', 'spacing', 'speeding', 'attention', 'lane-departure', None]
+    way_ids = roads['way_id'].to_numpy()
+    crashes = pd.DataFrame({
+        'crash_id': np.arange(n) + 1,
+        'crash_date': times.strftime('%Y-%m-%d'),
+        'crash_time': times.strftime('%H:%M:%S'),
+        'crash_severity': rng.choice([1, 2, 3], n, p=[0.7, 0.28, 0.02]),
+        'intersection': (rng.random(n) < 0.4).astype(np.int64),
+        'v1_maneuver': rng.choice(maneuvers, n),
+        'v1_dir': rng.choice(['N', 'S', 'E', 'W'], n),
+        'v1_fault': rng.choice(faults, n),
+        'v1_way': way_ids[way],
+        'v2_maneuver': np.where(second >= 0, rng.choice(maneuvers, n), None),
+        'v2_dir': np.where(second >= 0, rng.choice(['N', 'S', 'E', 'W'], n), None),
+        'v2_fault': np.where(second >= 0, rng.choice(faults, n), None),
+        'v2_way': np.where(second >= 0, way_ids[np.maximum(second, 0)], np.nan),
+        'mbpa': rng.choice(['', '', '', 'M', 'P', 'B', 'A'], n),
+        'primary_road': 'SYNTHETIC ST',
+        'lat': roads['lat'].to_numpy()[way],
+        'lon': roads['lon'].to_numpy()[way]})
+    return crashes
+
+def synthetic_aadts(roads, n, seed = 0):
+    '''
+    count stations on random roads, AADT by road type with a yearly trend and missing years
+    '''
+    rng = np.random.default_rng(seed)
+    way = rng.choice(len(roads), min(n, len(roads)), replace=False)
+    base = np.array([{1: 60000, 3: 15000, 4: 3000, 6: 500}[rt] for rt in roads['rt'].to_numpy()[way]])
+    base = base * rng.lognormal(0, 0.4, len(way))
+
+    aadts = pd.DataFrame({
+        'aadt_code': np.arange(len(way)) + 10000,
+        'on_road': 'SYNTHETIC ST',
+        'to_road': '',
+        'lat': roads['lat'].to_numpy()[way],
+        'lon': roads['lon'].to_numpy()[way],
+        'matched': rng.choice([2, 1, 0, -1, -2], len(way), p=[0.3, 0.4, 0.15, 0.1, 0.05]),
+        'score': rng.integers(70, 101, len(way)),
+        'way_id': roads['way_id'].to_numpy()[way]})
+    for i, year in enumerate(YEARS):
+        counts = np.round(base * (1 + 0.02 * (i - len(YEARS) // 2)) * rng.lognormal(0, 0.05, len(way)))
+        aadts[f'aadt_{year}'] = np.where(rng.random(len(way)) < 0.15, np.nan, counts)
+    return aadts
+
+def generate(out_dir, size = 20, crashes = 5000, aadts = 200, seed = 0):
+    '''
+    write a synthetic state to out_dir, returns the map
+    '''
+    synthetic = SyntheticMap(size, seed)
+    synthetic.write(out_dir)
+
+    roads = pd.DataFrame(synthetic.roads)
+    synthetic_crashes(roads, crashes, seed=seed).to_csv(os.path.join(os.path.expanduser(out_dir), 'CRASHES.csv'), index=False)
+    synthetic_aadts(roads, aadts, seed=seed).to_csv(os.path.join(os.path.expanduser(out_dir), 'AADTS.csv'), index=False)
+    return synthetic
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='synthetic HERE map, crashes and AADTs')
+    parser.add_argument('--state', default=state)
+    parser.add_argument('--size', type=int, default=20, help='intersections per side of the grid')
+    parser.add_argument('--crashes', type=int, default=5000)
+    parser.add_argument('--aadts', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    synthetic = generate(os.path.join(synth_dir, args.state), args.size, args.crashes, args.aadts, args.seed)
+    print(f"generated {len(synthetic.raw_ways)} ways, {len(synthetic.raw_relations)} relations, "
+          f"{len(synthetic.raw_members)} relation members")
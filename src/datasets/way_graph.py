@@ -3,6 +3,7 @@ import numpy as np
 import polyline
 from geographiclib.geodesic import Geodesic
 from weather import get_station_code
+from id_index import new_id_index
 
 """
 ways																
@@ -89,14 +90,17 @@ relations: relation_type, value, from_way, via_node, to_way
         3 no_overtaking
         4 timed_speed
 
-joints
+joints (built by joints.py)
     from_way_index: forward is positive, backward is negative
     to_way_index: forward is positive, backward is negative
-    length
-    slope
-    connected_lanes
-    traffic_control: no_sign, signal, stop, yield, merge, branch
-    traffic_conflicts: ???
+    via_node: node index
+    length: (from length + to length) / 2
+    slope: slope_up - slope_down of to way in travel direction
+    connected_lanes: lane_connectivity(3) value
+    traffic_control: no_sign(0), signal(1), stop(2), yield(3), railway_crossing(4), merge(5), branch(6)
+    restriction: timed restriction(1) value, the others remove the joint
+    barrier: barrier(2) value
+    traffic_conflicts: other joints at via_node crossing or merging with it (intersections.py)
 """
 
 class WayGraph:
@@ -108,8 +112,12 @@ class WayGraph:
 
     __way_idx__: {12345678:1, ...}
     __node_idx__: {22222101:0, 22222102:1, ...}
+    __relation_idx__: {33333301:0, ...}
+
+    id_index: 'dict', 'sorted' or 'disk' (id_index.py) for the way, node and relation id maps,
+        PIPELINE_ID_INDEX by default; station codes are a dict, there are only as many as weather stations
     '''
-    def __init__(self):
+    def __init__(self, id_index = None):
         self.ways = [{'way_id': 0, 'length': 0}] # way index is from 1 for negative (1 != -1, 0 == -0) 
         self.nodes = []
         self.stations = []
@@ -121,20 +129,18 @@ class WayGraph:
         self.__leaf_ways__ = []
         self.__relations__ = []
 
-        self.__way_idx__ = {}
-        self.__node_idx__ = {}
-        self.__relation_idx__ = {}
+        self.__way_idx__ = new_id_index(id_index, 'ways')
+        self.__node_idx__ = new_id_index(id_index, 'nodes')
+        self.__relation_idx__ = new_id_index(id_index, 'relations')
         self.__station_idx__ = {}
 
     def initialize(self, ways, nodes = None):
         self.ways = ways
-        for index, way in ways.iterrows():
-            self.__way_idx__[way['way_id']] = index
+        self.__way_idx__.insert_many(ways['way_id'].to_numpy(), ways.index.to_numpy())
 
         if nodes is not None:
             self.nodes = nodes
-            for index, node in nodes.iterrows():
-                self.__node_idx__[node['node_id']] = index
+            self.__node_idx__.insert_many(nodes['node_id'].to_numpy(), nodes.index.to_numpy())
 
     def get_way(self, way_id):
         return self.ways.iloc[self.__way_idx__[way_id]]
@@ -267,12 +273,35 @@ class WayGraph:
         if index is None:
             return
 
-        if (raw_member[2] == 'W' and raw_member[3] == 'from') and raw_member[1] // 1000 in self.__way_idx__:
-            self.__relations__[index][2] = self.__way_idx__[raw_member[1] // 1000]
-        elif (raw_member[2] == 'N' and raw_member[3] == 'via') and raw_member[1] in self.__node_idx__:
-            self.__relations__[index][3] = self.__node_idx__[raw_member[1]]
-        elif (raw_member[2] == 'W' and raw_member[3] == 'to') and raw_member[1] // 1000 in self.__way_idx__:
-            self.__relations__[index][4] = self.__way_idx__[raw_member[1] // 1000]
+        if raw_member[2] == 'W':
+            self.__set_member__(index, raw_member[3], self.__way_idx__.get(raw_member[1] // 1000, -1), -1)
+        elif raw_member[2] == 'N':
+            self.__set_member__(index, raw_member[3], -1, self.__node_idx__.get(raw_member[1], -1))
+
+    def add_relation_members(self, raw_members):
+        '''
+        add_relation_member of every row of RELATION_MEMBERS, the ids looked up in bulk
+        '''
+        member_ids = raw_members[1].to_numpy(dtype=np.int64)
+        relation_index = self.__relation_idx__.lookup_many(raw_members[0].to_numpy(dtype=np.int64))
+        way_index = self.__way_idx__.lookup_many(member_ids // 1000)
+        node_index = self.__node_idx__.lookup_many(member_ids)
+
+        kind = raw_members[2].to_numpy()
+        way_index[kind != 'W'] = -1
+        node_index[kind != 'N'] = -1
+        for index, role, way, node in zip(relation_index.tolist(), raw_members[3].tolist(),
+                                          way_index.tolist(), node_index.tolist()):
+            if index >= 0:
+                self.__set_member__(index, role, way, node)
+
+    def __set_member__(self, index, role, way_index, node_index):
+        if role == 'from' and way_index >= 0:
+            self.__relations__[index][2] = way_index
+        elif role == 'via' and node_index >= 0:
+            self.__relations__[index][3] = node_index
+        elif role == 'to' and way_index >= 0:
+            self.__relations__[index][4] = way_index
 
     def complete(self):
         for way in self.__leaf_ways__:
@@ -284,6 +313,13 @@ class WayGraph:
         for relation in self.__relations__:
             self.__settle_relation(relation)
 
+    def close(self):
+        '''
+        release the id maps, the files of a disk id index
+        '''
+        for index in [self.__way_idx__, self.__node_idx__, self.__relation_idx__]:
+            index.close()
+
     def __get_node_index__(self, node_id, point, from_node):
         way_index = len(self.ways)
         node_index = self.__node_idx__.get(node_id)
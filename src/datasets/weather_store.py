@@ -0,0 +1,191 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+local hourly weather store
+
+{root}/{station}/{yyyy-mm}.npz, one partition per station and UTC month:
+    hour:     int64   [row]    hours since epoch, UTC
+    temp, coco, prcp, wdir, wspd:
+              float32 [row]    NaN where missing
+    complete: bool             False if the month was not over when fetched, refetched next time
+
+a station without data in a month has an empty, complete partition so it is not fetched again
+"""
+
+COLUMNS = ['temp', 'coco', 'prcp', 'wdir', 'wspd']
+
+HOUR = np.timedelta64(1, 'h')
+
+class WeatherStore:
+
+    def __init__(self, root, offline = False, workers = 8):
+        self.root = os.path.expanduser(root)
+        self.offline = offline
+        self.workers = workers
+
+    def partition_path(self, station, month):
+        return os.path.join(self.root, str(station), f'{month}.npz')
+
+    def has_partition(self, station, month, complete = True):
+        path = self.partition_path(station, month)
+        if not os.path.exists(path):
+            return False
+        if not complete:
+            return True
+
+        with np.load(path) as partition:
+            return bool(partition['complete'])
+
+    def missing(self, stations, start, end):
+        '''
+        [(station, month)] not in the store for UTC datetimes [start, end), incomplete ones only if online
+        '''
+        months = _months(start, end)
+        return [(station, month) for station in stations for month in months
+                if not self.has_partition(station, month, not self.offline)]
+
+    def update(self, stations, start, end):
+        '''
+        fetch missing station months from meteostat, a few at a time with one partition in memory per worker
+        '''
+        tasks = self.missing(stations, start, end)
+        if not tasks:
+            return 0
+
+        if self.offline:
+            raise LookupError(f"{len(tasks)} station months are not in the offline weather store {self.root}, "
+                              f"e.g. {tasks[0]}")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            rows = sum(executor.map(lambda task: self.__fetch_partition__(*task), tasks))
+
+        print(f"fetched {len(tasks)} station months, {rows} hours of weather")
+        return len(tasks)
+
+    def __fetch_partition__(self, station, month):
+        from meteostat import Hourly
+
+        start = month.start_time.to_pydatetime()
+        end = month.end_time.floor('h').to_pydatetime()
+        data = Hourly(station, start, end).fetch()
+
+        if len(data):
+            hours = _hours(data.index.to_numpy())
+            self.write_partition(station, month, hours, data.reindex(columns=COLUMNS))
+        else:
+            self.write_partition(station, month, np.zeros(0, dtype=np.int64), pd.DataFrame(columns=COLUMNS))
+
+        return len(data)
+
+    def write_partition(self, station, month, hours, data, complete = None):
+        path = self.partition_path(station, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        columns = {column: data[column].to_numpy(dtype=np.float32) for column in COLUMNS}
+        if complete is None:
+            complete = month.end_time < pd.Timestamp.now('UTC').tz_localize(None)
+
+        # write then rename, so a reader never sees half a partition
+        temp_path = path[:-4] + '.tmp.npz'
+        np.savez(temp_path, hour=hours, complete=complete, **columns)
+        os.replace(temp_path, path)
+
+    def read_partition(self, station, month):
+        path = self.partition_path(station, month)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as partition:
+            return {name: partition[name] for name in ['hour'] + COLUMNS}
+
+    def read_arrays(self, stations, start, end):
+        '''
+        station positions in stations, hours since epoch and columns of UTC datetimes [start, end)
+        '''
+        first = _hours(np.datetime64(start, 'h'))
+        last = _hours(np.datetime64(end, 'h'))
+
+        parts = []
+        for index, station in enumerate(stations):
+            for month in _months(start, end):
+                partition = self.read_partition(station, month)
+                if partition is None or len(partition['hour']) == 0:
+                    continue
+
+                keep = (partition['hour'] >= first) & (partition['hour'] < last)
+                partition = {name: values[keep] for name, values in partition.items()}
+                partition['station'] = np.full(keep.sum(), index, dtype=np.int32)
+                parts.append(partition)
+
+        if not parts:
+            empty = {name: np.zeros(0, dtype=np.float32) for name in COLUMNS}
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64), empty
+
+        return (np.concatenate([part['station'] for part in parts]),
+                np.concatenate([part['hour'] for part in parts]),
+                {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS})
+
+    def read(self, stations, start, end, timezone = None):
+        '''
+        DataFrame indexed by (station, hour) as WEATHER_{year}.csv, station is the position in stations;
+        start, end and hour are local to timezone if given, otherwise UTC
+        '''
+        start_utc, end_utc = _to_utc(start, timezone), _to_utc(end, timezone)
+        station, hours, columns = self.read_arrays(stations, start_utc, end_utc)
+
+        hour = pd.to_datetime(hours * HOUR + np.datetime64(0, 'h'))
+        if timezone is not None:
+            hour = hour.tz_localize('UTC').tz_convert(timezone).tz_localize(None)
+
+        index = pd.MultiIndex.from_arrays([station, hour], names=['station', 'hour'])
+        return pd.DataFrame(columns, index=index)
+
+    def import_csv(self, weather_csv, stations, timezone = None):
+        '''
+        seed the store from a WEATHER_{year}.csv of the earlier 4_extract_nv_weather.py, which wrote one per year
+        before this store (no longer produced), e.g. for offline use;
+        stations are the codes of STATIONS.csv by station index, timezone of its hours if not UTC
+        '''
+        weather = pd.read_csv(os.path.expanduser(weather_csv))
+        hour = pd.to_datetime(weather['hour'].astype(str).str.zfill(8), format='%y%m%d%H')
+        if timezone is not None:
+            hour = hour.dt.tz_localize(timezone, ambiguous='NaT', nonexistent='NaT').dt.tz_convert('UTC').dt.tz_localize(None)
+
+        weather['hour'] = hour
+        weather = weather.dropna(subset=['hour'])
+        weather['month'] = weather['hour'].dt.to_period('M')
+
+        first = weather['hour'].min()
+        last = weather['hour'].max()
+
+        months = 0
+        for (station, month), data in weather.groupby(['station', 'month']):
+            # months cut by the ends of the file are kept, but fetched again when online
+            complete = month.start_time >= first and month.end_time.floor('h') <= last
+            if self.has_partition(stations[station], month, complete):
+                continue
+
+            self.write_partition(stations[station], month, _hours(data['hour'].to_numpy()), data, complete)
+            months += 1
+
+        return months
+
+def _months(start, end):
+    return list(pd.period_range(pd.Timestamp(start), pd.Timestamp(end) - pd.Timedelta(hours=1), freq='M'))
+
+def _hours(times):
+    return (np.asarray(times, dtype='datetime64[h]') - np.datetime64(0, 'h')) // HOUR
+
+def _to_utc(time, timezone):
+    time = pd.Timestamp(time)
+    if timezone is None:
+        return time.to_datetime64()
+
+    return time.tz_localize(timezone).tz_convert('UTC').tz_localize(None).to_datetime64()
+
+# store = WeatherStore("~/data/WEATHER")
+# store.update(['72488'], datetime(2019, 1, 1), datetime(2019, 2, 1))
+# print(store.read(['72488'], datetime(2019, 1, 1), datetime(2019, 2, 1), 'US/Pacific'))
@@ -0,0 +1,143 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from weather_store import COLUMNS, _hours, _to_utc
+
+"""
+dense hourly weather of one period
+    values: float32 [station, hour, var]    var in COLUMNS, NaN where missing
+    valid:  bool    [station, hour, var]
+    first_hour: hours since epoch (UTC) of hour 0; lookups take local times of timezone
+
+station is the station index of STATIONS.csv, as nodes['station']
+"""
+
+class WeatherTensor:
+
+    def __init__(self, values, first_hour, timezone):
+        self.values = values
+        self.valid = ~np.isnan(values)
+        self.first_hour = int(first_hour)
+        self.timezone = timezone
+
+        self.__nearest__ = None
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def hour_index(self, times):
+        '''
+        hour index of local times (datetime64 or strings); -1 if out of the period or not a time
+        '''
+        times = pd.DatetimeIndex(pd.to_datetime(times, errors='coerce')).floor('h')
+        if self.timezone is not None:
+            # an ambiguous local hour is taken as standard time, a skipped one as the hour after
+            times = times.tz_localize(self.timezone, ambiguous=np.zeros(len(times), dtype=bool),
+                                      nonexistent='shift_forward').tz_convert('UTC').tz_localize(None)
+
+        times = times.to_numpy().astype('datetime64[h]')
+        hours = times.astype(np.int64) - self.first_hour # NaT is the smallest int64
+        hours[np.isnat(times) | (hours < 0) | (hours >= self.shape[1])] = -1
+        return hours
+
+    def lookup(self, stations, times, fill = False, max_gap = 3):
+        '''
+        weather of every (station, local time) pair: values [n, var] float32 and valid [n, var];
+        fill takes the nearest valid hour within max_gap hours for a missing one
+        '''
+        stations = np.asarray(stations, dtype=np.int64)
+        hours = self.hour_index(times)
+        return self.gather(stations, hours, fill, max_gap)
+
+    def gather(self, stations, hours, fill = False, max_gap = 3):
+        found = (hours >= 0) & (stations >= 0) & (stations < self.shape[0])
+        stations = np.where(found, stations, 0)[:, None]
+        hours = np.where(found, hours, 0)[:, None]
+        variables = np.arange(self.shape[2])[None, :]
+
+        if fill:
+            nearest, distance = self.__nearest_valid__()
+            close = distance[stations, hours, variables] <= max_gap
+            hours = np.where(close, nearest[stations, hours, variables], hours)
+
+        valid = self.valid[stations, hours, variables] & found[:, None]
+        values = np.where(valid, self.values[stations, hours, variables], np.nan).astype(np.float32)
+        return values, valid
+
+    def __nearest_valid__(self):
+        '''
+        nearest valid hour and its distance per (station, hour, var), computed once
+        '''
+        if self.__nearest__ is not None:
+            return self.__nearest__
+
+        n_hours = self.shape[1]
+        hours = np.arange(n_hours)[None, :, None]
+        before = np.where(self.valid, hours, -n_hours)
+        np.maximum.accumulate(before, axis=1, out=before)
+        after = np.where(self.valid, hours, 2 * n_hours)
+        after = np.minimum.accumulate(after[:, ::-1], axis=1)[:, ::-1]
+
+        use_after = (after - hours) < (hours - before)
+        nearest = np.where(use_after, after, before)
+        distance = np.abs(nearest - hours)
+        nearest = np.clip(nearest, 0, n_hours - 1).astype(np.int32)
+
+        self.__nearest__ = (nearest, distance.astype(np.int32))
+        return self.__nearest__
+
+    def save(self, path):
+        path = os.path.expanduser(path)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'values.npy'), self.values)
+        with open(os.path.join(path, 'tensor.json'), 'w') as file:
+            json.dump({'first_hour': self.first_hour, 'timezone': self.timezone, 'columns': COLUMNS}, file)
+
+def load_weather_tensor(path, mmap = True):
+    path = os.path.expanduser(path)
+    with open(os.path.join(path, 'tensor.json')) as file:
+        meta = json.load(file)
+
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r' if mmap else None)
+    return WeatherTensor(values, meta['first_hour'], meta['timezone'])
+
+def build_weather_tensor(store, stations, start, end, timezone = None):
+    '''
+    stations: codes of STATIONS.csv by station index
+    start, end: local datetimes of timezone, e.g. a year
+    '''
+    first, last = _to_utc(start, timezone), _to_utc(end, timezone)
+    first_hour = int(_hours(first))
+
+    station, hours, columns = store.read_arrays(stations, first, last)
+    values = np.full((len(stations), int(_hours(last)) - first_hour, len(COLUMNS)), np.nan, dtype=np.float32)
+    values[station, hours - first_hour] = np.stack([columns[name] for name in COLUMNS], axis=1)
+
+    return WeatherTensor(values, first_hour, timezone)
+
+def weather_from_frame(weather, n_stations, start, end, timezone = None):
+    '''
+    tensor of a (station, hour) DataFrame as WeatherStore.read() returns, hour local to timezone
+    '''
+    first, last = _to_utc(start, timezone), _to_utc(end, timezone)
+    first_hour = int(_hours(first))
+
+    values = np.full((n_stations, int(_hours(last)) - first_hour, len(COLUMNS)), np.nan, dtype=np.float32)
+    hours = WeatherTensor(values, first_hour, timezone).hour_index(weather.index.get_level_values('hour'))
+    station = weather.index.get_level_values('station').to_numpy()
+
+    keep = hours >= 0
+    values[station[keep], hours[keep]] = weather[COLUMNS].to_numpy(dtype=np.float32)[keep]
+    return WeatherTensor(values, first_hour, timezone)
+
+def way_stations(ways, nodes):
+    '''
+    station index of every way by its from_node, or to_node if the from_node is not in the graph
+    '''
+    node_station = nodes['station'].to_numpy()
+    node = ways['from_node'].to_numpy()
+    node = np.where(node >= 0, node, ways['to_node'].to_numpy())
+    return np.where(node >= 0, node_station[np.maximum(node, 0)], -1)
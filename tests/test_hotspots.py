@@ -0,0 +1,25 @@
+import os
+import sys
+import numpy as np
+import pytest
+from geographiclib.geodesic import Geodesic
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'datasets'))
+
+from hotspots import project, grid_neighbors
+
+# Las Vegas as the origin, points there and in Reno, 600 km away
+ORIGIN = (36.1, -115.1)
+POINTS = [(36.1, -115.1), (39.5, -119.8), (41.9, -114.1)]
+
+@pytest.mark.parametrize('lat, lon', POINTS)
+@pytest.mark.parametrize('azimuth', [0, 90, 45, 180])
+def test_pair_at_exact_distance_are_neighbors(lat, lon, azimuth):
+    end = Geodesic.WGS84.Direct(lat, lon, azimuth, 50)
+    x, y = project([lat, end['lat2']], [lon, end['lon2']], ORIGIN)
+
+    assert np.hypot(x[1] - x[0], y[1] - y[0]) == pytest.approx(50, rel=0.01)
+    i, j = grid_neighbors(x, y, 60)
+    assert sorted(zip(i.tolist(), j.tolist())) == [(0, 1), (1, 0)]
+    i, j = grid_neighbors(x, y, 45)
+    assert len(i) == 0
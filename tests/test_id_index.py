@@ -0,0 +1,68 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'datasets'))
+
+from id_index import new_id_index, DictIdIndex, SortedIdIndex, DiskIdIndex
+from synthetic import SyntheticMap
+
+KINDS = ['dict', 'sorted', 'disk']
+
+def build(WayGraph, map_dir, kind):
+    '''
+    WAYS, NODES and RELATIONS csv text of the WayGraph build over a synthetic map, as 1_extract_ways.py
+    '''
+    graph = WayGraph(id_index=kind)
+    for name, append in [('WAYS', graph.append_way), ('RELATIONS', graph.append_relation)]:
+        for _, row in pd.read_csv(os.path.join(map_dir, name), delimiter='`', header=None).iterrows():
+            append(row)
+    graph.add_relation_members(pd.read_csv(os.path.join(map_dir, 'RELATION_MEMBERS'), delimiter='`', header=None))
+    graph.complete()
+    graph.close()
+    return [pd.DataFrame(rows).to_csv(index=False) for rows in (graph.ways, graph.nodes, graph.relations)]
+
+def test_way_graph_same_for_every_id_index(tmp_path, monkeypatch):
+    pytest.importorskip('meteostat') # station codes of way_graph.py
+    import way_graph
+    # the nearest station is a meteostat request, a cell of about 1 km stands in for it offline
+    monkeypatch.setattr(way_graph, 'get_station_code', lambda lat, lon: f"{lat:.2f}:{lon:.2f}")
+    SyntheticMap(20).write(str(tmp_path))
+    expected = build(way_graph.WayGraph, str(tmp_path), 'dict')
+    assert len(expected[0].splitlines()) > 100
+    for kind in KINDS[1:]:
+        assert build(way_graph.WayGraph, str(tmp_path), kind) == expected, kind
+
+@pytest.mark.parametrize('kind', KINDS[1:])
+def test_id_index_agrees_with_dict(kind, tmp_path):
+    rng = np.random.default_rng(0)
+    ids = rng.integers(1, 1 << 62, 300000)
+    ids[rng.integers(0, len(ids), 20000)] = ids[:20000] # ids inserted again map to their newer index
+    indexes = np.arange(len(ids))
+
+    expected = DictIdIndex()
+    # small buffer and block, so single inserts flush into runs and merges cross block bounds
+    if kind == 'sorted':
+        index = SortedIdIndex(buffer=1000, block=4096)
+    else:
+        index = DiskIdIndex(str(tmp_path), buffer=1000, block=4096)
+    for start, end in [(0, 100000), (150000, 250000)]:
+        expected.insert_many(ids[start:end], indexes[start:end])
+        index.insert_many(ids[start:end], indexes[start:end])
+    for start, end in [(100000, 150000), (250000, 300000)]:
+        for id, i in zip(ids[start:end].tolist(), indexes[start:end].tolist()):
+            expected[id] = i
+            index[id] = i
+
+    queries = np.concatenate([ids, rng.integers(1, 1 << 62, 10000)])
+    assert np.array_equal(index.lookup_many(queries), expected.lookup_many(queries))
+    for id in queries[::997].tolist():
+        assert index.get(id) == expected.get(id)
+    index.close()
+
+def test_new_id_index_kind():
+    assert isinstance(new_id_index('dict'), DictIdIndex)
+    with pytest.raises(ValueError):
+        new_id_index('tree')